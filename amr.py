@@ -7,7 +7,9 @@ For detailed description of AMR, see http://www.isi.edu/natural-language/amr/a.p
 
 """
 
+from array import array
 from collections import defaultdict
+import re
 import sys
 
 # change this if needed
@@ -16,6 +18,48 @@ ERROR_LOG = sys.stderr
 # change this if needed
 DEBUG_LOG = sys.stderr
 
+# tokens of an AMR line: (significant symbol ( : / ), quoted string, run of other characters that follows it).
+# The closing quote of a quoted string may be missing, spaces are part of the run.
+AMR_TOKEN = re.compile(r'(?:([():/])|("[^"]*"?))?([^"():/]*)')
+
+# units of a well-formed AMR line: [:relation] (node / concept, :relation value and :relation "quoted value"[suffix],
+# each with the closing brackets that follow, or only closing brackets, or any other character (no group is set)
+AMR_UNIT = re.compile(r' *(?:(?:(?::([^\s"():/]+) *)?\( *([^\s"():/]+) */ *([^\s"():/]*)'
+                      r'|:([^\s"():/]+) +([^\s"():/]+|"[^"]*"[^\s"():/]*)|(?=\)))(?: *(\)+))?|[\s\S])')
+
+# kinds of the edges in the tree of an AMR: a node that is defined here, a reference to a node (re-entrancy)
+# or a constant
+CHILD, REFERENCE, CONSTANT = 0, 1, 2
+
+# sense number of a concept (possibly followed by an alignment), e.g. "-01" in "want-01" or "want-01~e.3"
+SENSE = re.compile(r'-\d\d(?=~|$)')
+
+
+class AMRParseError(Exception):
+    """
+    Error in an AMR line.
+    kind: short name of the type of error, e.g. "unmatched_parenthesis" or "duplicate_node"
+    position: character offset of the error in the line
+    The message is the one that AMR.parse_AMR_line writes to ERROR_LOG.
+
+    """
+    def __init__(self, kind, position, *message):
+        # the parts of the message are joined like the print statement does: no space after a part that ends with
+        # whitespace other than a space
+        text, softspace = "", False
+        for part in message:
+            part = "%s" % (part,)
+            if softspace:
+                text += " "
+            text += part
+            softspace = not part or not part[-1].isspace() or part[-1] == " "
+        Exception.__init__(self, text)
+        self.kind = kind
+        self.position = position
+
+    def __reduce__(self):
+        return AMRParseError, (self.kind, self.position, self.args[0])
+
 
 class AMR(object):
     """
@@ -32,6 +76,9 @@ class AMR(object):
     attributes: list of edges connecting a node to an attribute name and its value. For example, if the polarity of
                some node is negative, there should be an edge connecting this node and "-". A triple < attribute name,
                node name, attribute value> is used to represent such attribute. It can also be viewed as a relation.
+    tree: only if the AMR is parsed with keep_tree=True (otherwise None). Its ith element is the list of edges of
+          node i, in the order of the AMR text: (relation as written, CHILD or REFERENCE, index of the other node) or
+          (relation as written, CONSTANT, value as written). It is used to serialize the AMR again.
 
     """
     def __init__(self, node_list=None, node_value_list=None, relation_list=None, attribute_list=None):
@@ -66,6 +113,7 @@ class AMR(object):
             self.attributes = []
         else:
             self.attributes = attribute_list[:]
+        self.tree = None
 
     def rename_node(self, prefix):
         """
@@ -163,232 +211,323 @@ class AMR(object):
         """
         print >> DEBUG_LOG, self.__str__()
 
+    def get_tokens(self, variables=True):
+        """
+        Get the tokens of the one-line PENMAN form of the AMR, e.g. ( w / want-01 :ARG0 ( b / boy ) :ARG1 b ),
+        or of the variable-free form if variables is False: ( want-01 :ARG0 ( boy ) :ARG1 b ).
+        Each node and edge of the tree is visited once. Nodes that are not reached from the root (only possible
+        for malformed lines, e.g. with a relation directly before a parenthesis) are left out.
 
-    @staticmethod
-    def parse_AMR_line(line):
         """
-        Parse a AMR from line representation to an AMR object.
-        This parsing algorithm scans the line once and process each character, in a shift-reduce style.
-
-        """
-        # Current state. It denotes the last significant symbol encountered. 1 for (, 2 for :, 3 for /,
-        # and 0 for start state or ')'
-        # Last significant symbol is ( --- start processing node name
-        # Last significant symbol is : --- start processing relation name
-        # Last significant symbol is / --- start processing node value (concept name)
-        # Last significant symbol is ) --- current node processing is complete
-        # Note that if these symbols are inside parenthesis, they are not significant symbols.
-        state = 0
-        # node stack for parsing
+        if self.tree is None:
+            raise ValueError("AMR has no tree, parse it with keep_tree=True")
+        tokens = []
+        if not self.nodes:
+            return tokens
+        # stack of [node index, index of its next edge]
         stack = []
-        # current not-yet-reduced character sequence
-        cur_charseq = []
-        # key: node name value: node value
-        node_dict = {}
-        # node name list (order: occurrence of the node)
-        node_name_list = []
-        # key: node name:  value: list of (relation name, the other node name)
-        node_relation_dict1 = defaultdict(list)
-        # key: node name, value: list of (attribute name, const value) or (relation name, unseen node name)
-        node_relation_dict2 = defaultdict(list)
-        # current relation name
-        cur_relation_name = ""
-        # having unmatched quote string
-        in_quote = False
-        for i, c in enumerate(line.strip()):
-            if c == " ":
-                # allow space in relation name
-                if state == 2:
-                    cur_charseq.append(c)
+        target = 0
+        while True:
+            if target is not None:
+                # open a node
+                tokens.append("(")
+                if variables:
+                    tokens.extend((self.nodes[target], "/"))
+                tokens.append(self.node_values[target])
+                stack.append([target, 0])
+                target = None
+            node, edge_index = stack[-1]
+            if edge_index == len(self.tree[node]):
+                tokens.append(")")
+                stack.pop()
+                if not stack:
+                    return tokens
                 continue
-            if c == "\"":
-                # flip in_quote value when a quote symbol is encountered
-                # insert placeholder if in_quote from last symbol
-                if in_quote:
-                    cur_charseq.append('_')
-                in_quote = not in_quote
-            elif c == "(":
-                # not significant symbol if inside quote
-                if in_quote:
-                    cur_charseq.append(c)
+            stack[-1][1] += 1
+            relation, kind, value = self.tree[node][edge_index]
+            tokens.append(":" + relation)
+            if kind == CHILD:
+                target = value
+            elif kind == REFERENCE:
+                tokens.append(self.nodes[value])
+            else:
+                tokens.append(value)
+
+    def to_penman(self, variables=True, parentheses=True):
+        """
+        Serialize the AMR to a one-line PENMAN string, e.g. (w / want-01 :ARG0 (b / boy) :ARG1 b)
+        variables: if False, the variable-free form (want-01 :ARG0 (boy) :ARG1 b)
+        parentheses: if False, without any parentheses (want-01 :ARG0 boy :ARG1 b)
+
+        """
+        tokens = self.get_tokens(variables)
+        if not parentheses:
+            return " ".join([token for token in tokens if token != "(" and token != ")"])
+        return join_tokens(tokens)
+
+    def to_var_free(self, parentheses=True):
+        """
+        Serialize the AMR to the variable-free form, e.g. (want-01 :ARG0 (boy) :ARG1 (go-01 :ARG0 (boy))) after
+        duplicate_reentrancies
+
+        """
+        return self.to_penman(False, parentheses)
+
+    def delete_wiki(self):
+        """
+        Delete the :wiki relations of all nodes
+
+        """
+        for attribute_dict in self.attributes:
+            attribute_dict.pop("wiki", None)
+        if self.tree is not None:
+            self.tree = [[edge for edge in edges if edge[0] != "wiki"] for edges in self.tree]
+
+    def delete_senses(self):
+        """
+        Delete the sense numbers of all concepts, e.g. want-01 becomes want
+
+        """
+        self.node_values = [SENSE.sub("", value) for value in self.node_values]
+        if self.attributes and "TOP" in self.attributes[0]:
+            self.attributes[0]["TOP"] = self.node_values[0]
+
+    def duplicate_reentrancies(self):
+        """
+        Replace each re-entrancy by a new node with the same concept, so that the tree has no references any more.
+        E.g. (l / like-01 :ARG0 (p / person) :ARG1 p) becomes (l / like-01 :ARG0 (p / person) :ARG1 (p2 / person))
+        Only the concept is copied, not the relations of the node, so each re-entrancy adds one node.
+
+        """
+        if self.tree is None:
+            raise ValueError("AMR has no tree, parse it with keep_tree=True")
+        names = set(self.nodes)
+        for i in range(len(self.nodes)):
+            edges = self.tree[i]
+            for edge_index, (relation, kind, value) in enumerate(edges):
+                if kind != REFERENCE:
                     continue
-                # get the attribute name
-                # e.g :arg0 (x ...
-                # at this point we get "arg0"
-                if state == 2:
-                    # in this state, current relation name should be empty
-                    if cur_relation_name != "":
-                        print >> ERROR_LOG, "Format error when processing ", line[0:i+1]
-                        return None
-                    # update current relation name for future use
-                    cur_relation_name = "".join(cur_charseq).strip()
-                    cur_charseq[:] = []
-                state = 1
-            elif c == ":":
-                # not significant symbol if inside quote
-                if in_quote:
-                    cur_charseq.append(c)
+                source, target = self.nodes[i], self.nodes[value]
+                count = 2
+                while target + str(count) in names:
+                    count += 1
+                name = target + str(count)
+                names.add(name)
+                self.nodes.append(name)
+                self.node_values.append(self.node_values[value])
+                self.relations.append({})
+                self.attributes.append({})
+                self.tree.append([])
+                edges[edge_index] = (relation, CHILD, len(self.nodes) - 1)
+                # move the relation from the referred node to the new node
+                if relation.endswith("-of"):
+                    if self.relations[value].get(source) == relation[:-3]:
+                        del self.relations[value][source]
+                        self.relations[-1][source] = relation[:-3]
+                else:
+                    self.relations[i].pop(target, None)
+                    self.relations[i][name] = relation
+                    # there is only one relation per pair of nodes, another edge to the referred node (the last one,
+                    # as in parsing) gets it back
+                    for other_relation, other_kind, other_value in edges:
+                        if other_kind != CONSTANT and other_value == value and not other_relation.endswith("-of"):
+                            self.relations[i][target] = other_relation
+
+
+    def canonical_order(self):
+        """
+        Order of the nodes that does not depend on the node names or on the order of the branches in the line:
+        the order in which a depth-first traversal from the root visits them, where the branches of a node are
+        visited in the order of (direction, relation, class of the other node). The classes are found by refining
+        the concepts and attributes of the nodes with the classes of their neighbours until they do not change
+        (Weisfeiler-Lehman), so the order is canonical for trees and for all but highly symmetric graphs.
+        Returns:
+            list of node indexes, the root first
+
+        """
+        num_nodes = len(self.nodes)
+        node_index = dict([(name, i) for i, name in enumerate(self.nodes)])
+        out_edges = [[] for _ in range(num_nodes)]
+        in_edges = [[] for _ in range(num_nodes)]
+        for i, relation_dict in enumerate(self.relations):
+            for other, relation in relation_dict.items():
+                relation, i2, j = normalize_relation(relation, i, node_index[other])
+                out_edges[i2].append((relation, j))
+                in_edges[j].append((relation, i2))
+
+        def ranks(signatures):
+            rank = dict([(sig, r) for r, sig in enumerate(sorted(set(signatures)))])
+            return [rank[sig] for sig in signatures], len(rank)
+
+        # the root is marked, so it is never in the same class as another node
+        colors, num_colors = ranks([(i == 0, self.node_values[i], tuple(sorted(self.attributes[i].items())))
+                                    for i in range(num_nodes)])
+        while True:
+            signatures = [(colors[i], tuple(sorted([(relation, colors[j]) for relation, j in out_edges[i]])),
+                           tuple(sorted([(relation, colors[j]) for relation, j in in_edges[i]])))
+                          for i in range(num_nodes)]
+            new_colors, num_new_colors = ranks(signatures)
+            colors = new_colors
+            if num_new_colors == num_colors:
+                break
+            num_colors = num_new_colors
+
+        order = []
+        visited = [False] * num_nodes
+        # nodes that are not connected to the root (only in malformed AMRs) are visited after the others
+        for start in [0] + sorted(range(num_nodes), key=lambda i: colors[i]):
+            if not num_nodes or visited[start]:
+                continue
+            stack = [start]
+            visited[start] = True
+            while stack:
+                i = stack.pop()
+                order.append(i)
+                branches = sorted([(0, relation, colors[j], j) for relation, j in out_edges[i]] +
+                                  [(1, relation, colors[j], j) for relation, j in in_edges[i]])
+                # reversed, so the first branch is visited first
+                for _, _, _, j in reversed(branches):
+                    if not visited[j]:
+                        visited[j] = True
+                        stack.append(j)
+        return order
+
+    def canonicalize(self):
+        """
+        Rename and reorder the nodes in canonical order (see canonical_order). Nodes get the first letter of their
+        concept as name, followed by a number if the letter is already used (e.g. w, b, g, b2). If the AMR has a
+        tree, the branches of each node are sorted as well, so to_penman gives the same line for AMRs that only
+        differ in variable names or branch order.
+
+        """
+        order = self.canonical_order()
+        new_index = [0] * len(order)
+        for new, old in enumerate(order):
+            new_index[old] = new
+        names = []
+        used = set()
+        for i in order:
+            prefix = self.node_values[i][:1].lower()
+            if not prefix.isalpha():
+                prefix = "x"
+            name, count = prefix, 1
+            while name in used:
+                count += 1
+                name = prefix + str(count)
+            used.add(name)
+            names.append(name)
+        name_map = dict([(self.nodes[i], names[new_index[i]]) for i in order])
+        self.nodes = names
+        self.root = names[0] if names else None
+        self.node_values = [self.node_values[i] for i in order]
+        self.relations = [dict([(name_map[k], v) for k, v in self.relations[i].items()]) for i in order]
+        self.attributes = [self.attributes[i] for i in order]
+        if self.tree is not None:
+            tree = []
+            for i in order:
+                edges = [(relation, kind, value if kind == CONSTANT else new_index[value])
+                         for relation, kind, value in self.tree[i]]
+                # constants and nodes by relation, then nodes in canonical order
+                edges.sort(key=lambda edge: (edge[0], edge[1] == CONSTANT, edge[2]))
+                tree.append(edges)
+            # a node is defined at its first occurrence in the line of the sorted tree, the other occurrences
+            # refer to it
+            defined = set([0])
+            # stack of [node index, index of its next edge], as in get_tokens
+            stack = [[0, 0]] if tree else []
+            while stack:
+                i, edge_index = stack[-1]
+                if edge_index == len(tree[i]):
+                    stack.pop()
                     continue
-                # Last significant symbol is "/". Now we encounter ":"
-                # Example:
-                # :OR (o2 / *OR*
-                #    :mod (o3 / official)
-                #  gets node value "*OR*" at this point
-                if state == 3:
-                    node_value = "".join(cur_charseq)
-                    # clear current char sequence
-                    cur_charseq[:] = []
-                    # pop node name ("o2" in the above example)
-                    cur_node_name = stack[-1]
-                    # update node name/value map
-                    node_dict[cur_node_name] = node_value
-                # Last significant symbol is ":". Now we encounter ":"
-                # Example:
-                # :op1 w :quant 30
-                # or :day 14 :month 3
-                # the problem is that we cannot decide if node value is attribute value (constant)
-                # or node value (variable) at this moment
-                elif state == 2:
-                    temp_attr_value = "".join(cur_charseq)
-                    cur_charseq[:] = []
-                    parts = temp_attr_value.split()
-                    if len(parts) < 2:
-                        print >> ERROR_LOG, "Error in processing; part len < 2", line[0:i+1]
-                        return None
-                    # For the above example, node name is "op1", and node value is "w"
-                    # Note that this node name might not be encountered before
-                    relation_name = parts[0].strip()
-                    relation_value = parts[1].strip()
-                    # We need to link upper level node to the current
-                    # top of stack is upper level node
-                    if len(stack) == 0:
-                        print >> ERROR_LOG, "Error in processing", line[:i], relation_name, relation_value
-                        return None
-                    # if we have not seen this node name before
-                    if relation_value not in node_dict:
-                        node_relation_dict2[stack[-1]].append((relation_name, relation_value))
-                    else:
-                        node_relation_dict1[stack[-1]].append((relation_name, relation_value))
-                state = 2
-            elif c == "/":
-                if in_quote:
-                    cur_charseq.append(c)
+                stack[-1][1] += 1
+                relation, kind, value = tree[i][edge_index]
+                if kind == CONSTANT:
                     continue
-                # Last significant symbol is "(". Now we encounter "/"
-                # Example:
-                # (d / default-01
-                # get "d" here
-                if state == 1:
-                    node_name = "".join(cur_charseq)
-                    cur_charseq[:] = []
-                    # if this node name is already in node_dict, it is duplicate
-                    if node_name in node_dict:
-                        print >> ERROR_LOG, "Duplicate node name ", node_name, " in parsing AMR"
-                        return None
-                    # push the node name to stack
-                    stack.append(node_name)
-                    # add it to node name list
-                    node_name_list.append(node_name)
-                    # if this node is part of the relation
-                    # Example:
-                    # :arg1 (n / nation)
-                    # cur_relation_name is arg1
-                    # node name is n
-                    # we have a relation arg1(upper level node, n)
-                    if cur_relation_name != "":
-                        # if relation name ends with "-of", e.g."arg0-of",
-                        # it is reverse of some relation. For example, if a is "arg0-of" b,
-                        # we can also say b is "arg0" a.
-                        # If the relation name ends with "-of", we store the reverse relation.
-                        if not cur_relation_name.endswith("-of"):
-                            # stack[-2] is upper_level node we encountered, as we just add node_name to stack
-                            node_relation_dict1[stack[-2]].append((cur_relation_name, node_name))
-                        else:
-                            # cur_relation_name[:-3] is to delete "-of"
-                            node_relation_dict1[node_name].append((cur_relation_name[:-3], stack[-2]))
-                        # clear current_relation_name
-                        cur_relation_name = ""
+                if value in defined:
+                    tree[i][edge_index] = (relation, REFERENCE, value)
                 else:
-                    # error if in other state
-                    print >> ERROR_LOG, "Error in parsing AMR", line[0:i+1]
-                    return None
-                state = 3
-            elif c == ")":
-                if in_quote:
-                    cur_charseq.append(c)
-                    continue
-                # stack should be non-empty to find upper level node
-                if len(stack) == 0:
-                    print >> ERROR_LOG, "Unmatched parenthesis at position", i, "in processing", line[0:i+1]
-                    return None
-                # Last significant symbol is ":". Now we encounter ")"
-                # Example:
-                # :op2 "Brown") or :op2 w)
-                # get \"Brown\" or w here
-                if state == 2:
-                    temp_attr_value = "".join(cur_charseq)
-                    cur_charseq[:] = []
-                    parts = temp_attr_value.split()
-                    if len(parts) < 2:
-                        print >> ERROR_LOG, "Error processing", line[:i+1], temp_attr_value
-                        return None
-                    relation_name = parts[0].strip()
-                    relation_value = parts[1].strip()
-                    # store reverse of the relation
-                    # we are sure relation_value is a node here, as "-of" relation is only between two nodes
-                    if relation_name.endswith("-of"):
-                        node_relation_dict1[relation_value].append((relation_name[:-3], stack[-1]))
-                    # attribute value not seen before
-                    # Note that it might be a constant attribute value, or an unseen node
-                    # process this after we have seen all the node names
-                    elif relation_value not in node_dict:
-                        node_relation_dict2[stack[-1]].append((relation_name, relation_value))
-                    else:
-                        node_relation_dict1[stack[-1]].append((relation_name, relation_value))
-                # Last significant symbol is "/". Now we encounter ")"
-                # Example:
-                # :arg1 (n / nation)
-                # we get "nation" here
-                elif state == 3:
-                    node_value = "".join(cur_charseq)
-                    cur_charseq[:] = []
-                    cur_node_name = stack[-1]
-                    # map node name to its value
-                    node_dict[cur_node_name] = node_value
-                # pop from stack, as the current node has been processed
-                stack.pop()
-                cur_relation_name = ""
-                state = 0
+                    defined.add(value)
+                    tree[i][edge_index] = (relation, CHILD, value)
+                    stack.append([value, 0])
+            self.tree = tree
+
+    def canonical_form(self):
+        """
+        String that is the same for AMRs that only differ in variable names or branch order: the sorted triples of
+        the AMR after canonicalize, e.g. "ARG0(w,b) TOP(w,want-01) instance(b,boy) instance(w,want-01)"
+        Relations that are still inverted (see normalize_relation) are written the other way around.
+        The AMR itself is not changed.
+
+        """
+        canonical = AMR(self.nodes, self.node_values, self.relations, self.attributes)
+        canonical.canonicalize()
+        instance_triples, attribute_triples, relation_triples = canonical.get_triples()
+        triples = instance_triples + attribute_triples + [normalize_relation(*triple) for triple in relation_triples]
+        return " ".join(sorted(["%s(%s,%s)" % triple for triple in triples]))
+
+    @staticmethod
+    def parse_AMR_line(line, raise_errors=False, keep_tree=False):
+        """
+        Parse a AMR from line representation to an AMR object.
+        Most AMRs are read with a compiled regular expression and built in the same pass (see read_well_formed).
+        Other lines are split into tokens with a compiled regular expression and processed in a shift-reduce style
+        (see read_tokens).
+        If the line is not a valid AMR, the error is written to ERROR_LOG and None is returned, or AMRParseError
+        is raised if raise_errors is True.
+        If keep_tree is True, the order of the edges in the line is kept as well (see the tree member), so the AMR
+        can be serialized again.
+
+        """
+        result_amr = read_well_formed(line.strip(), keep_tree)
+        if result_amr is not None:
+            return result_amr
+        tree = defaultdict(list) if keep_tree else None
+        try:
+            parsed = read_tokens(line, tree)
+            if not parsed[1]:
+                if raise_errors:
+                    raise AMRParseError("empty", 0, "Error: no AMR in line")
             else:
-                # not significant symbols, so we just shift.
-                cur_charseq.append(c)
+                missing = [v for v in parsed[1] if v not in parsed[0]]
+                if missing:
+                    # the concept of a node is only stored when it is closed, so the line ended too early
+                    raise AMRParseError("incomplete", len(line.rstrip()), "Error: Node name not found", missing[0])
+        except AMRParseError, error:
+            if raise_errors:
+                raise
+            print >> ERROR_LOG, error.args[0]
+            return None
+        return AMR.from_parsed(parsed, tree)
+
+    @staticmethod
+    def from_parsed(parsed, tree=None):
+        """
+        Build an AMR object from the result of read_tokens (or read_recovering), with the tree if it was kept
+
+        """
+        node_dict, node_name_list, node_relation_dict1, node_relation_dict2 = parsed
         #create data structures to initialize an AMR
         node_value_list = []
         relation_list = []
         attribute_list = []
         for v in node_name_list:
-            if v not in node_dict:
-                print >> ERROR_LOG, "Error: Node name not found", v
-                return None
-            else:
-                node_value_list.append(node_dict[v])
+            node_value_list.append(node_dict[v])
             # build relation map and attribute map for this node
             relation_dict = {}
             attribute_dict = {}
-            if v in node_relation_dict1:
-                for v1 in node_relation_dict1[v]:
-                    relation_dict[v1[1]] = v1[0]
-            if v in node_relation_dict2:
-                for v2 in node_relation_dict2[v]:
-                    # if value is in quote, it is a constant value
-                    # strip the quote and put it in attribute map
-                    if v2[1][0] == "\"" and v2[1][-1] == "\"":
-                        attribute_dict[v2[0]] = v2[1][1:-1]
-                    # if value is a node name
-                    elif v2[1] in node_dict:
-                        relation_dict[v2[1]] = v2[0]
-                    else:
-                        attribute_dict[v2[0]] = v2[1]
+            for relation_name, other_node in node_relation_dict1.get(v, ()):
+                relation_dict[other_node] = relation_name
+            for attr_name, attr_value in node_relation_dict2.get(v, ()):
+                # if value is in quote, it is a constant value
+                # strip the quote and put it in attribute map
+                if attr_value[0] == "\"" and attr_value[-1] == "\"":
+                    attribute_dict[attr_name] = attr_value[1:-1]
+                # if value is a node name
+                elif attr_value in node_dict:
+                    relation_dict[attr_value] = attr_name
+                else:
+                    attribute_dict[attr_name] = attr_value
             # each node has a relation map and attribute map
             relation_list.append(relation_dict)
             attribute_list.append(attribute_dict)
@@ -399,8 +538,1011 @@ class AMR(object):
         #print relation_list
         #print attribute_list,'\n\n'
         result_amr = AMR(node_name_list, node_value_list, relation_list, attribute_list)
+        if tree is not None:
+            # refer to nodes by index, a value that is a node name is a re-entrancy
+            node_index = dict([(v, i) for i, v in enumerate(node_name_list)])
+            result_amr.tree = []
+            for v in node_name_list:
+                edges = []
+                for relation_name, kind, value in tree.get(v, ()):
+                    if kind == CHILD:
+                        edges.append((relation_name, CHILD, node_index[value]))
+                    elif value in node_index:
+                        edges.append((relation_name, REFERENCE, node_index[value]))
+                    else:
+                        edges.append((relation_name, CONSTANT, value))
+                result_amr.tree.append(edges)
         return result_amr
 
+    @staticmethod
+    def recover_AMR_line(line):
+        """
+        Parse an AMR line that may be malformed (e.g. output of a parser), see read_recovering. Nothing is written
+        to ERROR_LOG.
+        Returns:
+            the AMR of the parts that could be read (with tree, so it can be serialized again with to_penman), None if
+            the line has no node at all, and the list of AMRParseError of the errors that were repaired or skipped
+
+        """
+        parsed, tree, errors = read_recovering(line)
+        if not parsed[1]:
+            return None, errors
+        return AMR.from_parsed(parsed, tree), errors
+
+    @staticmethod
+    def parse_var_free_line(line):
+        """
+        Parse a variable-free AMR (as produced by var_free_amrs.py, create_coref_indexing.py or
+        create_coref_paths.py, possibly in the +-spaced character-level format) to an AMR object.
+        Variables are synthesized while reading the line, so no restoring step is needed before scoring.
+
+        """
+        penman_line = var_free_to_penman(line)
+        if penman_line is None:
+            return None
+        return AMR.parse_AMR_line(penman_line)
+
+
+# interned labels (concepts, relation names and attribute values) shared by all CompactAMR objects.
+# A label is stored once and referred to by its index in LABELS.
+LABELS = []
+LABEL_IDS = {}
+
+
+def label_id(label):
+    """
+    Index of label in LABELS, the label is added if it was not seen before
+
+    """
+    try:
+        return LABEL_IDS[label]
+    except KeyError:
+        LABEL_IDS[label] = len(LABELS)
+        LABELS.append(label)
+        return len(LABELS) - 1
+
+
+class TripleView(object):
+    """
+    Read-only sequence of the instance, attribute or relation triples of a CompactAMR.
+    Triples are built from the integer arrays when they are accessed, nothing is copied. The view follows the
+    node names of the AMR, so it changes after rename_node.
+
+    """
+    __slots__ = ("amr", "kind", "start", "length")
+
+    def __init__(self, amr, kind):
+        """
+        amr: CompactAMR
+        kind: "instance", "attribute" or "relation"
+
+        """
+        self.amr = amr
+        self.kind = kind
+        num_nodes, num_relations, num_attributes = amr.data[0], amr.data[1], amr.data[2]
+        if kind == "instance":
+            self.start, self.length = 3, num_nodes
+        elif kind == "relation":
+            self.start, self.length = 3 + num_nodes, num_relations
+        else:
+            self.start, self.length = 3 + num_nodes + 3 * num_relations, num_attributes
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(self.length))]
+        if index < 0:
+            index += self.length
+        if not 0 <= index < self.length:
+            raise IndexError("triple index out of range")
+        data = self.amr.data
+        if self.kind == "instance":
+            return "instance", self.amr.node_name(index), LABELS[data[self.start + index]]
+        pos = self.start + 3 * index
+        if self.kind == "relation":
+            return LABELS[data[pos + 1]], self.amr.node_name(data[pos]), self.amr.node_name(data[pos + 2])
+        return LABELS[data[pos + 1]], self.amr.node_name(data[pos]), LABELS[data[pos + 2]]
+
+    def __iter__(self):
+        for i in xrange(self.length):
+            yield self[i]
+
+    def __repr__(self):
+        return repr(list(self))
+
+
+class CompactAMR(object):
+    """
+    Memory-efficient, read-only version of AMR, for keeping a large corpus of graphs in memory.
+    All integers are stored in one array ("data"), with this layout:
+    [number of nodes, number of relations, number of attributes,
+     concept id of each node,
+     (node index, relation name id, node index) for each relation,
+     (node index, attribute name id, attribute value id) for each attribute]
+    Concepts, relation names and attribute values are ids of labels in LABELS (see label_id). Relations and
+    attributes are in the same order as in AMR.get_triples.
+    names: tuple of the node names, or None if the nodes are named prefix + node index (after rename_node)
+    root: root node name (like in AMR, it is not changed by rename_node)
+
+    """
+    __slots__ = ("names", "prefix", "data", "root")
+
+    def __init__(self, names, data, prefix=None):
+        self.names = names
+        self.data = data
+        self.prefix = prefix
+        self.root = names[0] if names else None
+
+    @staticmethod
+    def from_amr(amr):
+        """
+        Create a CompactAMR from an AMR object
+
+        """
+        # the data is collected in a list and labels are looked up in LABEL_IDS directly, label_id is only called
+        # for new labels
+        ids = LABEL_IDS
+        node_index = dict([(name, i) for i, name in enumerate(amr.nodes)])
+        data = [len(amr.nodes), 0, 0]
+        data += [ids[value] if value in ids else label_id(value) for value in amr.node_values]
+        start = len(data)
+        for i, relations in enumerate(amr.relations):
+            for k, v in relations.items():
+                data += (i, ids[v] if v in ids else label_id(v), node_index[k])
+        data[1] = (len(data) - start) // 3
+        start = len(data)
+        for i, attributes in enumerate(amr.attributes):
+            for k2, v2 in attributes.items():
+                data += (i, ids[k2] if k2 in ids else label_id(k2), ids[v2] if v2 in ids else label_id(v2))
+        data[2] = (len(data) - start) // 3
+        return CompactAMR(tuple([intern(name) if isinstance(name, str) else name for name in amr.nodes]),
+                          array("i", data))
+
+    @staticmethod
+    def parse_AMR_line(line):
+        """
+        Parse an AMR line (see AMR.parse_AMR_line) to a CompactAMR object, None if the line is not a valid AMR
+
+        """
+        amr = AMR.parse_AMR_line(line)
+        if amr is None:
+            return None
+        return CompactAMR.from_amr(amr)
+
+    def to_amr(self):
+        """
+        Convert back to an AMR object, with the same nodes, relations and attributes
+
+        """
+        data = self.data
+        nodes = self.nodes
+        relations = [{} for _ in nodes]
+        attributes = [{} for _ in nodes]
+        pos = 3 + data[0]
+        for _ in range(data[1]):
+            relations[data[pos]][nodes[data[pos + 2]]] = LABELS[data[pos + 1]]
+            pos += 3
+        for _ in range(data[2]):
+            attributes[data[pos]][LABELS[data[pos + 1]]] = LABELS[data[pos + 2]]
+            pos += 3
+        return AMR(nodes, self.node_values, relations, attributes)
+
+    def node_name(self, index):
+        if self.names is None:
+            return self.prefix + str(index)
+        return self.names[index]
+
+    def label_positions(self):
+        """
+        Positions in data that hold a label id (concepts, relation names, attribute names and values)
+
+        """
+        num_nodes, num_relations, num_attributes = self.data[0], self.data[1], self.data[2]
+        positions = range(3, 3 + num_nodes)
+        positions += range(4 + num_nodes, 3 + num_nodes + 3 * num_relations, 3)
+        start = 3 + num_nodes + 3 * num_relations
+        for pos in range(start, start + 3 * num_attributes, 3):
+            positions += [pos + 1, pos + 2]
+        return positions
+
+    def rename_node(self, prefix):
+        """
+        Rename AMR graph nodes to prefix + node_index (see AMR.rename_node), only the prefix is stored.
+        The relations of each node are put in the order of the renamed relation dict of AMR, so the triples stay
+        in the same order as those of AMR.get_triples.
+
+        """
+        data = self.data
+        pos = 3 + data[0]
+        end = pos + 3 * data[1]
+        while pos < end:
+            # relations of one node are stored next to each other
+            run_end = pos
+            while run_end < end and data[run_end] == data[pos]:
+                run_end += 3
+            new_dict = {}
+            for p in range(pos, run_end, 3):
+                new_dict[prefix + str(data[p + 2])] = (data[p + 1], data[p + 2])
+            for p, (relation, node) in zip(range(pos, run_end, 3), new_dict.values()):
+                data[p + 1], data[p + 2] = relation, node
+            pos = run_end
+        self.names = None
+        self.prefix = prefix
+
+    @property
+    def nodes(self):
+        return [self.node_name(i) for i in range(self.data[0])]
+
+    @property
+    def node_values(self):
+        return [LABELS[concept] for concept in self.data[3:3 + self.data[0]]]
+
+    @property
+    def relations(self):
+        return self.to_amr().relations
+
+    @property
+    def attributes(self):
+        return self.to_amr().attributes
+
+    def instance_triples(self):
+        return TripleView(self, "instance")
+
+    def attribute_triples(self):
+        return TripleView(self, "attribute")
+
+    def relation_triples(self):
+        return TripleView(self, "relation")
+
+    def get_triples(self):
+        """
+        Get the instance, attribute and relation triples (see AMR.get_triples), as views that do not copy
+
+        """
+        return self.instance_triples(), self.attribute_triples(), self.relation_triples()
+
+    def node_triples(self):
+        """
+        Generator that yields, for each node in order, the node index, its relation triples and its attribute triples
+
+        """
+        data = self.data
+        relation_pos = 3 + data[0]
+        relation_end = attribute_pos = relation_pos + 3 * data[1]
+        attribute_end = attribute_pos + 3 * data[2]
+        for i in range(data[0]):
+            relation_triple = []
+            attribute_triple = []
+            # relations and attributes are stored per node, in node order
+            while relation_pos < relation_end and data[relation_pos] == i:
+                relation_triple.append((LABELS[data[relation_pos + 1]], self.node_name(i),
+                                        self.node_name(data[relation_pos + 2])))
+                relation_pos += 3
+            while attribute_pos < attribute_end and data[attribute_pos] == i:
+                attribute_triple.append((LABELS[data[attribute_pos + 1]], self.node_name(i),
+                                         LABELS[data[attribute_pos + 2]]))
+                attribute_pos += 3
+            yield i, relation_triple, attribute_triple
+
+    def get_triples2(self):
+        """
+        Get the instance and relation triples (see AMR.get_triples2). The relation triples are a new list, as
+        relations and attributes are mixed per node.
+
+        """
+        relation_triple = []
+        for _, relations, attributes in self.node_triples():
+            relation_triple.extend(relations)
+            relation_triple.extend(attributes)
+        return self.instance_triples(), relation_triple
+
+    def __getstate__(self):
+        # label ids are only valid in this process, pickle the labels themselves
+        return self.names, self.prefix, self.data, self.root, [LABELS[self.data[pos]] for pos in self.label_positions()]
+
+    def __setstate__(self, state):
+        self.names, self.prefix, self.data, self.root, labels = state
+        for pos, label in zip(self.label_positions(), labels):
+            self.data[pos] = label_id(label)
+
+    def __str__(self):
+        """
+        Generate AMR string for better readability (same as AMR.__str__)
+
+        """
+        lines = []
+        node_values = self.node_values
+        for i, relations, attributes in self.node_triples():
+            lines.append("Node " + str(i) + " " + self.node_name(i))
+            lines.append("Value: " + node_values[i])
+            lines.append("Relations:")
+            for v, _, k in relations:
+                lines.append("Node " + k + " via " + v)
+            for k2, _, v2 in attributes:
+                lines.append("Attribute: " + k2 + " value " + v2)
+        return "\n".join(lines)
+
+    def __repr__(self):
+        return self.__str__()
+
+    def output_amr(self):
+        print >> DEBUG_LOG, self.__str__()
+
+
+def normalize_relation(relation, source, target):
+    """
+    Write an inverted relation the other way around, e.g. (ARG0-of, a, b) becomes (ARG0, b, a).
+    parse_AMR_line already does this for most relations, but not for a relation to an existing node that is
+    followed by another relation (e.g. ":part-of s :mod ..."), so the same graph can have either form.
+
+    """
+    if relation.endswith("-of"):
+        return relation[:-3], target, source
+    return relation, source, target
+
+
+def read_well_formed(line, keep_tree=False):
+    """
+    Build the AMR of a (stripped) AMR line that only consists of the units
+        [:relation] (node / concept        :relation value        :relation "quoted value"[suffix]
+    each followed by their closing brackets, separated by spaces. The units are read at once with the compiled
+    regular expression AMR_UNIT and the node, relation and attribute lists of the AMR are filled in the same pass,
+    so only a few Python operations are needed per unit. The result is the same as read_tokens and
+    AMR.from_parsed would give.
+    If keep_tree is True, the tree of the AMR is built as well (see AMR).
+    Returns:
+        the AMR, None if the line contains anything else or is not a complete, valid AMR (read_tokens handles those
+        lines and reports the error)
+
+    """
+    # \s only matches the whitespace of str.split for byte strings, unicode lines are left to read_tokens
+    if not isinstance(line, str):
+        return None
+    node_index = {}
+    node_list = []
+    node_value_list = []
+    relation_list = []
+    attribute_list = []
+    tree = [] if keep_tree else None
+    # (node index, relation, value) of the attributes, a value may be a node that is only defined later
+    attr_items = []
+    stack = []
+    index = 0
+    # bound methods, called for every unit
+    new_node = node_list.append
+    new_value = node_value_list.append
+    new_relations = relation_list.append
+    new_attributes = attribute_list.append
+    push = stack.append
+    add_item = attr_items.append
+    # 3 after a node, 2 after a relation to a value, 0 at the start or after ")"
+    state = 0
+    for relation_name, node_name, node_value, attr_name, attr_value, close in AMR_UNIT.findall(line):
+        if node_name:
+            if node_name in node_index:
+                return None
+            if relation_name:
+                if not stack:
+                    return None
+                # stack[-1] is the upper level node, the node is not on the stack yet
+                if not relation_name.endswith("-of"):
+                    relation_list[stack[-1]][node_name] = relation_name
+                    new_relations({})
+                else:
+                    new_relations({node_list[stack[-1]]: relation_name[:-3]})
+                if tree is not None:
+                    tree[stack[-1]].append((relation_name, CHILD, index))
+            # a node without relation is only read as in read_tokens at the start or after ")"
+            elif state != 0:
+                return None
+            else:
+                new_relations({})
+            push(index)
+            node_index[node_name] = index
+            new_node(node_name)
+            new_value(node_value)
+            new_attributes({})
+            if tree is not None:
+                tree.append([])
+            index += 1
+            state = 3
+        elif attr_name:
+            if not stack:
+                return None
+            top = stack[-1]
+            if tree is not None:
+                if attr_value in node_index:
+                    tree[top].append((attr_name, REFERENCE, node_index[attr_value]))
+                else:
+                    tree[top].append((attr_name, CONSTANT, attr_value))
+            # quotes are dropped and the closing quote becomes "_", only the part up to a space is kept
+            if attr_value[0] == "\"":
+                quote_end = attr_value.rindex("\"")
+                attr_value = (attr_value[1:quote_end] + "_" + attr_value[quote_end + 1:]).split()[0]
+            # the reverse of a "-of" relation is only stored when ")" follows
+            if close and attr_name.endswith("-of"):
+                if attr_value not in node_index:
+                    # stored before the relations of a node that is defined later, left to read_tokens
+                    return None
+                relation_list[node_index[attr_value]][node_list[top]] = attr_name[:-3]
+            elif attr_value in node_index:
+                relation_list[top][attr_value] = attr_name
+            else:
+                attribute_list[top][attr_name] = attr_value
+                add_item((top, attr_name, attr_value))
+            state = 2
+        elif not close:
+            return None
+        if close:
+            if len(close) > len(stack):
+                return None
+            del stack[-len(close):]
+            state = 0
+    if state != 0 or not node_list:
+        return None
+    forward = node_index.viewkeys() & [attr_value for node, attr_name, attr_value in attr_items]
+    if forward:
+        # values that are nodes defined later are relations, added after the other relations of the node
+        nodes_forward = set([node for node, attr_name, attr_value in attr_items if attr_value in forward])
+        for node in nodes_forward:
+            attribute_list[node] = {}
+        for node, attr_name, attr_value in attr_items:
+            if node in nodes_forward:
+                if attr_value in forward:
+                    relation_list[node][attr_value] = attr_name
+                else:
+                    attribute_list[node][attr_name] = attr_value
+        if tree is not None:
+            for edges in tree:
+                for i, (relation_name, kind, value) in enumerate(edges):
+                    if kind == CONSTANT and value in forward:
+                        edges[i] = (relation_name, REFERENCE, node_index[value])
+    # add TOP as an attribute. The attribute value is the top node value
+    attribute_list[0]["TOP"] = node_value_list[0]
+    result_amr = AMR()
+    result_amr.nodes = node_list
+    result_amr.root = node_list[0]
+    result_amr.node_values = node_value_list
+    result_amr.relations = relation_list
+    result_amr.attributes = attribute_list
+    result_amr.tree = tree
+    return result_amr
+
+
+def raw_value(raw_charseq, value):
+    """
+    Value of a relation as written, from the characters after ":" (only needed for the tree). Values with quotes
+    keep their quotes and spaces, other values are the same as value.
+
+    """
+    parts = "".join(raw_charseq).split(None, 1)
+    if len(parts) > 1 and "\"" in parts[1]:
+        return parts[1].strip()
+    return value
+
+
+def join_tokens(tokens):
+    """
+    Join the tokens of an AMR (see AMR.get_tokens) with spaces, except after "(" and before ")"
+
+    """
+    parts = []
+    previous = "("
+    for token in tokens:
+        if token != ")" and previous != "(":
+            parts.append(" ")
+        parts.append(token)
+        previous = token
+    return "".join(parts)
+
+
+def token_position(tokens, index):
+    """
+    Position of the significant symbol of tokens[index] in the line (only needed for error messages)
+
+    """
+    return sum([len(c) + len(quoted) + len(text) for c, quoted, text in tokens[:index]])
+
+
+def read_tokens(line, tree=None):
+    """
+    Read the nodes and relations of an AMR line, which is split into tokens once with a compiled regular
+    expression (AMR_TOKEN). Each token is a significant symbol or a quoted string, together with the characters
+    up to the next one, processed in a shift-reduce style.
+    If tree is a dict of lists, the edges of each node are added to it in the order of the line, as
+    (relation name as written, CHILD, node name) or (relation name, CONSTANT, value as written, with quotes).
+    Returns:
+        node_dict, node_name_list, node_relation_dict1, node_relation_dict2 (see below)
+    Raises:
+        AMRParseError if the line is not a valid AMR
+
+    """
+    # Current state. It denotes the last significant symbol encountered. 1 for (, 2 for :, 3 for /,
+    # and 0 for start state or ')'
+    # Last significant symbol is ( --- start processing node name
+    # Last significant symbol is : --- start processing relation name
+    # Last significant symbol is / --- start processing node value (concept name)
+    # Last significant symbol is ) --- current node processing is complete
+    # Note that if these symbols are inside quotes, they are not significant symbols (they are part of
+    # the quoted token).
+    state = 0
+    # node stack for parsing
+    stack = []
+    # current not-yet-reduced sequence of tokens
+    cur_charseq = []
+    # key: node name value: node value
+    node_dict = {}
+    # node name list (order: occurrence of the node)
+    node_name_list = []
+    # key: node name:  value: list of (relation name, the other node name)
+    node_relation_dict1 = defaultdict(list)
+    # key: node name, value: list of (attribute name, const value) or (relation name, unseen node name)
+    node_relation_dict2 = defaultdict(list)
+    # current relation name
+    cur_relation_name = ""
+    # characters after ":" as written (with quotes), only kept for the tree
+    raw_charseq = []
+    tokens = AMR_TOKEN.findall(line.strip())
+    # error positions are reported as offsets in the original line
+    lead = len(line) - len(line.lstrip())
+    for index, (c, quoted, text) in enumerate(tokens):
+        if c == "(":
+            # get the attribute name
+            # e.g :arg0 (x ...
+            # at this point we get "arg0"
+            if state == 2:
+                # in this state, current relation name should be empty
+                if cur_relation_name != "":
+                    raise AMRParseError("relation_before_node", lead + token_position(tokens, index),
+                                        "Format error when processing ", line[0:token_position(tokens, index) + 1])
+                # update current relation name for future use
+                cur_relation_name = "".join(cur_charseq).strip()
+                cur_charseq = []
+                raw_charseq = []
+            state = 1
+        elif c == ":":
+            # Last significant symbol is "/". Now we encounter ":"
+            # Example:
+            # :OR (o2 / *OR*
+            #    :mod (o3 / official)
+            #  gets node value "*OR*" at this point
+            if state == 3:
+                # update node name/value map of the node on top of the stack ("o2" in the above example)
+                node_dict[stack[-1]] = "".join(cur_charseq)
+                cur_charseq = []
+            # Last significant symbol is ":". Now we encounter ":"
+            # Example:
+            # :op1 w :quant 30
+            # or :day 14 :month 3
+            # the problem is that we cannot decide if node value is attribute value (constant)
+            # or node value (variable) at this moment
+            elif state == 2:
+                parts = "".join(cur_charseq).split()
+                cur_charseq = []
+                if len(parts) < 2:
+                    raise AMRParseError("missing_value", lead + token_position(tokens, index),
+                                        "Error in processing; part len < 2", line[0:token_position(tokens, index) + 1])
+                # For the above example, node name is "op1", and node value is "w"
+                # Note that this node name might not be encountered before
+                relation_name, relation_value = parts[0], parts[1]
+                # We need to link upper level node to the current
+                # top of stack is upper level node
+                if len(stack) == 0:
+                    raise AMRParseError("no_parent_node", lead + token_position(tokens, index), "Error in processing",
+                                        line[:token_position(tokens, index)], relation_name, relation_value)
+                # if we have not seen this node name before
+                if relation_value not in node_dict:
+                    node_relation_dict2[stack[-1]].append((relation_name, relation_value))
+                else:
+                    node_relation_dict1[stack[-1]].append((relation_name, relation_value))
+                if tree is not None:
+                    tree[stack[-1]].append((relation_name, CONSTANT, raw_value(raw_charseq, relation_value)))
+            raw_charseq = []
+            state = 2
+        elif c == "/":
+            # Last significant symbol is "(". Now we encounter "/"
+            # Example:
+            # (d / default-01
+            # get "d" here
+            if state == 1:
+                node_name = "".join(cur_charseq)
+                cur_charseq = []
+                # if this node name is already in node_dict, it is duplicate
+                if node_name in node_dict:
+                    raise AMRParseError("duplicate_node", lead + token_position(tokens, index),
+                                        "Duplicate node name ", node_name, " in parsing AMR")
+                # push the node name to stack
+                stack.append(node_name)
+                # add it to node name list
+                node_name_list.append(node_name)
+                # if this node is part of the relation
+                # Example:
+                # :arg1 (n / nation)
+                # cur_relation_name is arg1
+                # node name is n
+                # we have a relation arg1(upper level node, n)
+                if cur_relation_name != "":
+                    if tree is not None:
+                        tree[stack[-2]].append((cur_relation_name, CHILD, node_name))
+                    # if relation name ends with "-of", e.g."arg0-of",
+                    # it is reverse of some relation. For example, if a is "arg0-of" b,
+                    # we can also say b is "arg0" a.
+                    # If the relation name ends with "-of", we store the reverse relation.
+                    if not cur_relation_name.endswith("-of"):
+                        # stack[-2] is upper_level node we encountered, as we just add node_name to stack
+                        node_relation_dict1[stack[-2]].append((cur_relation_name, node_name))
+                    else:
+                        # cur_relation_name[:-3] is to delete "-of"
+                        node_relation_dict1[node_name].append((cur_relation_name[:-3], stack[-2]))
+                    # clear current_relation_name
+                    cur_relation_name = ""
+            else:
+                # error if in other state
+                raise AMRParseError("unexpected_slash", lead + token_position(tokens, index),
+                                    "Error in parsing AMR", line[0:token_position(tokens, index) + 1])
+            state = 3
+        elif c == ")":
+            # stack should be non-empty to find upper level node
+            if len(stack) == 0:
+                raise AMRParseError("unmatched_parenthesis", lead + token_position(tokens, index),
+                                    "Unmatched parenthesis at position", token_position(tokens, index), "in processing",
+                                    line[0:token_position(tokens, index) + 1])
+            # Last significant symbol is ":". Now we encounter ")"
+            # Example:
+            # :op2 "Brown") or :op2 w)
+            # get \"Brown\" or w here
+            if state == 2:
+                temp_attr_value = "".join(cur_charseq)
+                cur_charseq = []
+                parts = temp_attr_value.split()
+                if len(parts) < 2:
+                    raise AMRParseError("missing_value", lead + token_position(tokens, index), "Error processing",
+                                        line[:token_position(tokens, index) + 1], temp_attr_value)
+                relation_name, relation_value = parts[0], parts[1]
+                # store reverse of the relation
+                # we are sure relation_value is a node here, as "-of" relation is only between two nodes
+                if relation_name.endswith("-of"):
+                    node_relation_dict1[relation_value].append((relation_name[:-3], stack[-1]))
+                # attribute value not seen before
+                # Note that it might be a constant attribute value, or an unseen node
+                # process this after we have seen all the node names
+                elif relation_value not in node_dict:
+                    node_relation_dict2[stack[-1]].append((relation_name, relation_value))
+                else:
+                    node_relation_dict1[stack[-1]].append((relation_name, relation_value))
+                if tree is not None:
+                    tree[stack[-1]].append((relation_name, CONSTANT, raw_value(raw_charseq, relation_value)))
+                raw_charseq = []
+            # Last significant symbol is "/". Now we encounter ")"
+            # Example:
+            # :arg1 (n / nation)
+            # we get "nation" here
+            elif state == 3:
+                # map node name to its value
+                node_dict[stack[-1]] = "".join(cur_charseq)
+                cur_charseq = []
+            # pop from stack, as the current node has been processed
+            stack.pop()
+            cur_relation_name = ""
+            state = 0
+        if tree is not None and state == 2:
+            raw_charseq.append(quoted + text)
+        if quoted:
+            # the quotes of a quoted string are dropped, a closing quote is replaced by the placeholder "_"
+            if len(quoted) > 1 and quoted[-1] == "\"":
+                text = quoted[1:-1] + "_" + text
+            else:
+                text = quoted[1:] + text
+        # not significant symbols, so we just shift.
+        if text:
+            # allow space in relation name
+            if state != 2:
+                text = text.replace(" ", "")
+            cur_charseq.append(text)
+    return node_dict, node_name_list, node_relation_dict1, node_relation_dict2
+
+
+# tokens of a (possibly malformed) AMR line for read_recovering: quoted string (without closing quote it ends at
+# a space or bracket), bracket, slash, relation (":" and its name) or any other run of characters
+RECOVER_TOKEN = re.compile(r'("[^"]*"|"[^"\s()]*)|([()/])|(:[^\s"():/]*)|([^\s"():/]+)')
+
+# concept of a node that has none in the line, and relation of a node that has no relation to its parent
+MISSING_CONCEPT = "thing"
+MISSING_RELATION = "mod"
+
+
+def read_recovering(line):
+    """
+    Read the nodes and relations of an AMR line like read_tokens, but repair or skip the parts that are not valid
+    instead of stopping at the first error, so the rest of the graph is still read:
+        unmatched_parenthesis: a ")" without open node is skipped. If the root was closed too early, the root is
+                               opened again for what follows
+        unclosed_parenthesis: nodes that are still open at the end of the line are closed
+        duplicate_node: a node name that is already used gets a new name
+        missing_variable: a node without name (e.g. "(boy)") gets a new name
+        missing_concept: a node without concept gets MISSING_CONCEPT
+        missing_relation: a node without relation to its parent gets MISSING_RELATION
+        missing_value, no_parent_node: a relation without value or without node is skipped
+        unclosed_quote: a quoted value without closing quote ends at the next space or bracket
+        unexpected_slash, unexpected_token: tokens that can not be placed are skipped
+    Quoted values and values that are node names are read as in read_tokens.
+    Returns:
+        (node_dict, node_name_list, node_relation_dict1, node_relation_dict2) as read_tokens, the tree (see
+        read_tokens) and the list of AMRParseError, in order of position
+
+    """
+    tokens = [(m.start(), m.group()) for m in RECOVER_TOKEN.finditer(line)]
+    # names used anywhere in the line are not used for new nodes, they may be references
+    used_names = set([text for _, text in tokens])
+    node_dict = {}
+    node_name_list = []
+    node_relation_dict1 = defaultdict(list)
+    node_relation_dict2 = defaultdict(list)
+    tree = defaultdict(list)
+    errors = []
+    # (parent, relation, value) of relations to a name or constant, resolved when all node names are known
+    values = []
+    stack = []
+    root_closed = None
+    relation = None
+    index = 0
+
+    def new_name(concept):
+        prefix = concept[:1].lower() if concept[:1].isalpha() else "x"
+        count = 1
+        name = prefix
+        while name in used_names:
+            count += 1
+            name = prefix + str(count)
+        used_names.add(name)
+        return name
+
+    def peek(offset=0):
+        if index + offset < len(tokens):
+            return tokens[index + offset][1]
+        return ""
+
+    while index < len(tokens):
+        position, token = tokens[index]
+        index += 1
+        if (token == "(" or token[0] == ":") and not stack and node_name_list:
+            # the root was closed too early, e.g. (a / and :op1 (b / boy))) :op2 (g / girl))
+            errors.append(AMRParseError("unmatched_parenthesis", root_closed,
+                                        "Root node closed at position", root_closed, "before the end of the AMR"))
+            stack.append(node_name_list[0])
+        if token == "(":
+            name, concept = None, None
+            if peek() not in ("", "(", ")", "/") and peek()[0] not in ":\"" and peek(1) == "/":
+                name = peek()
+                index += 1
+            if peek() == "/":
+                index += 1
+                if peek() not in ("", "(", ")", "/") and peek()[0] not in ":\"":
+                    concept = peek()
+                    index += 1
+            elif name is None and peek() not in ("", "(", ")", "/") and peek()[0] not in ":\"":
+                # a concept without name, as in the variable-free format
+                concept = peek()
+                index += 1
+                errors.append(AMRParseError("missing_variable", position, "Node without name:", concept))
+            if concept is None:
+                errors.append(AMRParseError("missing_concept", position, "Node without concept:", name))
+                concept = MISSING_CONCEPT
+            if name is None:
+                name = new_name(concept)
+            elif name in node_dict:
+                old_name, name = name, new_name(concept)
+                errors.append(AMRParseError("duplicate_node", position, "Duplicate node name", old_name,
+                                            "renamed to", name))
+            if stack:
+                if relation is None:
+                    errors.append(AMRParseError("missing_relation", position, "Node without relation:", name))
+                    relation = MISSING_RELATION
+                tree[stack[-1]].append((relation, CHILD, name))
+                if not relation.endswith("-of"):
+                    node_relation_dict1[stack[-1]].append((relation, name))
+                else:
+                    node_relation_dict1[name].append((relation[:-3], stack[-1]))
+            node_dict[name] = concept
+            node_name_list.append(name)
+            stack.append(name)
+            relation = None
+        elif token == ")":
+            if not stack:
+                errors.append(AMRParseError("unmatched_parenthesis", position, "Unmatched parenthesis at position",
+                                            position))
+                continue
+            stack.pop()
+            if not stack:
+                root_closed = position
+        elif token[0] == ":":
+            if token == ":":
+                # a space between ":" and the relation name is allowed, as in read_tokens
+                if peek() not in ("", "(", ")", "/") and peek()[0] not in ":\"" and peek(1) != "/":
+                    token += peek()
+                    index += 1
+                else:
+                    errors.append(AMRParseError("missing_relation", position, "Relation without name"))
+                    token += MISSING_RELATION
+            if not stack:
+                errors.append(AMRParseError("no_parent_node", position, "Relation without node:", token))
+                continue
+            if peek() == "(":
+                relation = token[1:]
+            elif peek() and peek() not in (")", "/") and peek()[0] != ":":
+                value = raw = peek()
+                index += 1
+                if value[0] == "\"":
+                    end = tokens[index - 1][0] + len(value)
+                    if len(value) == 1 or value[-1] != "\"":
+                        errors.append(AMRParseError("unclosed_quote", tokens[index - 1][0], "Quote not closed:", value))
+                        value += "\""
+                        raw = value
+                    quote_end = len(value) - 1
+                    # a suffix directly after the quotes (e.g. an alignment) belongs to the value
+                    suffix = ""
+                    if index < len(tokens) and tokens[index][0] == end and \
+                            tokens[index][1] not in ("(", ")", "/") and tokens[index][1][0] not in ":\"":
+                        suffix = tokens[index][1]
+                        raw += suffix
+                        index += 1
+                    # the quotes are dropped and the closing quote becomes "_", as in read_tokens
+                    value = (value[1:quote_end] + "_" + suffix).split()
+                    value = value[0] if value else "_"
+                values.append((stack[-1], token[1:], value))
+                tree[stack[-1]].append((token[1:], CONSTANT, raw))
+            else:
+                errors.append(AMRParseError("missing_value", position, "Relation without value:", token))
+        elif token == "/":
+            errors.append(AMRParseError("unexpected_slash", position, "Unexpected slash at position", position))
+        else:
+            errors.append(AMRParseError("unexpected_token", position, "Unexpected token", token, "at position",
+                                        position))
+    if stack:
+        errors.append(AMRParseError("unclosed_parenthesis", len(line.rstrip()), len(stack), "unclosed parentheses"))
+    for parent, relation_name, value in values:
+        if value in node_dict:
+            if relation_name.endswith("-of"):
+                node_relation_dict1[value].append((relation_name[:-3], parent))
+            else:
+                node_relation_dict1[parent].append((relation_name, value))
+        else:
+            node_relation_dict2[parent].append((relation_name, value))
+    if not node_name_list:
+        errors.append(AMRParseError("empty", 0, "Error: no AMR in line"))
+    errors.sort(key=lambda error: error.position)
+    return (node_dict, node_name_list, node_relation_dict1, node_relation_dict2), tree, errors
+
+
+# tokens of a variable-free AMR: quoted constants, brackets, coreference indexes (*1*), path counters (|1|),
+# relations and other symbols (concepts and constants)
+VAR_FREE_TOKEN = re.compile(r'"[^"]*"?|[(){}]|\*\d+\*|\|\d+\||:[^\s(){}"]+|[^\s(){}"]+')
+COREF_INDEX = re.compile(r'^\*\d+\*$')
+
+
+def is_char_level(line):
+    """
+    Check whether a line is in the character-level format of char_level_AMR.py, e.g. ( l i k e + :ARG0 + ( ...
+
+    """
+    tokens = line.split()
+    if "+" not in tokens:
+        return False
+    return sum([1 for t in tokens if len(t) == 1]) * 2 > len(tokens)
+
+
+def var_free_to_penman(line):
+    """
+    Convert a variable-free AMR line to a one-line AMR with (synthesized) variables.
+    Coreference is restored for the indexing method ((*1* person ...) ... *1*) and the absolute paths method
+    ({ :ARG0 |1| }), duplicated nodes (the default method) are kept as separate nodes.
+    Output of a model is not always well-formed: missing brackets are added, parts after the closing bracket of
+    the root, relations without value and references that can not be resolved are ignored.
+
+    """
+    line = line.strip()
+    if is_char_level(line):
+        line = line.replace(" ", "").replace("+", " ")
+    tokens = VAR_FREE_TOKEN.findall(line)
+    # a node is a dictionary with its variable, concept and list of (relation, value) edges. A value is a node,
+    # a constant, a coreference index ("*1*") or an absolute path (tuple of (relation, count))
+    root = None
+    stack = []
+    index_dict = {}
+    relation = None
+    i = 0
+    while i < len(tokens):
+        tok = tokens[i]
+        if tok == "(":
+            node = {"var": "v" + str(i), "concept": None, "edges": []}
+            if stack:
+                if relation is not None:
+                    stack[-1]["edges"].append((relation, node))
+            elif root is None:
+                root = node
+            else:
+                # a second root, ignore the rest of the line
+                break
+            stack.append(node)
+            relation = None
+        elif tok == ")":
+            if not stack:
+                break
+            stack.pop()
+            relation = None
+            if not stack:
+                break
+        elif tok == "{":
+            # absolute path, e.g. { :ARG0 |1| :ARG1 |2| }
+            path = []
+            i += 1
+            while i < len(tokens) and tokens[i] != "}":
+                if tokens[i].startswith(":") and i + 1 < len(tokens) and tokens[i + 1].startswith("|"):
+                    path.append((tokens[i], int(tokens[i + 1][1:-1])))
+                    i += 1
+                i += 1
+            if stack and stack[-1]["concept"] is None and not stack[-1]["edges"] and len(stack) > 1:
+                # ( { path } ): the bracket node is the reference itself
+                node = stack.pop()
+                parent_edges = stack[-1]["edges"]
+                if parent_edges and parent_edges[-1][1] is node:
+                    parent_edges[-1] = (parent_edges[-1][0], tuple(path))
+                if i + 1 < len(tokens) and tokens[i + 1] == ")":
+                    i += 1
+            elif stack and relation is not None:
+                stack[-1]["edges"].append((relation, tuple(path)))
+            relation = None
+        elif not stack:
+            pass
+        elif tok.startswith(":"):
+            relation = tok
+        elif COREF_INDEX.match(tok) and relation is None and stack[-1]["concept"] is None:
+            # (*1* person ...): instantiation of an index
+            index_dict[tok] = stack[-1]
+        elif relation is None:
+            # concept of the current node, other symbols without relation are dropped
+            if stack[-1]["concept"] is None:
+                stack[-1]["concept"] = tok
+        else:
+            stack[-1]["edges"].append((relation, tok))
+            relation = None
+        i += 1
+    if root is None:
+        return None
+
+    def follow_path(path):
+        node = root
+        for rel, count in path:
+            children = [value for r, value in node["edges"] if r == rel and isinstance(value, dict)]
+            if count < 1 or count > len(children):
+                return None
+            node = children[count - 1]
+        return node
+
+    def to_string(node):
+        concept = node["concept"] if node["concept"] is not None else "dummy"
+        parts = ["(" + node["var"] + " / " + concept]
+        for rel, value in node["edges"]:
+            if isinstance(value, dict):
+                parts.append(rel + " " + to_string(value))
+                continue
+            if isinstance(value, tuple):
+                target = follow_path(value)
+            elif COREF_INDEX.match(value):
+                target = index_dict.get(value)
+            else:
+                parts.append(rel + " " + value)
+                continue
+            # references are written as the variable of the node they refer to
+            if target is not None:
+                parts.append(rel + " " + target["var"])
+        return " ".join(parts) + ")"
+
+    return to_string(root)
+
+
 # test AMR parsing
 # a unittest can also be used.
 if __name__ == "__main__":
@@ -3,10 +3,21 @@
 
 '''General utils and AMR specific utils'''
 
-from collections import defaultdict
 import json
 import os
+import io
+import re
+import random
 import codecs
+import gzip
+import bz2
+import hashlib
+import shelve
+import sqlite3
+from collections import OrderedDict, deque, namedtuple
+from itertools import chain, islice, izip
+from multiprocessing import Pool, current_process
+from amr import AMR, AMRParseError, CompactAMR
 
 
 def get_default_amr():
@@ -14,8 +25,66 @@ def get_default_amr():
     return default
 
 
+# magic bytes and extensions of the compressed file formats open_file can read and write
+COMPRESSION = [('gzip', '\x1f\x8b', ['.gz']),
+               ('bz2', 'BZh', ['.bz2']),
+               ('xz', '\xfd7zXZ\x00', ['.xz', '.lzma'])]
+
+
+def compression_type(file_name, mode='r'):
+    '''Compression of a file ('gzip', 'bz2' or 'xz'), None if it is not compressed. Files that are read are
+       recognized by their magic bytes, new files by their extension'''
+
+    if 'r' in mode and os.path.isfile(file_name):
+        with open(file_name, 'rb') as in_f:
+            start = in_f.read(6)
+        for kind, magic, _ in COMPRESSION:
+            if start.startswith(magic):
+                return kind
+        return None
+    for kind, _, extensions in COMPRESSION:
+        if os.path.splitext(file_name)[1].lower() in extensions:
+            return kind
+    return None
+
+
+def import_lzma():
+    try:
+        import lzma
+    except ImportError:
+        try:
+            from backports import lzma
+        except ImportError:
+            raise IOError('Reading and writing xz files needs Python 3 or the backports.lzma package')
+    return lzma
+
+
+def open_file(file_name, mode='r', encoding=None, compression='auto'):
+    '''Open a file that can be compressed with gzip, bz2 or xz (see compression_type), the (de)compression is
+       streamed. With encoding, the file object reads and writes unicode, as with codecs.open.
+       compression can also be given explicitly (None for a plain file), e.g. for a temporary file'''
+
+    if compression == 'auto':
+        compression = compression_type(file_name, mode)
+    raw_mode = mode.replace('b', '').replace('t', '') + 'b'
+    if compression is None:
+        file_obj = open(file_name, mode if encoding is None else raw_mode)
+    elif compression == 'gzip':
+        file_obj = gzip.GzipFile(file_name, raw_mode)
+        #GzipFile reads lines in Python, the buffered reader does it in C
+        if 'r' in mode:
+            file_obj = io.BufferedReader(file_obj)
+    elif compression == 'bz2':
+        file_obj = bz2.BZ2File(file_name, raw_mode)
+    else:
+        file_obj = import_lzma().LZMAFile(file_name, raw_mode)
+    if encoding is not None:
+        file_obj = codecs.getreader(encoding)(file_obj) if 'r' in mode else codecs.getwriter(encoding)(file_obj)
+    return file_obj
+
+
 def write_to_file(lst, file_new, split=True):
-    with codecs.open(file_new, 'w', 'utf-8') as out_f:
+    with open_file(file_new, 'w', 'utf-8') as out_f:
         if split:
             for line in lst:
                 out_f.write(line.strip() + '\n')
@@ -24,6 +93,124 @@ def write_to_file(lst, file_new, split=True):
     out_f.close()
 
 
+def file_sha256(file_name):
+    '''SHA-256 checksum of the bytes of a file'''
+
+    checksum = hashlib.sha256()
+    with open(file_name, 'rb') as in_f:
+        for block in iter(lambda: in_f.read(1 << 20), b''):
+            checksum.update(block)
+    return checksum.hexdigest()
+
+
+class ShardWriter(object):
+    '''Writes aligned output files, e.g. the .tf and .sent file of the same AMRs, one line per file for each example
+
+       With shard_size, the files are split in shards of shard_size examples that data loaders can read in parallel:
+       shard i of [file] is [file].[i, 5 digits]. With compression ('gzip', 'bz2' or 'xz'), the files get the
+       extension of the compression (see COMPRESSION). Lines are buffered and written in blocks of buffer_size.
+
+       Each shard is written to a temporary file ([shard].temp) that is only renamed when the shard is complete. With
+       manifest_file, a JSON file with the path, size and SHA-256 checksum of each shard and the number of examples
+       is written the same way when the writer is closed. So an interrupted run never leaves half-written files.
+       Used as a context manager, the temporary files are removed after an error.'''
+
+    def __init__(self, file_names, shard_size=0, compression=None, manifest_file=None, buffer_size=1000):
+        self.file_names = file_names
+        self.shard_size = shard_size
+        self.compression = compression
+        self.manifest_file = manifest_file
+        self.buffer_size = buffer_size
+        self.base_dir = os.path.dirname(os.path.abspath(manifest_file or file_names[0]))
+        self.shards = []  # manifest entries of the shards that are complete
+        self.out_files = None  # (shard name, temporary file) of each file of the current shard
+        self.buffers = [[] for _ in file_names]
+        self.num_lines = 0  # examples in the current shard
+        self.total = 0
+
+    def shard_name(self, file_name):
+        if self.shard_size:
+            file_name = '{0}.{1:05d}'.format(file_name, len(self.shards))
+        for kind, _, extensions in COMPRESSION:
+            if kind == self.compression and not file_name.endswith(extensions[0]):
+                file_name += extensions[0]
+        return file_name
+
+    def open_shard(self):
+        self.out_files = []
+        for file_name in self.file_names:
+            shard = self.shard_name(file_name)
+            self.out_files.append((shard, open_file(shard + '.temp', 'w', 'utf-8', compression_type(shard, 'w'))))
+
+    def write(self, *lines):
+        '''Write one example: a line (without newline) for each file'''
+
+        if self.out_files is None:
+            self.open_shard()
+        for buf, line in izip(self.buffers, lines):
+            buf.append(line + '\n')
+        self.num_lines += 1
+        if len(self.buffers[0]) >= self.buffer_size:
+            self.flush()
+        if self.num_lines == self.shard_size:
+            self.finish_shard()
+
+    def flush(self):
+        for (_, out_f), buf in izip(self.out_files, self.buffers):
+            out_f.write(u''.join(buf))
+            del buf[:]
+
+    def finish_shard(self):
+        self.flush()
+        files = []
+        for shard, out_f in self.out_files:
+            out_f.close()
+            files.append(OrderedDict([('path', os.path.relpath(os.path.abspath(shard), self.base_dir)),
+                                      ('bytes', os.path.getsize(shard + '.temp')),
+                                      ('sha256', file_sha256(shard + '.temp'))]))
+            os.rename(shard + '.temp', shard)
+        self.shards.append(OrderedDict([('examples', self.num_lines), ('files', files)]))
+        self.total += self.num_lines
+        self.out_files, self.num_lines = None, 0
+
+    def close(self):
+        '''Finish the last shard and write the manifest. Without shard_size, empty files are written if there
+           were no examples, as with write_to_file'''
+
+        if self.out_files is None and not self.shard_size and not self.shards:
+            self.open_shard()
+        if self.out_files is not None:
+            self.finish_shard()
+        if self.manifest_file:
+            manifest = OrderedDict([('files', [os.path.relpath(os.path.abspath(file_name), self.base_dir)
+                                               for file_name in self.file_names]),
+                                    ('shard_size', self.shard_size),
+                                    ('compression', self.compression),
+                                    ('examples', self.total),
+                                    ('shards', self.shards)])
+            with open(self.manifest_file + '.temp', 'w') as out_f:
+                json.dump(manifest, out_f, indent=2, separators=(',', ': '))
+            os.rename(self.manifest_file + '.temp', self.manifest_file)
+
+    def abort(self):
+        '''Remove the temporary files of the current shard, the shards that are complete are kept'''
+
+        if self.out_files is not None:
+            for shard, out_f in self.out_files:
+                out_f.close()
+                os.remove(shard + '.temp')
+            self.out_files = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
 def get_files_by_ext(direc, ext):
     '''Function that traverses a directory and returns all files that match a certain extension'''
 
@@ -51,7 +238,7 @@ def reverse_tokenize(new_line):
 def load_dict(d):
     '''Funcion that loads json dictionaries'''
 
-    with open(d, 'r') as in_f:				#load reference dict (based on training data) to settle disputes based on frequency
+    with open_file(d, 'r') as in_f:				#load reference dict (based on training data) to settle disputes based on frequency
         dic = json.load(in_f)
     in_f.close()
 
@@ -69,430 +256,523 @@ def add_to_dict(d, key, base):
     return d
 
 
+# start of a metadata key in an AMR comment line, e.g. " ::date" in "# ::id 1 ::date 2012-12-19"
+METADATA_KEY = re.compile(r'(?:^|\s)::(\S+)')
+
+
+def read_metadata(line):
+    '''Return the metadata of an AMR comment line as a dict, e.g. {'id': '1', 'date': '2012-12-19'}
+       Sentences (::snt and ::tok) take the rest of the line, as they can contain anything'''
+
+    line = line.lstrip('#').strip()
+    for key in ['snt', 'tok']:
+        if line.startswith('::' + key + ' '):
+            return {key: line[len(key) + 3:].strip()}
+    parts = METADATA_KEY.split(line)
+    return dict([(parts[idx], parts[idx + 1].strip()) for idx in range(1, len(parts) - 1, 2)])
+
+
+class AMRRecord(namedtuple('AMRRecord', ['id', 'metadata', 'comments', 'lines'])):
+    '''One AMR of a file in the format of the AMR releases
+       id: value of ::id (None if there is none)
+       metadata: dict with the metadata of the comment lines (e.g. snt, tok, snt-type, alignments)
+       comments: the comment lines, without newline
+       lines: the lines of the AMR itself, without newline (leading whitespace is kept)'''
+
+    __slots__ = ()
+
+    @property
+    def sentence(self):
+        '''The sentence of the AMR (::snt, or ::tok if there is no ::snt), None if there is none'''
+        return self.metadata.get('snt', self.metadata.get('tok'))
+
+    def one_line(self):
+        return " ".join([line.strip() for line in self.lines]).strip()
+
+
+def read_amr_records(in_f, snt_type=None):
+    '''Generator that lazily reads AMRs in the format of the AMR releases from a file object (or any other
+       iterable of lines) and yields an AMRRecord for each AMR. AMRs are separated by empty lines.
+       Lines that start with "#" are comments, the header lines of the AMR releases ("# AMR release...") are skipped.
+       Comments of a block without AMR are added to the next AMR.
+       If snt_type is given, AMRs with a different ::snt-type (e.g. "body" or "summary" in the proxy
+       report data) are skipped, AMRs without ::snt-type are kept'''
+
+    metadata, comments, lines = {}, [], []
+    for line in chain(in_f, ['']):
+        if not line.strip():
+            if lines:
+                if not snt_type or metadata.get('snt-type', snt_type) == snt_type:
+                    yield AMRRecord(metadata.get('id'), metadata, comments, lines)
+                metadata, comments, lines = {}, [], []
+        elif line.startswith('#'):
+            if not line.startswith('# AMR'):
+                comments.append(line.rstrip('\n'))
+                metadata.update(read_metadata(line))
+        else:
+            lines.append(line.rstrip('\n'))
+
+
+class AMRIndex(object):
+    '''Index of the AMRs of a file in the format of the AMR releases, kept in a sidecar file ([file].idx)
+
+       For each AMR the index has its ::id, the byte offset and length of its block (comments and AMR lines), its
+       document id (the ::id up to the first ".", AMRs without ::id belong to the document of the previous AMR)
+       and its ::snt-type. AMRs of an id or document can then be read by seeking to them, without reading the rest
+       of the file. The sidecar file is rebuilt automatically when the size or modification time of the file changed.'''
+
+    def __init__(self, amr_file, index_file=None):
+        self.amr_file = amr_file
+        self.index_file = index_file or amr_file + '.idx'
+        stat = os.stat(amr_file)
+        self.source = [stat.st_size, stat.st_mtime]
+        self.entries = None
+        if os.path.isfile(self.index_file):
+            with open(self.index_file, 'r') as in_f:
+                try:
+                    index = json.load(in_f)
+                except ValueError:
+                    index = {}
+            if index.get('source') == self.source:
+                self.entries = index['entries']
+        if self.entries is None:
+            self.entries = self.build()
+            self.save()
+        self.by_id = dict([(entry[0], idx) for idx, entry in enumerate(self.entries) if entry[0] is not None])
+
+    def build(self):
+        '''Scan the file once, return a list of [id, offset, length, document id, snt-type] for each AMR'''
+
+        entries = []
+        doc_id = None
+        offset, start, metadata, has_amr = 0, None, {}, False
+        with open_file(self.amr_file, 'rb') as in_f:
+            for line in chain(in_f, ['']):
+                if not line.strip():
+                    if has_amr:
+                        amr_id = metadata.get('id')
+                        if amr_id:
+                            doc_id = amr_id.split('.')[0]
+                        entries.append([amr_id, start, offset - start, doc_id, metadata.get('snt-type')])
+                        start, metadata, has_amr = None, {}, False
+                else:
+                    #comments of a block without AMR belong to the next AMR, as in read_amr_records
+                    if start is None:
+                        start = offset
+                    if line.startswith('#'):
+                        if not line.startswith('# AMR') and '::' in line:
+                            metadata.update(read_metadata(line.decode('utf-8')))
+                    else:
+                        has_amr = True
+                offset += len(line)
+        return entries
+
+    def save(self):
+        with open(self.index_file + '.temp', 'w') as out_f:
+            json.dump({'source': self.source, 'entries': self.entries}, out_f)
+        os.rename(self.index_file + '.temp', self.index_file)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def ids(self):
+        return [entry[0] for entry in self.entries]
+
+    def documents(self):
+        '''List of (document id, entries of its AMRs), in order of the first AMR of each document in the file'''
+
+        documents = OrderedDict()
+        for entry in self.entries:
+            documents.setdefault(entry[3], []).append(entry)
+        return list(documents.items())
+
+    def select(self, document=None, snt_type=None):
+        '''Entries of the AMRs of a document and/or snt-type, in file order.
+           As in read_amr_records, AMRs without ::snt-type are kept when filtering on snt-type'''
+
+        return [entry for entry in self.entries if (document is None or entry[3] == document)
+                and (snt_type is None or entry[4] in [None, snt_type])]
+
+    def sample(self, num, document=None, snt_type=None, seed=None):
+        '''Random sample of num entries (of a document and/or snt-type), in file order'''
+
+        entries = self.select(document, snt_type)
+        sampled = set(random.Random(seed).sample(range(len(entries)), min(num, len(entries))))
+        return [entry for idx, entry in enumerate(entries) if idx in sampled]
+
+    def read_blocks(self, entries):
+        '''Generator that yields the text (unicode) of the block of each entry, by seeking to it'''
+
+        with open_file(self.amr_file, 'rb') as in_f:
+            for entry in entries:
+                in_f.seek(entry[1])
+                yield in_f.read(entry[2]).decode('utf-8')
+
+    def records(self, entries):
+        '''Generator that yields the AMRRecord of each entry'''
+
+        for block in self.read_blocks(entries):
+            for record in read_amr_records(block.splitlines(True)):
+                yield record
+
+    def record(self, amr_id):
+        '''AMRRecord of the AMR with this ::id, KeyError if there is none'''
+
+        return next(self.records([self.entries[self.by_id[amr_id]]]))
+
+
+# everything except parentheses, see countparens
+NO_PARENS = re.compile(r'[^()]+')
+
+
 def countparens(text):
   ''' proper nested parens counting '''
+  # remove matching pairs until nothing is left, only with string operations (no Python loop per character)
+  parens = NO_PARENS.sub('', text)
+  while '()' in parens:
+    parens = parens.replace('()', '')
+  return not parens
+
+
+def paren_error_position(text):
+  '''Character offset of the first unmatched closing parenthesis, or the end of the text if a parenthesis is not closed'''
   currcount=0
-  for i in text:
+  for idx, i in enumerate(text):
     if i == "(":
       currcount+=1
     elif i == ")":
       currcount-=1
       if currcount < 0:
-        return False
-  return currcount == 0
+        return idx
+  return len(text)
+
+
+def parse_amr(line):
+    '''Parse an AMR line for validation: return a CompactAMR if the AMR is valid, else (error kind, character offset)'''
+
+    if not countparens(line):		## wrong parentheses, not valid
+        return 'parentheses', paren_error_position(line)
+    try:
+        return CompactAMR.from_amr(AMR.parse_AMR_line(line, raise_errors=True))
+    except AMRParseError, e:
+        return e.kind, e.position
+    except Exception:
+        return 'exception', -1
+
+
+def check_amr(line):
+    '''Validity of an AMR line, as it is kept in the parse cache: True if the AMR is valid, else (error kind,
+       character offset). The parsed graph itself is not kept'''
+
+    result = parse_amr(line)
+    return True if isinstance(result, CompactAMR) else result
+
+
+def parse_chunk(lines):
+    return [check_amr(line) for line in lines]
+
+
+class ParseCache(object):
+    '''Cache of AMR validation results, keyed by a hash of the (stripped) AMR line
+
+       Results are kept in memory, and also in a shelve file if one is opened. The file can be shared by the stages
+       of a pipeline (which run as separate scripts) and by later runs, so each unique AMR is only parsed once.
+       A result is True if the line is a valid AMR, else (error kind, character offset) (see check_amr): only what
+       validation needs is kept, not the parsed graphs.'''
+
+    def __init__(self, cache_file=None):
+        self.memory = {}
+        self.disk = None
+        self.hits, self.misses = 0, 0
+        self.hit_bytes, self.parsed_bytes = 0, 0
+        if cache_file:
+            self.open(cache_file)
+
+    def open(self, cache_file):
+        '''Also keep the results in a shelve file. Only one process should have the file open at a time'''
+
+        self.close()
+        self.disk = shelve.open(cache_file, protocol=2)
+
+    def close(self):
+        '''Write the results to the shelve file and close it, the results in memory are kept'''
+
+        if self.disk is not None:
+            self.disk.close()
+            self.disk = None
+
+    def key(self, line):
+        return hashlib.sha1(line.encode('utf-8') if isinstance(line, unicode) else line).hexdigest()
+
+    def lookup(self, key, line):
+        '''Return the cached result of the (stripped) line, None if it is not in the cache'''
+
+        result = self.memory.get(key)
+        if result is None and self.disk is not None and key in self.disk:
+            result = self.disk[key]
+            if isinstance(result, CompactAMR):  #cache files of earlier versions kept the parsed graphs
+                result = True
+            self.memory[key] = result
+        if result is not None:
+            self.hits += 1
+            self.hit_bytes += len(line)
+        return result
+
+    def store(self, key, line, result):
+        self.misses += 1
+        self.parsed_bytes += len(line)
+        self.memory[key] = result
+        if self.disk is not None:
+            self.disk[key] = result
+
+    def result(self, line):
+        '''Return True if the line is a valid AMR, else (error kind, character offset in the stripped line). The
+           line is only parsed if it is not in the cache'''
+
+        line = line.strip()
+        key = self.key(line)
+        result = self.lookup(key, line)
+        if result is None:
+            result = check_amr(line)
+            self.store(key, line, result)
+        return result
+
+    def error(self, line):
+        '''Return (error kind, character offset) if the line is not valid, None if it is valid'''
+
+        result = self.result(line)
+        return None if result is True else result
+
+    def valid(self, line):
+        return self.result(line) is True
+
+    def stats(self):
+        return 'Parse cache: {0} hits, {1} misses, {2} bytes parsed, {3} bytes not parsed again'.format(
+                self.hits, self.misses, self.parsed_bytes, self.hit_bytes)
+
+
+# parse cache of this process, used by valid_amr and the bulk validation functions
+PARSE_CACHE = ParseCache()
+
+
+class TokenCache(object):
+    '''Cache of tokenized sentences in an SQLite file, keyed by a hash of the tokenizer version and the sentence
+
+       The file can be shared by runs and scripts, so a sentence is only tokenized once per tokenizer version. It
+       keeps at most max_size sentences: when there are more, the least recently used sentences are removed.'''
+
+    def __init__(self, cache_file, version='', max_size=1000000):
+        self.version = version
+        self.max_size = max_size
+        self.conn = sqlite3.connect(cache_file)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS tokens (key TEXT PRIMARY KEY, tokens TEXT, used INTEGER)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS tokens_used ON tokens (used)')
+        self.size, last_used = self.conn.execute('SELECT COUNT(*), MAX(used) FROM tokens').fetchone()
+        self.clock = (last_used or 0) + 1  #increases after each lookup, sentences with the lowest value are evicted
+        self.hits, self.misses, self.evicted = 0, 0, 0
+
+    def key(self, sent):
+        text = self.version + '\n' + sent
+        return hashlib.sha1(text.encode('utf-8') if isinstance(text, unicode) else text).hexdigest()
+
+    def lookup(self, sents):
+        '''Return the tokenized sentence for each sentence of the list, None for sentences that are not in the cache'''
+
+        keys = [self.key(sent) for sent in sents]
+        found = {}
+        #SQLite allows at most 999 parameters per query
+        for start in range(0, len(keys), 500):
+            part = keys[start:start + 500]
+            query = 'SELECT key, tokens FROM tokens WHERE key IN ({0})'.format(', '.join(['?'] * len(part)))
+            found.update(self.conn.execute(query, part).fetchall())
+        self.conn.executemany('UPDATE tokens SET used = ? WHERE key = ?', [(self.clock, key) for key in found])
+        self.clock += 1
+        results = [found.get(key) for key in keys]
+        num_hits = len([result for result in results if result is not None])
+        self.hits += num_hits
+        self.misses += len(results) - num_hits
+        return results
+
+    def store(self, sents, tokenized_sents):
+        '''Add tokenized sentences to the cache and remove the least recently used sentences if it is too large'''
+
+        rows = [(self.key(sent), tokens, self.clock) for sent, tokens in izip(sents, tokenized_sents)]
+        #the size is kept up to date from the number of inserted and deleted rows, counting the rows is a table scan
+        inserted = self.conn.executemany('INSERT OR IGNORE INTO tokens VALUES (?, ?, ?)', rows).rowcount
+        if inserted < len(rows):
+            #sentences that were stored meanwhile (e.g. by an earlier batch) have the same tokens, only mark them used
+            self.conn.executemany('UPDATE tokens SET used = ? WHERE key = ?', [(used, key) for key, _, used in rows])
+        self.size += inserted
+        if self.size > self.max_size:
+            deleted = self.conn.execute('DELETE FROM tokens WHERE key IN (SELECT key FROM tokens ORDER BY used LIMIT ?)',
+                                        (self.size - self.max_size,)).rowcount
+            self.evicted += deleted
+            self.size -= deleted
+        self.conn.commit()
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.commit()
+            self.conn.close()
+            self.conn = None
+
+    def stats(self):
+        total = self.hits + self.misses
+        return 'Token cache: {0} hits, {1} misses ({2:.1f}% hits), {3} sentences in cache, {4} evicted'.format(
+                self.hits, self.misses, 100.0 * self.hits / total if total else 0.0, self.size, self.evicted)
 
 
 def valid_amr(amrtext):
-  import amr
-  
-  if not countparens(amrtext):		## wrong parentheses, return false
-      return False
-  
-  try:
-    theamr = amr.AMR.parse_AMR_line(amrtext)
-    if theamr is None:
-      return False
-      print "MAJOR WARNING: couldn't build amr out of "+amrtext+" using smatch code"
-    else:
-      return True
-
-  except (AttributeError,Exception),e:
-    print 'Error:',e
-    return False
-  
-  return True
-
-
-class AMR(object):
-    """
-    AMR is a rooted, labeled graph to represent semantics.
-    This class has the following members:
-    nodes: list of node in the graph. Its ith element is the name of the ith node. For example, a node name
-           could be "a1", "b", "g2", .etc
-    node_values: list of node labels (values) of the graph. Its ith element is the value associated with node i in
-                 nodes list. In AMR, such value is usually a semantic concept (e.g. "boy", "want-01")
-    root: root node name
-    relations: list of edges connecting two nodes in the graph. Each entry is a link between two nodes, i.e. a triple
-               <relation name, node1 name, node 2 name>. In AMR, such link denotes the relation between two semantic
-               concepts. For example, "arg0" means that one of the concepts is the 0th argument of the other.
-    attributes: list of edges connecting a node to an attribute name and its value. For example, if the polarity of
-               some node is negative, there should be an edge connecting this node and "-". A triple < attribute name,
-               node name, attribute value> is used to represent such attribute. It can also be viewed as a relation.
-
-    """
-
-    from collections import defaultdict
-    import sys
-
-    # change this if needed
-    ERROR_LOG = sys.stderr
-
-    # change this if needed
-    DEBUG_LOG = sys.stderr
-
-    def __init__(self, node_list=None, node_value_list=None, relation_list=None, attribute_list=None):
-        """
-        node_list: names of nodes in AMR graph, e.g. "a11", "n"
-        node_value_list: values of nodes in AMR graph, e.g. "group" for a node named "g"
-        relation_list: list of relations between two nodes
-        attribute_list: list of attributes (links between one node and one constant value)
-
-        """
-        # initialize AMR graph nodes using list of nodes name
-        # root, by default, is the first in var_list
-
-        if node_list is None:
-            self.nodes = []
-            self.root = None
-        else:
-            self.nodes = node_list[:]
-            if len(node_list) != 0:
-                self.root = node_list[0]
-            else:
-                self.root = None
-        if node_value_list is None:
-            self.node_values = []
-        else:
-            self.node_values = node_value_list[:]
-        if relation_list is None:
-            self.relations = []
-        else:
-            self.relations = relation_list[:]
-        if attribute_list is None:
-            self.attributes = []
+    '''An AMR is valid if the parentheses match and the smatch code can build an AMR out of it.
+       Results are cached in PARSE_CACHE, so the same AMR is never parsed twice'''
+
+    return PARSE_CACHE.valid(amrtext)
+
+
+class ValidationResult(object):
+    '''Validity of a sequence of AMR lines: a bitmap with one bit per line (set if the line is valid) and
+       the (error kind, character offset) of each invalid line, by line index. If the lines were rewritten with
+       recovery (see validate_file), repaired has the indexes of the invalid lines that were repaired'''
+
+    def __init__(self):
+        self.bitmap = bytearray()
+        self.errors = {}
+        self.repaired = set()
+        self.size = 0
+
+    def add(self, error):
+        if self.size % 8 == 0:
+            self.bitmap.append(0)
+        if error is None:
+            self.bitmap[-1] |= 1 << (self.size % 8)
         else:
-            self.attributes = attribute_list[:]
-
-    def rename_node(self, prefix):
-        """
-        Rename AMR graph nodes to prefix + node_index to avoid nodes with the same name in two different AMRs.
-
-        """
-        node_map_dict = {}
-        # map each node to its new name (e.g. "a1")
-        for i in range(0, len(self.nodes)):
-            node_map_dict[self.nodes[i]] = prefix + str(i)
-        # update node name
-        for i, v in enumerate(self.nodes):
-            self.nodes[i] = node_map_dict[v]
-        # update node name in relations
-        for i, d in enumerate(self.relations):
-            new_dict = {}
-            for k, v in d.items():
-                new_dict[node_map_dict[k]] = v
-            self.relations[i] = new_dict
-  
-    def get_triples(self):
-        """
-        Get the triples in three lists.
-        instance_triple: a triple representing an instance. E.g. instance(w, want-01)
-        attribute triple: relation of attributes, e.g. polarity(w, - )
-        and relation triple, e.g. arg0 (w, b)
-
-        """
-        instance_triple = []
-        relation_triple = []
-        attribute_triple = []
-        for i in range(len(self.nodes)):
-            instance_triple.append(("instance", self.nodes[i], self.node_values[i]))
-            # k is the other node this node has relation with
-            # v is relation name
-            for k, v in self.relations[i].items():
-                relation_triple.append((v, self.nodes[i], k))
-            # k2 is the attribute name
-            # v2 is the attribute value
-            for k2, v2 in self.attributes[i].items():
-                attribute_triple.append((k2, self.nodes[i], v2))
-        return instance_triple, attribute_triple, relation_triple
-
-
-    def get_triples2(self):
-        """
-        Get the triples in two lists:
-        instance_triple: a triple representing an instance. E.g. instance(w, want-01)
-        relation_triple: a triple representing all relations. E.g arg0 (w, b) or E.g. polarity(w, - )
-        Note that we do not differentiate between attribute triple and relation triple. Both are considered as relation
-        triples.
-        All triples are represented by (triple_type, argument 1 of the triple, argument 2 of the triple)
-
-        """
-        instance_triple = []
-        relation_triple = []
-        for i in range(len(self.nodes)):
-            # an instance triple is instance(node name, node value).
-            # For example, instance(b, boy).
-            instance_triple.append(("instance", self.nodes[i], self.node_values[i]))
-            # k is the other node this node has relation with
-            # v is relation name
-            for k, v in self.relations[i].items():
-                relation_triple.append((v, self.nodes[i], k))
-            # k2 is the attribute name
-            # v2 is the attribute value
-            for k2, v2 in self.attributes[i].items():
-                relation_triple.append((k2, self.nodes[i], v2))
-        return instance_triple, relation_triple
-
-
-    def __str__(self):
-        """
-        Generate AMR string for better readability
-
-        """
-        lines = []
-        for i in range(len(self.nodes)):
-            lines.append("Node "+ str(i) + " " + self.nodes[i])
-            lines.append("Value: " + self.node_values[i])
-            lines.append("Relations:")
-            for k, v in self.relations[i].items():
-                lines.append("Node " + k + " via " + v)
-            for k2, v2 in self.attributes[i].items():
-                lines.append("Attribute: " + k2 + " value " + v2)
-        return "\n".join(lines)
-
-    def __repr__(self):
-        return self.__str__()
-
-    def output_amr(self):
-        """
-        Output AMR string
-
-        """
-        print >> DEBUG_LOG, self.__str__()
-
-
-    @staticmethod
-    def parse_AMR_line(line):
-        """
-        Parse a AMR from line representation to an AMR object.
-        This parsing algorithm scans the line once and process each character, in a shift-reduce style.
-
-        """
-        # Current state. It denotes the last significant symbol encountered. 1 for (, 2 for :, 3 for /,
-        # and 0 for start state or ')'
-        # Last significant symbol is ( --- start processing node name
-        # Last significant symbol is : --- start processing relation name
-        # Last significant symbol is / --- start processing node value (concept name)
-        # Last significant symbol is ) --- current node processing is complete
-        # Note that if these symbols are inside parenthesis, they are not significant symbols.
-        state = 0
-        # node stack for parsing
-        stack = []
-        # current not-yet-reduced character sequence
-        cur_charseq = []
-        # key: node name value: node value
-        node_dict = {}
-        # node name list (order: occurrence of the node)
-        node_name_list = []
-        # key: node name:  value: list of (relation name, the other node name)
-        node_relation_dict1 = defaultdict(list)
-        # key: node name, value: list of (attribute name, const value) or (relation name, unseen node name)
-        node_relation_dict2 = defaultdict(list)
-        # current relation name
-        cur_relation_name = ""
-        # having unmatched quote string
-        in_quote = False
-        for i, c in enumerate(line.strip()):
-            if c == " ":
-                # allow space in relation name
-                if state == 2:
-                    cur_charseq.append(c)
-                continue
-            if c == "\"":
-                # flip in_quote value when a quote symbol is encountered
-                # insert placeholder if in_quote from last symbol
-                if in_quote:
-                    cur_charseq.append('_')
-                in_quote = not in_quote
-            elif c == "(":
-                # not significant symbol if inside quote
-                if in_quote:
-                    cur_charseq.append(c)
+            self.errors[self.size] = error
+        self.size += 1
+
+    def valid(self, index):
+        return bool(self.bitmap[index // 8] >> (index % 8) & 1)
+
+    def __len__(self):
+        return self.size
+
+
+def iter_validation(lines, processes=1, chunk_size=1000, cache=PARSE_CACHE):
+    '''Generator that yields (stripped line, error) for each AMR line, in order. The error is None for a valid AMR,
+       else (error kind, character offset in the stripped line). Results are looked up in the cache first, the other
+       lines are parsed in chunks, each unique line once (a copy of a line that is still being parsed waits for
+       that result). Chunks are parsed by a pool of processes once a second chunk has lines to parse, so small
+       inputs are parsed in this process (as always if processes is 1, or if this process is a pool worker itself,
+       which can not start processes)'''
+
+    pool = None
+    in_flight = deque()		#chunks that are parsed, in order
+    pending = set()			#keys of the lines that are parsed, but not yet in the cache
+    copy = object()			#result of a line that is pending in the same or an earlier chunk
+    parsed_chunks = 0			#chunks with lines to parse
+
+    def finish(chunk, keys, results, parsed):
+        parsed = iter(parsed if isinstance(parsed, list) else parsed.get())
+        for line, key, result in izip(chunk, keys, results):
+            if result is None:
+                result = next(parsed)
+                cache.store(key, line, result)
+                pending.discard(key)
+            elif result is copy:	#the first copy is finished already, it comes earlier
+                result = cache.lookup(key, line)
+            yield line, None if result is True else result
+
+    try:
+        lines = iter(lines)
+        while True:
+            chunk = [line.strip() for line in islice(lines, chunk_size)]
+            if not chunk:
+                break
+            keys = [cache.key(line) for line in chunk]
+            results = []
+            todo = []
+            for key, line in izip(keys, chunk):
+                if key in pending:
+                    results.append(copy)
                     continue
-                # get the attribute name
-                # e.g :arg0 (x ...
-                # at this point we get "arg0"
-                if state == 2:
-                    # in this state, current relation name should be empty
-                    if cur_relation_name != "":
-                        print >> ERROR_LOG, "Format error when processing ", line[0:i+1]
-                        return None
-                    # update current relation name for future use
-                    cur_relation_name = "".join(cur_charseq).strip()
-                    cur_charseq[:] = []
-                state = 1
-            elif c == ":":
-                # not significant symbol if inside quote
-                if in_quote:
-                    cur_charseq.append(c)
-                    continue
-                # Last significant symbol is "/". Now we encounter ":"
-                # Example:
-                # :OR (o2 / *OR*
-                #    :mod (o3 / official)
-                #  gets node value "*OR*" at this point
-                if state == 3:
-                    node_value = "".join(cur_charseq)
-                    # clear current char sequence
-                    cur_charseq[:] = []
-                    # pop node name ("o2" in the above example)
-                    cur_node_name = stack[-1]
-                    # update node name/value map
-                    node_dict[cur_node_name] = node_value
-                # Last significant symbol is ":". Now we encounter ":"
-                # Example:
-                # :op1 w :quant 30
-                # or :day 14 :month 3
-                # the problem is that we cannot decide if node value is attribute value (constant)
-                # or node value (variable) at this moment
-                elif state == 2:
-                    temp_attr_value = "".join(cur_charseq)
-                    cur_charseq[:] = []
-                    parts = temp_attr_value.split()
-                    if len(parts) < 2:
-                        print >> ERROR_LOG, "Error in processing; part len < 2", line[0:i+1]
-                        return None
-                    # For the above example, node name is "op1", and node value is "w"
-                    # Note that this node name might not be encountered before
-                    relation_name = parts[0].strip()
-                    relation_value = parts[1].strip()
-                    # We need to link upper level node to the current
-                    # top of stack is upper level node
-                    if len(stack) == 0:
-                        print >> ERROR_LOG, "Error in processing", line[:i], relation_name, relation_value
-                        return None
-                    # if we have not seen this node name before
-                    if relation_value not in node_dict:
-                        node_relation_dict2[stack[-1]].append((relation_name, relation_value))
-                    else:
-                        node_relation_dict1[stack[-1]].append((relation_name, relation_value))
-                state = 2
-            elif c == "/":
-                if in_quote:
-                    cur_charseq.append(c)
-                    continue
-                # Last significant symbol is "(". Now we encounter "/"
-                # Example:
-                # (d / default-01
-                # get "d" here
-                if state == 1:
-                    node_name = "".join(cur_charseq)
-                    cur_charseq[:] = []
-                    # if this node name is already in node_dict, it is duplicate
-                    if node_name in node_dict:
-                        print >> ERROR_LOG, "Duplicate node name ", node_name, " in parsing AMR"
-                        return None
-                    # push the node name to stack
-                    stack.append(node_name)
-                    # add it to node name list
-                    node_name_list.append(node_name)
-                    # if this node is part of the relation
-                    # Example:
-                    # :arg1 (n / nation)
-                    # cur_relation_name is arg1
-                    # node name is n
-                    # we have a relation arg1(upper level node, n)
-                    if cur_relation_name != "":
-                        # if relation name ends with "-of", e.g."arg0-of",
-                        # it is reverse of some relation. For example, if a is "arg0-of" b,
-                        # we can also say b is "arg0" a.
-                        # If the relation name ends with "-of", we store the reverse relation.
-                        if not cur_relation_name.endswith("-of"):
-                            # stack[-2] is upper_level node we encountered, as we just add node_name to stack
-                            node_relation_dict1[stack[-2]].append((cur_relation_name, node_name))
-                        else:
-                            # cur_relation_name[:-3] is to delete "-of"
-                            node_relation_dict1[node_name].append((cur_relation_name[:-3], stack[-2]))
-                        # clear current_relation_name
-                        cur_relation_name = ""
-                else:
-                    # error if in other state
-                    print >> ERROR_LOG, "Error in parsing AMR", line[0:i+1]
-                    return None
-                state = 3
-            elif c == ")":
-                if in_quote:
-                    cur_charseq.append(c)
-                    continue
-                # stack should be non-empty to find upper level node
-                if len(stack) == 0:
-                    print >> ERROR_LOG, "Unmatched parenthesis at position", i, "in processing", line[0:i+1]
-                    return None
-                # Last significant symbol is ":". Now we encounter ")"
-                # Example:
-                # :op2 "Brown") or :op2 w)
-                # get \"Brown\" or w here
-                if state == 2:
-                    temp_attr_value = "".join(cur_charseq)
-                    cur_charseq[:] = []
-                    parts = temp_attr_value.split()
-                    if len(parts) < 2:
-                        print >> ERROR_LOG, "Error processing", line[:i+1], temp_attr_value
-                        return None
-                    relation_name = parts[0].strip()
-                    relation_value = parts[1].strip()
-                    # store reverse of the relation
-                    # we are sure relation_value is a node here, as "-of" relation is only between two nodes
-                    if relation_name.endswith("-of"):
-                        node_relation_dict1[relation_value].append((relation_name[:-3], stack[-1]))
-                    # attribute value not seen before
-                    # Note that it might be a constant attribute value, or an unseen node
-                    # process this after we have seen all the node names
-                    elif relation_value not in node_dict:
-                        node_relation_dict2[stack[-1]].append((relation_name, relation_value))
-                    else:
-                        node_relation_dict1[stack[-1]].append((relation_name, relation_value))
-                # Last significant symbol is "/". Now we encounter ")"
-                # Example:
-                # :arg1 (n / nation)
-                # we get "nation" here
-                elif state == 3:
-                    node_value = "".join(cur_charseq)
-                    cur_charseq[:] = []
-                    cur_node_name = stack[-1]
-                    # map node name to its value
-                    node_dict[cur_node_name] = node_value
-                # pop from stack, as the current node has been processed
-                stack.pop()
-                cur_relation_name = ""
-                state = 0
+                result = cache.lookup(key, line)
+                if result is None:
+                    pending.add(key)
+                    todo.append(line)
+                results.append(result)
+            if todo:
+                parsed_chunks += 1
+                if pool is None and parsed_chunks > 1 and processes > 1 and not current_process().daemon:
+                    pool = Pool(processes=processes)
+            if pool is None or not todo:
+                in_flight.append((chunk, keys, results, parse_chunk(todo)))
             else:
-                # not significant symbols, so we just shift.
-                cur_charseq.append(c)
-        #create data structures to initialize an AMR
-        node_value_list = []
-        relation_list = []
-        attribute_list = []
-        for v in node_name_list:
-            if v not in node_dict:
-                print >> ERROR_LOG, "Error: Node name not found", v
-                return None
-            else:
-                node_value_list.append(node_dict[v])
-            # build relation map and attribute map for this node
-            relation_dict = {}
-            attribute_dict = {}
-            if v in node_relation_dict1:
-                for v1 in node_relation_dict1[v]:
-                    relation_dict[v1[1]] = v1[0]
-            if v in node_relation_dict2:
-                for v2 in node_relation_dict2[v]:
-                    # if value is in quote, it is a constant value
-                    # strip the quote and put it in attribute map
-                    if v2[1][0] == "\"" and v2[1][-1] == "\"":
-                        attribute_dict[v2[0]] = v2[1][1:-1]
-                    # if value is a node name
-                    elif v2[1] in node_dict:
-                        relation_dict[v2[1]] = v2[0]
+                in_flight.append((chunk, keys, results, pool.apply_async(parse_chunk, (todo,))))
+            #keep all workers busy, while only a few chunks are in memory
+            while len(in_flight) > (0 if pool is None else 2 * processes):
+                for item in finish(*in_flight.popleft()):
+                    yield item
+        while in_flight:
+            for item in finish(*in_flight.popleft()):
+                yield item
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+
+def validate_amrs(lines, processes=1, chunk_size=1000, cache=PARSE_CACHE):
+    '''Validate all AMR lines, return a ValidationResult'''
+
+    result = ValidationResult()
+    for _, error in iter_validation(lines, processes, chunk_size, cache):
+        result.add(error)
+    return result
+
+
+def recover_amr(line):
+    '''Repair an invalid AMR line with the recovering parser (see AMR.recover_AMR_line), return the repaired line,
+       or None if nothing could be recovered'''
+
+    try:
+        recovered, _ = AMR.recover_AMR_line(line)
+    except Exception:
+        return None
+    if recovered is None:
+        return None
+    repaired = recovered.to_penman()
+    if not isinstance(parse_amr(repaired), CompactAMR):
+        return None
+    return repaired
+
+
+def validate_file(in_file, rewrite=False, default_amr=None, processes=1, chunk_size=1000, cache=PARSE_CACHE,
+                  recover=False):
+    '''Validate all AMR lines of a file and return a ValidationResult. If rewrite is True, the stripped lines are
+       written to a temporary file in the same pass, with default_amr (or get_default_amr()) for the invalid lines.
+       If recover is also True, invalid lines are repaired with recover_amr first, the default AMR is only used
+       when nothing can be recovered (the indexes of the repaired lines are in result.repaired).
+       The file is only replaced if there were invalid lines'''
+
+    if default_amr is None:
+        default_amr = get_default_amr()
+    result = ValidationResult()
+    with open_file(in_file, 'r') as in_f:
+        out_f = open_file(in_file + '.temp', 'w', compression=compression_type(in_file)) if rewrite else None
+        for line, error in iter_validation(in_f, processes, chunk_size, cache):
+            if out_f is not None:
+                new_line = line
+                if error is not None:
+                    new_line = recover_amr(line) if recover else None
+                    if new_line is None:
+                        new_line = default_amr
                     else:
-                        attribute_dict[v2[0]] = v2[1]
-            # each node has a relation map and attribute map
-            relation_list.append(relation_dict)
-            attribute_list.append(attribute_dict)
-        # add TOP as an attribute. The attribute value is the top node value
-        attribute_list[0]["TOP"] = node_value_list[0]
-        #print node_name_list
-        #print node_value_list
-        #print relation_list
-        #print attribute_list,'\n\n'
-        result_amr = AMR(node_name_list, node_value_list, relation_list, attribute_list)
-        return result_amr
+                        result.repaired.add(result.size)
+                out_f.write(new_line + '\n')
+            result.add(error)
+    if out_f is not None:
+        out_f.close()
+        if result.errors:
+            os.rename(in_file + '.temp', in_file)
+        else:
+            os.remove(in_file + '.temp')
+    return result
@@ -80,7 +80,7 @@ def process_var_line(line, var_dict):
 
 
 def get_tokenized_sentences(f):
-	sents = [l.replace('# ::snt','').replace('# ::tok','').strip() for l in open(f,'r') if (l.startswith('# ::snt') or l.startswith('# ::tok'))]
+	sents = [record.sentence for record in read_amr_records(open_file(f,'r'))]
 	return sents
 
 
@@ -517,9 +517,10 @@ def process_file_best(amrs, sent_amrs, cut_off):
 def preprocess(f_path):
 	'''Preprocess the AMR file, deleting variables/wiki-links and tokenizing'''
 	
-	no_wiki_amrs        = delete_wiki(f_path)
-	del_amrs 		    = delete_amr_variables(no_wiki_amrs)
-	old_amrs, sent_amrs = single_line_convert(del_amrs)				# old amrs with deleted wiki and variables
+	with open_file(f_path, 'r', 'utf-8') as in_f:
+		no_wiki_amrs        = delete_wiki(read_amr_records(in_f))
+		del_amrs 		    = delete_amr_variables(no_wiki_amrs)
+		old_amrs, sent_amrs = single_line_convert(del_amrs)				# old amrs with deleted wiki and variables
 	
 	return sent_amrs, old_amrs
 
@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+
+import sys
+import os
+import mmap
+import struct
+import argparse
+from array import array
+from collections import namedtuple
+from amr import AMR, CompactAMR, LABELS, label_id
+from amr_utils import open_file, read_amr_records
+
+'''Script that converts an AMR corpus (format of the AMR releases) to a packed binary file, that is read through
+   mmap. Any AMR can then be loaded by index without parsing (or even reading) the rest of the corpus, and worker
+   processes that open the same file share its pages instead of each keeping a copy.
+
+   Layout of the file (all offsets are byte offsets from the start of the file):
+
+   header : magic "AMRB", version, flags, number of AMRs, number of labels, offset of the index, offset of the labels
+   AMRs   : for each AMR the integer array of its CompactAMR, followed by the label ids of its node names,
+            then the utf-8 strings of its id, sentence (::snt) and tokens (::tok)
+   index  : for each AMR the offset and number of integers of its graph, and the offset and length of each string
+   labels : offset of each label (plus the end offset), followed by the utf-8 labels (concepts, relations,
+            attribute values and node names)
+
+   The integers of the graphs are in the byte order of the machine that wrote the file (flag 1 is big-endian),
+   they are swapped when the file is read on a machine with the other byte order.
+   Label ids in the file are only valid in the file, they are mapped to the label ids of the reading process
+   (see amr.LABELS) when an AMR is loaded. AMRs that could not be parsed are stored without graph.
+
+   Usage:
+
+   python binary_corpus.py -f training.txt -o training.amrb
+
+   In Python:
+
+   corpus = BinaryCorpus('training.amrb')
+   cur_amr = corpus.amr(1000)			#CompactAMR (None if the AMR was not valid)
+   entry = corpus[1000]				#CorpusEntry(id, sentence, tokens, amr)'''
+
+
+MAGIC = 'AMRB'
+VERSION = 1
+BIG_ENDIAN = 1
+
+# magic, version, flags, number of AMRs, number of labels, index offset, labels offset
+HEADER = struct.Struct('<4sIIQQQQ')
+# graph offset, number of integers, then offset and length of id, sentence and tokens
+ENTRY = struct.Struct('<QIQIQIQI')
+OFFSET = struct.Struct('<Q')
+INT_SIZE = array('i').itemsize
+
+CorpusEntry = namedtuple('CorpusEntry', ['id', 'sentence', 'tokens', 'amr'])
+
+
+def create_arg_parser():
+	parser = argparse.ArgumentParser()
+	parser.add_argument("-f", required=True, type=str, help="AMR file (format of the AMR releases)")
+	parser.add_argument("-o", required=True, type=str, help="Output binary file")
+	parser.add_argument("-snt_type", default=None, type=str, help="Only keep AMRs with this ::snt-type (e.g. summary)")
+	args = parser.parse_args()
+
+	return args
+
+
+def encode(text):
+	if text is None:
+		return ''
+	return text.encode('utf-8') if isinstance(text, unicode) else text
+
+
+def write_corpus(records, out_file):
+	'''Write AMRRecords to a binary corpus file, return the number of AMRs.
+	   The file is written to a temporary file first, so a half-written corpus is never read'''
+
+	entries = []
+	with open(out_file + '.temp', 'wb') as out_f:
+		out_f.write(HEADER.pack(MAGIC, VERSION, 0, 0, 0, 0, 0))
+		for record in records:
+			cur_amr = AMR.parse_AMR_line(record.one_line())
+			if cur_amr is None:
+				graph = array('i')
+			else:
+				graph = CompactAMR.from_amr(cur_amr).data
+				graph.extend([label_id(name) for name in cur_amr.nodes])
+			entry = [out_f.tell(), len(graph)]
+			graph.tofile(out_f)
+			for text in [record.id, record.metadata.get('snt'), record.metadata.get('tok')]:
+				text = encode(text)
+				entry += [out_f.tell(), len(text)]
+				out_f.write(text)
+			entries.append(entry)
+
+		index_offset = out_f.tell()
+		for entry in entries:
+			out_f.write(ENTRY.pack(*entry))
+
+		#label ids of the graphs are the ids in LABELS of this process, so the whole table is written
+		labels_offset = out_f.tell()
+		labels = [encode(label) for label in LABELS]
+		offset = labels_offset + OFFSET.size * (len(labels) + 1)
+		for label in labels:
+			out_f.write(OFFSET.pack(offset))
+			offset += len(label)
+		out_f.write(OFFSET.pack(offset))
+		out_f.write(''.join(labels))
+
+		flags = BIG_ENDIAN if sys.byteorder == 'big' else 0
+		out_f.seek(0)
+		out_f.write(HEADER.pack(MAGIC, VERSION, flags, len(entries), len(labels), index_offset, labels_offset))
+	os.rename(out_file + '.temp', out_file)
+	return len(entries)
+
+
+class BinaryCorpus(object):
+	'''Read-only, random access view of a binary corpus file (see write_corpus)
+
+	   Nothing is read when the file is opened, except the header. An AMR is only read (from the shared pages of
+	   the mmap) when it is accessed, and only its own labels are decoded. Objects can be passed to worker
+	   processes, they open the file again'''
+
+	def __init__(self, corpus_file):
+		self.corpus_file = corpus_file
+		self.in_f = open(corpus_file, 'rb')
+		self.data = mmap.mmap(self.in_f.fileno(), 0, access=mmap.ACCESS_READ)
+		magic, version, flags, self.size, num_labels, self.index_offset, self.labels_offset = HEADER.unpack_from(self.data, 0)
+		if magic != MAGIC or version != VERSION:
+			raise ValueError('{0} is not a binary AMR corpus (version {1})'.format(corpus_file, VERSION))
+		self.swap = (flags & BIG_ENDIAN) != (sys.byteorder == 'big')
+		self.label_map = [None] * num_labels		#label id in the file -> label id in this process
+
+	def close(self):
+		self.data.close()
+		self.in_f.close()
+
+	def __getstate__(self):
+		return self.corpus_file
+
+	def __setstate__(self, corpus_file):
+		self.__init__(corpus_file)
+
+	def __len__(self):
+		return self.size
+
+	def entry(self, index):
+		if index < 0:
+			index += self.size
+		if not 0 <= index < self.size:
+			raise IndexError('AMR index out of range')
+		return ENTRY.unpack_from(self.data, self.index_offset + ENTRY.size * index)
+
+	def string(self, offset, length):
+		if not length:
+			return None
+		return self.data[offset:offset + length].decode('utf-8')
+
+	def label(self, file_id):
+		'''Label id in this process (see amr.label_id) of a label id of the file'''
+
+		local_id = self.label_map[file_id]
+		if local_id is None:
+			start, end = struct.unpack_from('<QQ', self.data, self.labels_offset + OFFSET.size * file_id)
+			local_id = self.label_map[file_id] = label_id(self.data[start:end])
+		return local_id
+
+	def amr_id(self, index):
+		return self.string(*self.entry(index)[2:4])
+
+	def sentence(self, index):
+		return self.string(*self.entry(index)[4:6])
+
+	def tokens(self, index):
+		tokens = self.string(*self.entry(index)[6:8])
+		return None if tokens is None else tokens.split()
+
+	def amr(self, index):
+		'''CompactAMR of the AMR with this index, None if the AMR could not be parsed'''
+
+		offset, length = self.entry(index)[:2]
+		if not length:
+			return None
+		graph = array('i', self.data[offset:offset + INT_SIZE * length])
+		if self.swap:
+			graph.byteswap()
+		num_nodes = graph[0]
+		names = tuple([LABELS[self.label(name)] for name in graph[length - num_nodes:]])
+		del graph[length - num_nodes:]
+		compact = CompactAMR(names, graph)
+		for pos in compact.label_positions():
+			graph[pos] = self.label(graph[pos])
+		return compact
+
+	def __getitem__(self, index):
+		if isinstance(index, slice):
+			return [self[i] for i in range(*index.indices(self.size))]
+		return CorpusEntry(self.amr_id(index), self.sentence(index), self.tokens(index), self.amr(index))
+
+	def __iter__(self):
+		for index in xrange(self.size):
+			yield self[index]
+
+
+if __name__ == '__main__':
+	args = create_arg_parser()
+	with open_file(args.f, 'r') as in_f:
+		num_amrs = write_corpus(read_amr_records(in_f, args.snt_type), args.o)
+	print 'Wrote {0} AMRs to {1}'.format(num_amrs, args.o)
@@ -65,7 +65,7 @@ def get_fixed_lines(file_lines):
 
 def get_amr_lines(f_path):
 	file_lines = []
-	for line in open(f_path,'r'):
+	for line in open_file(f_path,'r'):
 		line = line.replace(' ','+') #replace actual spaces with '+'
 		new_l = ''
 		add_space = True
@@ -92,7 +92,7 @@ def process_pos_tagged(f_path):
 	
 	fixed_lines = []
 	
-	for line in open(f_path, 'r'):
+	for line in open_file(f_path, 'r'):
 		new_l = ''
 		no_spaces = False
 		line = line.replace(' ','+') #replace actual spaces with '+'
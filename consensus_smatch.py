@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+
+import sys
+import os
+import argparse
+from itertools import izip
+from collections import deque
+from multiprocessing import Pool
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'smatch'))
+import smatch_edited
+import amr
+from amr_utils import open_file
+
+'''Script that selects a consensus AMR for each sentence out of the output of multiple systems (minimum Bayes risk)
+
+   Input are N files with one-line AMRs, aligned by sentence (e.g. output of different checkpoints or beam settings).
+   For each sentence, smatch is computed between all pairs of candidate AMRs. The candidate with the highest
+   average smatch to the other candidates is selected. Each candidate is parsed only once, identical candidates
+   are only scored once and all sentences are processed in parallel by one pool of workers.
+
+   Output files:
+
+   [out]       : the selected AMR for each sentence
+   [out].scores: for each sentence the index of the selected file, followed by the average smatch of each candidate
+
+   Usage:
+
+   python consensus_smatch.py -f epoch10.restore epoch11.restore epoch12.restore -o consensus.restore'''
+
+
+def create_arg_parser():
+	parser = argparse.ArgumentParser()
+	parser.add_argument("-f", required=True, nargs='+', type=str, help="Files with one-line AMRs, aligned by sentence")
+	parser.add_argument("-o", required=True, type=str, help="Output file for the consensus AMRs")
+	parser.add_argument("-mx", default=12, type=int, help="Max number of parallel processes (default 12)")
+	parser.add_argument("-rs", default=4, type=int, help="Number of restarts for smatch (default 4)")
+	parser.add_argument("-chunk", default=100, type=int, help="Number of sentences sent to a worker at once (default 100)")
+	parser.add_argument("-var_free", action='store_true', help="Input AMRs are variable-free (e.g. .tf output)")
+	parser.add_argument("-batch", action='store_true', help="Use the batched smatch search (needs numpy)")
+	args = parser.parse_args()
+
+	return args
+
+
+def init_worker(restarts):
+	smatch_edited.iteration_num = restarts + 1
+
+
+def parse_candidate(line, var_free):
+	'''Parse candidate AMR once, return its triples for both sides of a smatch pair (prefix a and b), None if it is
+	   not a valid AMR'''
+
+	try:
+		if var_free:
+			cur_amr = amr.AMR.parse_var_free_line(line)
+		else:
+			cur_amr = amr.AMR.parse_AMR_line(line)
+	except Exception:	#e.g. an empty line, if a system produced no output for the sentence
+		cur_amr = None
+	if cur_amr is None:
+		return None
+	cur_amr.rename_node('a')
+	triples_a = cur_amr.get_triples()
+	cur_amr.rename_node('b')
+	triples_b = cur_amr.get_triples()
+	return triples_a, triples_b
+
+
+def sentence_agreement(candidates, var_free, batch):
+	'''Compute the average smatch of each candidate AMR to the other candidates of a sentence'''
+
+	parsed = {}
+	for line in candidates:
+		if line not in parsed:
+			parsed[line] = parse_candidate(line, var_free)
+
+	#only score each unordered pair of different, valid AMRs once (f-score is symmetric)
+
+	pair_scores = {}
+	to_score = []
+	unique = [line for line in sorted(parsed) if parsed[line] is not None]
+	for idx, line1 in enumerate(unique):
+		pair_scores[(line1, line1)] = 1.0
+		for line2 in unique[idx + 1:]:
+			to_score.append((line1, line2))
+
+	triple_list = [parsed[line1][0] + parsed[line2][1] for line1, line2 in to_score]
+	if batch:
+		best_matches = smatch_edited.get_best_match_batch(triple_list, 'a', 'b')
+	else:
+		best_matches = []
+		for triples in triple_list:
+			best_matches.append(smatch_edited.get_best_match(*(triples + ('a', 'b'))))
+			smatch_edited.match_triple_dict.clear()
+
+	for (line1, line2), triples, (_, match_num) in izip(to_score, triple_list, best_matches):
+		test_num = len(triples[0]) + len(triples[1]) + len(triples[2])
+		gold_num = len(triples[3]) + len(triples[4]) + len(triples[5])
+		score = smatch_edited.compute_f(match_num, test_num, gold_num)[2]
+		pair_scores[(line1, line2)] = score
+		pair_scores[(line2, line1)] = score
+
+	averages = []
+	for idx, line1 in enumerate(candidates):
+		scores = [pair_scores.get((line1, line2), 0.0) for idx2, line2 in enumerate(candidates) if idx2 != idx]
+		averages.append(sum(scores) / len(scores) if scores else 0.0)
+	return averages
+
+
+def process_chunk(arg_list):
+	chunk, var_free, batch = arg_list
+	return [sentence_agreement(candidates, var_free, batch) for candidates in chunk]
+
+
+def read_chunks(files, chunk_size):
+	'''Read the candidates of each sentence from all files at once, in chunks of sentences'''
+
+	chunk = []
+	for lines in izip(*[open_file(f, 'r') for f in files]):
+		chunk.append([line.strip() for line in lines])
+		if len(chunk) == chunk_size:
+			yield chunk
+			chunk = []
+	if chunk:
+		yield chunk
+
+
+def select_consensus(args):
+	pool = Pool(processes=args.mx, initializer=init_worker, initargs=(args.rs,))
+	in_flight = deque()		#chunks that are sent to the workers, in order
+
+	def tasks():
+		for chunk in read_chunks(args.f, args.chunk):
+			in_flight.append(chunk)
+			yield chunk, args.var_free, args.batch
+
+	num_sents, total = 0, 0.0
+	selected_count = [0] * len(args.f)
+	with open(args.o, 'w') as out_f, open(args.o + '.scores', 'w') as score_f:
+		for all_averages in pool.imap(process_chunk, tasks()):
+			chunk = in_flight.popleft()
+			for candidates, averages in izip(chunk, all_averages):
+				best = averages.index(max(averages))	#first file wins a tie
+				out_f.write(candidates[best] + '\n')
+				score_f.write('{0}\t{1}\n'.format(best, '\t'.join(['{0:.4f}'.format(x) for x in averages])))
+				selected_count[best] += 1
+				total += averages[best]
+				num_sents += 1
+	pool.close()
+	pool.join()
+
+	print 'Selected consensus AMRs for {0} sentences, average agreement {1:.4f}'.format(num_sents, total / max(num_sents, 1))
+	for f, count in zip(args.f, selected_count):
+		print '{0}: selected {1} times'.format(f, count)
+
+
+if __name__ == '__main__':
+	args = create_arg_parser()
+	select_consensus(args)
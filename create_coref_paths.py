@@ -232,8 +232,9 @@ if __name__ == "__main__":
 	
 	print 'Processing file {0}'.format(args.f)
 	
-	amr_file_no_wiki 	= delete_wiki(args.f)
-	single_amrs, sents 	= single_line_convert(amr_file_no_wiki)
+	with open_file(args.f, 'r', 'utf-8') as in_f:
+		amr_file_no_wiki 	= delete_wiki(read_amr_records(in_f))
+		single_amrs, sents 	= single_line_convert(amr_file_no_wiki)
 	repl_amrs  			= replace_coreference(single_amrs, sents)
 	final_amrs 			= replace_variables(repl_amrs)
 	
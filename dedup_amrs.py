@@ -0,0 +1,225 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+
+import os
+import shutil
+import struct
+import hashlib
+import heapq
+import tempfile
+import argparse
+from itertools import izip
+from multiprocessing import Pool
+from amr import AMR
+from amr_utils import open_file, read_amr_records
+
+'''Script that removes AMRs that are graph-identical to an earlier AMR in the file, i.e. that only differ in variable
+   names or branch order (e.g. the .double files of best_amr_permutation.py, or repeated short sentences)
+
+   AMRs are compared on a hash of their canonical form (see AMR.canonical_form). AMRs that can not be parsed are
+   compared on their text. The first occurrence of each AMR is kept.
+
+   Memory is bounded: the hashes are written to -buckets bucket files on disk, and only one bucket is in memory at
+   a time. The input is read twice, the second time to write the kept AMRs.
+
+   Input is either a file in the format of the AMR releases (comments are kept), or with -one_line a file with one
+   AMR per line (e.g. .tf files with -var_free), optionally with a sentence file that is aligned by line.
+
+   Output files:
+
+   [out]       : the kept AMRs
+   [out].sent  : the sentences of the kept AMRs (only with -one_line and -s)
+   [out].counts: for each kept AMR the number of times it occurs in the input
+
+   Usage:
+
+   python dedup_amrs.py -f silver.txt -o silver.dedup.txt
+   python dedup_amrs.py -f train.tf.double -s train.sent.double -one_line -var_free -o train.dedup.tf'''
+
+
+def create_arg_parser():
+	parser = argparse.ArgumentParser()
+	parser.add_argument("-f", required=True, type=str, help="Input AMR file")
+	parser.add_argument("-o", required=True, type=str, help="Output file for the kept AMRs")
+	parser.add_argument("-s", default='', type=str, help="Sentence file, aligned by line with -f (only with -one_line)")
+	parser.add_argument("-one_line", action='store_true', help="Input has one AMR per line")
+	parser.add_argument("-var_free", action='store_true', help="AMRs are variable-free (e.g. .tf files)")
+	parser.add_argument("-buckets", default=64, type=int, help="Number of bucket files for the hashes (default 64)")
+	parser.add_argument("-t", default=1, type=int, help="Number of parallel processes for hashing (default 1)")
+	parser.add_argument("-chunk", default=1000, type=int, help="Number of AMRs sent to a worker at once (default 1000)")
+	parser.add_argument("-top", default=10, type=int, help="Print the N most frequent duplicated AMRs (default 10)")
+	args = parser.parse_args()
+
+	return args
+
+
+# hash and index of an AMR in a bucket file, and (index, count) in the sorted files of the buckets
+HASH_RECORD = struct.Struct('<20sQ')
+COUNT_RECORD = struct.Struct('<QQ')
+
+
+def amr_hash(line, var_free=False):
+	'''SHA-1 of the canonical form of the AMR, or of the text of the line if it can not be parsed.
+	   Returns (digest, True if the AMR was parsed)'''
+
+	try:
+		cur_amr = AMR.parse_var_free_line(line) if var_free else AMR.parse_AMR_line(line)
+	except Exception:
+		cur_amr = None
+	if cur_amr is None:
+		return hashlib.sha1('text ' + line.strip()).digest(), False
+	return hashlib.sha1('amr ' + cur_amr.canonical_form()).digest(), True
+
+
+def hash_chunk(arg_list):
+	lines, var_free = arg_list
+	return [amr_hash(line, var_free) for line in lines]
+
+
+def read_items(args):
+	'''Generator that yields (AMR line, text to write) for each AMR of the input. The text to write is the AMR with its
+	   comments for the AMR release format, or (line, sentence) with -one_line'''
+
+	if args.one_line:
+		with open_file(args.f, 'r') as in_f:
+			if args.s:
+				with open_file(args.s, 'r') as sent_f:
+					for line, sent in izip(in_f, sent_f):
+						yield line.strip(), (line, sent)
+			else:
+				for line in in_f:
+					yield line.strip(), (line, None)
+	else:
+		with open_file(args.f, 'r') as in_f:
+			for record in read_amr_records(in_f):
+				yield record.one_line(), '\n'.join(record.comments + record.lines) + '\n\n'
+
+
+def iter_hashes(args):
+	'''Generator that yields the hash of each AMR, in order, computed by a pool of processes if -t > 1'''
+
+	def chunks():
+		chunk = []
+		for line, _ in read_items(args):
+			chunk.append(line)
+			if len(chunk) == args.chunk:
+				yield chunk, args.var_free
+				chunk = []
+		if chunk:
+			yield chunk, args.var_free
+
+	if args.t > 1:
+		pool = Pool(processes=args.t)
+		results = pool.imap(hash_chunk, chunks())
+	else:
+		pool = None
+		results = (hash_chunk(chunk) for chunk in chunks())
+	for hashes in results:
+		for item in hashes:
+			yield item
+	if pool is not None:
+		pool.close()
+		pool.join()
+
+
+def write_buckets(args, tmp_dir):
+	'''First pass: write (hash, index) of each AMR to the bucket files, by the first byte of the hash'''
+
+	bucket_files = [open(os.path.join(tmp_dir, 'bucket{0}'.format(idx)), 'wb') for idx in range(args.buckets)]
+	total, invalid = 0, 0
+	for idx, (digest, parsed) in enumerate(iter_hashes(args)):
+		bucket_files[ord(digest[0]) % args.buckets].write(HASH_RECORD.pack(digest, idx))
+		total += 1
+		if not parsed:
+			invalid += 1
+	for bucket_f in bucket_files:
+		bucket_f.close()
+	return total, invalid
+
+
+def read_records(file_name, record_struct):
+	with open(file_name, 'rb') as in_f:
+		while True:
+			data = in_f.read(record_struct.size * 4096)
+			if not data:
+				break
+			for pos in xrange(0, len(data), record_struct.size):
+				yield record_struct.unpack_from(data, pos)
+
+
+def count_buckets(args, tmp_dir):
+	'''Second pass: for each bucket, count the occurrences of each hash. Writes a sorted file per bucket with (index,
+	   number of occurrences) for the first occurrence of each hash and (index, 0) for the other occurrences.
+	   Returns the indexes and counts of the most frequent AMRs'''
+
+	top = []
+	for idx in range(args.buckets):
+		bucket_file = os.path.join(tmp_dir, 'bucket{0}'.format(idx))
+		first = {}
+		counts = {}
+		for digest, amr_idx in read_records(bucket_file, HASH_RECORD):
+			if digest not in first:
+				first[digest] = amr_idx
+				counts[amr_idx] = 1
+			else:
+				counts[first[digest]] += 1
+				counts[amr_idx] = 0
+		os.remove(bucket_file)
+		with open(bucket_file + '.counts', 'wb') as out_f:
+			for amr_idx in sorted(counts):
+				out_f.write(COUNT_RECORD.pack(amr_idx, counts[amr_idx]))
+		for amr_idx, count in counts.iteritems():
+			if count > 1:
+				heapq.heappush(top, (count, -amr_idx))
+				if len(top) > args.top:
+					heapq.heappop(top)
+	return [(-neg_idx, count) for count, neg_idx in sorted(top, reverse=True)]
+
+
+def write_output(args, tmp_dir, top):
+	'''Third pass: merge the sorted bucket files and write the first occurrence of each AMR with its count'''
+
+	merged = heapq.merge(*[read_records(os.path.join(tmp_dir, 'bucket{0}.counts'.format(idx)), COUNT_RECORD)
+						   for idx in range(args.buckets)])
+	top_lines = dict([(amr_idx, None) for amr_idx, _ in top])
+	kept = 0
+	sent_f = open_file(args.o + '.sent', 'w') if args.one_line and args.s else None
+	with open_file(args.o, 'w') as out_f, open_file(args.o + '.counts', 'w') as count_f:
+		for (line, text), (amr_idx, count) in izip(read_items(args), merged):
+			if amr_idx in top_lines:
+				top_lines[amr_idx] = line
+			if not count:
+				continue
+			kept += 1
+			count_f.write('{0}\n'.format(count))
+			if args.one_line:
+				out_f.write(text[0])
+				if sent_f is not None:
+					sent_f.write(text[1])
+			else:
+				out_f.write(text)
+	if sent_f is not None:
+		sent_f.close()
+	return kept, top_lines
+
+
+def dedup_amrs(args):
+	tmp_dir = tempfile.mkdtemp(prefix='dedup_amrs')
+	try:
+		total, invalid = write_buckets(args, tmp_dir)
+		top = count_buckets(args, tmp_dir)
+		kept, top_lines = write_output(args, tmp_dir, top)
+	finally:
+		shutil.rmtree(tmp_dir)
+
+	print 'Read {0} AMRs ({1} could not be parsed, compared on text)'.format(total, invalid)
+	print 'Kept {0} unique AMRs, removed {1} duplicates'.format(kept, total - kept)
+	if top:
+		print '\nMost frequent AMRs:'
+		for amr_idx, count in top:
+			print '{0}\t{1}'.format(count, top_lines[amr_idx])
+
+
+if __name__ == '__main__':
+	args = create_arg_parser()
+	dedup_amrs(args)
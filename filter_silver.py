@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+
+import sys
+import os
+import json
+import argparse
+from collections import deque
+from itertools import izip_longest
+from multiprocessing import Pool
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'smatch'))
+import smatch_edited
+from amr_utils import open_file, read_amr_records
+
+'''Script that filters silver data on the agreement of two parsers (e.g. CAMR and JAMR), using smatch
+
+   Input are two AMR files that are aligned by sentence (same sentences in the same order, checked on ::id and ::snt
+   when both AMRs have them). For each sentence, smatch between the two parses is computed in parallel. The AMRs of
+   the first file (with their comments) are kept when the smatch is at least the threshold. Progress is saved in a checkpoint file after each chunk, so an
+   interrupted run continues where it stopped when it is started again with the same input files and options.
+
+   Output files:
+
+   [out].txt   : kept AMRs of the first file with their comments, AMRs in one-line format
+   [out].smatch: smatch score for each sentence (one per line)
+   [out].hist  : histogram of the smatch scores
+   [out].ckpt  : checkpoint (deleted when done)
+
+   Usage:
+
+   python filter_silver.py -f1 camr_parses.txt -f2 jamr_parses.txt -o silver_agreement -t 0.7'''
+
+
+def create_arg_parser():
+	parser = argparse.ArgumentParser()
+	parser.add_argument("-f1", required=True, type=str, help="First AMR file, kept AMRs come from this file")
+	parser.add_argument("-f2", required=True, type=str, help="Second AMR file, aligned by sentence with -f1")
+	parser.add_argument("-o", required=True, type=str, help="Output prefix")
+	parser.add_argument("-t", default=0.7, type=float, help="Keep AMRs with at least this smatch (default 0.7)")
+	parser.add_argument("-mx", default=12, type=int, help="Max number of parallel processes (default 12)")
+	parser.add_argument("-rs", default=4, type=int, help="Number of restarts for smatch (default 4)")
+	parser.add_argument("-chunk", default=500, type=int, help="Number of AMR pairs per chunk/checkpoint (default 500)")
+	parser.add_argument("-bins", default=10, type=int, help="Number of bins in the histogram (default 10)")
+	parser.add_argument("-batch", action='store_true', help="Use the batched smatch search (needs numpy)")
+	args = parser.parse_args()
+
+	return args
+
+
+def same_sentence(record1, record2):
+	'''Return the metadata key (id or snt) on which two AMR records differ, None if they can be of the same sentence.
+	   A key is only compared when both records have it'''
+
+	for key in ['id', 'snt']:
+		value1, value2 = record1.metadata.get(key), record2.metadata.get(key)
+		if value1 is not None and value2 is not None and value1.split() != value2.split():
+			return key
+	return None
+
+
+def read_chunks(f1, f2, chunk_size, skip):
+	'''Read aligned AMR pairs in chunks, skip the pairs that were already done. Raises ValueError if the files
+	   do not have the same number of AMRs, or if two AMRs of a pair are not of the same sentence (as all later
+	   pairs would be misaligned)'''
+
+	chunk = []
+	for idx, (record1, record2) in enumerate(izip_longest(read_amr_records(open_file(f1, 'r')), read_amr_records(open_file(f2, 'r')))):
+		if record1 is None or record2 is None:
+			shorter, longer = (f1, f2) if record1 is None else (f2, f1)
+			raise ValueError('{0} ends after {1} AMRs, {2} has more, the files are not aligned'.format(shorter, idx, longer))
+		key = same_sentence(record1, record2)
+		if key:
+			raise ValueError('AMR {0} of {1} and {2} is not of the same sentence (other ::{3}), the files are not aligned'.format(idx + 1, f1, f2, key))
+		if idx < skip:
+			continue
+		chunk.append(((record1.comments, record1.one_line()), record2.one_line()))
+		if len(chunk) == chunk_size:
+			yield chunk
+			chunk = []
+	if chunk:
+		yield chunk
+
+
+def init_worker(restarts):
+	smatch_edited.iteration_num = restarts + 1
+
+
+def score_chunk(arg_list):
+	'''Compute smatch for each AMR pair in the chunk, 0.0 if one of the AMRs can not be parsed'''
+
+	chunk, batch = arg_list
+	pairs = [(block1[1], amr2) for block1, amr2 in chunk]
+	scores = []
+	for res in smatch_edited.get_amr_match_batch(pairs, batch=batch):
+		if res is None:
+			scores.append(0.0)
+		else:
+			scores.append(smatch_edited.compute_f(*res)[2])
+	return scores
+
+
+def run_settings(args):
+	'''Settings a checkpoint belongs to: the input files (path, size and modification time) and the options that
+	   change the output'''
+
+	files = [[os.path.abspath(f), os.path.getsize(f), os.path.getmtime(f)] for f in [args.f1, args.f2]]
+	return {'files': files, 't': args.t, 'bins': args.bins, 'rs': args.rs, 'batch': args.batch}
+
+
+def load_checkpoint(ckpt_file, out_files, settings):
+	'''Load the checkpoint and cut off output written after it (from an interrupted chunk). A checkpoint of a run
+	   with other settings (see run_settings) is not used, as its histogram and kept AMRs would be wrong'''
+
+	if not os.path.isfile(ckpt_file):
+		for f in out_files:
+			open(f, 'w').close()
+		return {'done': 0, 'kept': 0, 'sizes': [0] * len(out_files), 'hist': [0] * settings['bins'],
+				'settings': settings}
+
+	with open(ckpt_file, 'r') as in_f:
+		ckpt = json.load(in_f)
+	changed = sorted([key for key in settings if ckpt.get('settings', {}).get(key) != settings[key]])
+	if changed:
+		raise ValueError('Checkpoint {0} is of a run with other {1}, delete it to start again'.format(
+			ckpt_file, ', '.join(['input files' if key == 'files' else '-' + key for key in changed])))
+	for f, size in zip(out_files, ckpt['sizes']):
+		with open(f, 'a') as out_f:
+			out_f.truncate(size)
+	print 'Continue from checkpoint, {0} AMR pairs already done'.format(ckpt['done'])
+	return ckpt
+
+
+def save_checkpoint(ckpt_file, ckpt):
+	'''Write checkpoint to a temporary file first, so it is never half-written'''
+
+	with open(ckpt_file + '.temp', 'w') as out_f:
+		json.dump(ckpt, out_f)
+	os.rename(ckpt_file + '.temp', ckpt_file)
+
+
+def write_histogram(hist, hist_file):
+	'''Print histogram to screen and file'''
+
+	total = max(sum(hist), 1)
+	lines = []
+	for idx, count in enumerate(hist):
+		lower, upper = float(idx) / len(hist), float(idx + 1) / len(hist)
+		lines.append('{0:.2f}-{1:.2f}\t{2}\t{3:.1f}%\t{4}'.format(lower, upper, count, 100.0 * count / total,
+																 '#' * int(50.0 * count / total)))
+	print '\n'.join(lines)
+	with open(hist_file, 'w') as out_f:
+		out_f.write('\n'.join(lines) + '\n')
+	out_f.close()
+
+
+def filter_silver(args):
+	out_amr, out_scores = args.o + '.txt', args.o + '.smatch'
+	ckpt_file = args.o + '.ckpt'
+	ckpt = load_checkpoint(ckpt_file, [out_amr, out_scores], run_settings(args))
+
+	pool = Pool(processes=args.mx, initializer=init_worker, initargs=(args.rs,))
+	in_flight = deque()		#chunks that are sent to the workers, in order
+
+	def tasks():
+		for chunk in read_chunks(args.f1, args.f2, args.chunk, ckpt['done']):
+			in_flight.append(chunk)
+			yield chunk, args.batch
+
+	#imap keeps the order of the chunks, while the workers can already work on the next ones
+
+	for scores in pool.imap(score_chunk, tasks()):
+		chunk = in_flight.popleft()
+		with open(out_amr, 'a') as amr_f, open(out_scores, 'a') as score_f:
+			for (block1, _), score in zip(chunk, scores):
+				score_f.write('{0:.4f}\n'.format(score))
+				ckpt['hist'][min(int(score * args.bins), args.bins - 1)] += 1
+				if score >= args.t:
+					amr_f.write("\n".join(block1[0] + [block1[1]]) + '\n\n')
+					ckpt['kept'] += 1
+		ckpt['done'] += len(chunk)
+		ckpt['sizes'] = [os.path.getsize(out_amr), os.path.getsize(out_scores)]
+		save_checkpoint(ckpt_file, ckpt)
+		print 'Done {0} AMR pairs, kept {1}'.format(ckpt['done'], ckpt['kept'])
+
+	pool.close()
+	pool.join()
+	write_histogram(ckpt['hist'], args.o + '.hist')
+	print 'Kept {0} out of {1} AMRs with smatch >= {2}'.format(ckpt['kept'], ckpt['done'], args.t)
+	os.remove(ckpt_file)
+
+
+if __name__ == '__main__':
+	args = create_arg_parser()
+	filter_silver(args)
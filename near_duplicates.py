@@ -0,0 +1,257 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+
+import sys
+import os
+import zlib
+import argparse
+from collections import defaultdict
+from itertools import izip
+from multiprocessing import Pool
+import numpy as np
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'smatch'))
+import smatch_edited
+from amr import AMR, var_free_to_penman
+from amr_utils import open_file, read_amr_records
+
+'''Script that finds near-duplicate AMR graphs between two corpora (e.g. silver training data and the dev/test gold
+   data, to rule out leakage), or within one corpus, without computing smatch between all pairs
+
+   Each AMR is turned into a set of shingles: its triples (see AMR.get_triples2) with the variables replaced by their
+   concepts, e.g. instance(want-01), ARG0(want-01, boy) and polarity(possible-01, -). A MinHash signature of the set
+   (-bands x -rows hash functions) estimates the Jaccard similarity between two AMRs, and an LSH index on the bands
+   of the signatures of the second corpus (-b) gives the candidate pairs, so only pairs that share at least one band
+   are compared. The first corpus (-a) is streamed, so it can have millions of AMRs, only -b is kept in memory.
+   Without -b, the AMRs of -a are compared to the earlier AMRs of -a (then all signatures are kept in memory).
+
+   Pairs with an estimated Jaccard similarity of at least -j are written to the output file. With -smatch, smatch is
+   computed for these pairs as well, and only pairs with a smatch of at least -smatch_t are kept.
+
+   Output file (tab-separated): index in -a, id in -a, index in -b, id in -b, estimated Jaccard[, smatch]
+   Ids are the ::id of AMRs in the format of the AMR releases, the line number for one-line files.
+
+   Usage:
+
+   python near_duplicates.py -a silver.txt -b dev.txt test.txt -o leakage.tsv -j 0.8 -smatch -smatch_t 0.9'''
+
+
+def create_arg_parser():
+	parser = argparse.ArgumentParser()
+	parser.add_argument("-a", required=True, type=str, help="First (large) AMR file, it is streamed")
+	parser.add_argument("-b", default=[], nargs='+', type=str, help="Second AMR file(s), kept in memory. Without -b, -a is compared to itself")
+	parser.add_argument("-o", required=True, type=str, help="Output file with the near-duplicate pairs")
+	parser.add_argument("-a_format", default='release', choices=['release', 'one_line', 'var_free'], help="Format of -a: AMR release format (default), one AMR per line, or one variable-free AMR per line")
+	parser.add_argument("-b_format", default='release', choices=['release', 'one_line', 'var_free'], help="Format of -b (see -a_format)")
+	parser.add_argument("-j", default=0.8, type=float, help="Minimum estimated Jaccard similarity of the shingles (default 0.8)")
+	parser.add_argument("-bands", default=32, type=int, help="Number of LSH bands (default 32)")
+	parser.add_argument("-rows", default=4, type=int, help="Number of MinHash values per band (default 4)")
+	parser.add_argument("-seed", default=1, type=int, help="Seed of the MinHash functions (default 1)")
+	parser.add_argument("-smatch", action='store_true', help="Confirm the candidate pairs with smatch")
+	parser.add_argument("-smatch_t", default=0.0, type=float, help="Only keep pairs with at least this smatch (with -smatch, default 0.0)")
+	parser.add_argument("-batch", action='store_true', help="Use the batched smatch search (needs numpy)")
+	parser.add_argument("-t", default=1, type=int, help="Number of parallel processes for the signatures of -a (default 1)")
+	parser.add_argument("-chunk", default=1000, type=int, help="Number of AMRs sent to a worker at once (default 1000)")
+	args = parser.parse_args()
+
+	return args
+
+
+# MinHash functions (a * x + b) mod PRIME on 32-bit shingle hashes: a * x + b fits in 64 bits, so numpy computes
+# them exactly
+PRIME = np.uint64(4294967291)
+
+
+def read_amrs(amr_file, amr_format):
+	'''Generator that yields (id, one-line AMR with variables) for each AMR of a file. The AMR is None for
+	   variable-free AMRs that can not be converted'''
+
+	with open_file(amr_file, 'r') as in_f:
+		if amr_format == 'release':
+			for record in read_amr_records(in_f):
+				yield record.id, record.one_line()
+		else:
+			for idx, line in enumerate(in_f):
+				if amr_format == 'var_free':
+					yield str(idx + 1), var_free_to_penman(line)
+				else:
+					yield str(idx + 1), line.strip()
+
+
+def shingles(line):
+	'''32-bit hashes of the shingles of an AMR (triples with variables replaced by concepts), None if the AMR
+	   can not be parsed'''
+
+	if not line:
+		return None
+	try:
+		cur_amr = AMR.parse_AMR_line(line)
+	except Exception:
+		cur_amr = None
+	if cur_amr is None:
+		return None
+	instance_triples, relation_triples = cur_amr.get_triples2()
+	concepts = dict([(node, concept) for _, node, concept in instance_triples])
+	shingle_set = set(['instance(' + concept + ')' for concept in concepts.values()])
+	for relation, node1, node2 in relation_triples:
+		shingle_set.add('{0}({1},{2})'.format(relation, concepts[node1], concepts.get(node2, node2)))
+	return np.array([zlib.crc32(shingle) & 0xffffffff for shingle in shingle_set], dtype=np.uint64)
+
+
+class MinHasher(object):
+	'''MinHash signatures of shingle hashes with num_perm hash functions'''
+
+	def __init__(self, num_perm, seed):
+		rand = np.random.RandomState(seed)
+		self.a = rand.randint(1, 1 << 32, size=num_perm).astype(np.uint64) % PRIME
+		self.b = rand.randint(0, 1 << 32, size=num_perm).astype(np.uint64) % PRIME
+
+	def signature(self, hashes):
+		return ((hashes[:, None] * self.a[None, :] + self.b[None, :]) % PRIME).min(axis=0).astype(np.uint32)
+
+
+def signature_chunk(arg_list):
+	'''Signatures of a chunk of AMR lines, None for AMRs that can not be parsed'''
+
+	lines, num_perm, seed = arg_list
+	hasher = MinHasher(num_perm, seed)
+	signatures = []
+	for line in lines:
+		hashes = shingles(line)
+		signatures.append(None if hashes is None else hasher.signature(hashes))
+	return signatures
+
+
+def iter_signatures(amrs, args):
+	'''Generator that yields (id, line, signature) for each AMR, computed by a pool of processes if -t > 1'''
+
+	num_perm = args.bands * args.rows
+	buffered = []
+
+	def chunks():
+		chunk = []
+		for amr_id, line in amrs:
+			buffered.append((amr_id, line))
+			chunk.append(line)
+			if len(chunk) == args.chunk:
+				yield chunk, num_perm, args.seed
+				chunk = []
+		if chunk:
+			yield chunk, num_perm, args.seed
+
+	if args.t > 1:
+		pool = Pool(processes=args.t)
+		results = pool.imap(signature_chunk, chunks())
+	else:
+		pool = None
+		results = (signature_chunk(chunk) for chunk in chunks())
+	for signatures in results:
+		#imap keeps the order, so the first len(signatures) buffered AMRs belong to this chunk
+		items, buffered[:len(signatures)] = buffered[:len(signatures)], []
+		for (amr_id, line), signature in izip(items, signatures):
+			yield amr_id, line, signature
+	if pool is not None:
+		pool.close()
+		pool.join()
+
+
+class LSHIndex(object):
+	'''Signatures of a corpus, with an LSH table per band: AMRs that have the same values for all rows of a band are
+	   candidate near-duplicates'''
+
+	def __init__(self, bands, rows):
+		self.bands, self.rows = bands, rows
+		self.tables = [defaultdict(list) for _ in range(bands)]
+		self.signatures = []
+		self.items = []
+
+	def band_keys(self, signature):
+		return [signature[band * self.rows:(band + 1) * self.rows].tostring() for band in range(self.bands)]
+
+	def add(self, item, signature):
+		idx = len(self.items)
+		self.items.append(item)
+		self.signatures.append(signature)
+		for table, key in izip(self.tables, self.band_keys(signature)):
+			table[key].append(idx)
+
+	def query(self, signature, threshold):
+		'''Indexes of the candidates with an estimated Jaccard similarity of at least threshold, with the estimate'''
+
+		candidates = set()
+		for table, key in izip(self.tables, self.band_keys(signature)):
+			candidates.update(table.get(key, ()))
+		results = []
+		for idx in sorted(candidates):
+			jaccard = float(np.mean(self.signatures[idx] == signature))
+			if jaccard >= threshold:
+				results.append((idx, jaccard))
+		return results
+
+
+def confirm_smatch(pairs, batch):
+	'''Smatch of each (AMR line, AMR line) pair'''
+
+	scores = []
+	for res in smatch_edited.get_amr_match_batch(pairs, batch=batch):
+		scores.append(0.0 if res is None else smatch_edited.compute_f(*res)[2])
+	return scores
+
+
+def find_near_duplicates(args):
+	print 'LSH with {0} bands of {1} rows: pairs with Jaccard {2:.2f} are found with probability 0.5'.format(
+		args.bands, args.rows, (1.0 - 0.5 ** (1.0 / args.bands)) ** (1.0 / args.rows))
+
+	index = LSHIndex(args.bands, args.rows)
+	invalid = 0
+	if args.b:
+		for b_file in args.b:
+			b_amrs = [(amr_id, line) for amr_id, line in read_amrs(b_file, args.b_format)]
+			for amr_id, line, signature in iter_signatures(b_amrs, args):
+				if signature is None:
+					invalid += 1
+				else:
+					index.add((len(index.items), amr_id, line), signature)
+		print 'Indexed {0} AMRs of {1}'.format(len(index.items), ', '.join(args.b))
+
+	num_a, num_pairs = 0, 0
+	matched_a, matched_b = set(), set()
+	pending = []		#candidate pairs waiting for smatch
+
+	def write_pairs(out_f, pairs):
+		scores = confirm_smatch([(a_line, b_item[2]) for (_, _, a_line), b_item, _ in pairs], args.batch) if args.smatch else [None] * len(pairs)
+		kept = 0
+		for ((a_idx, a_id, _), b_item, jaccard), score in izip(pairs, scores):
+			if score is not None and score < args.smatch_t:
+				continue
+			fields = [a_idx, a_id, b_item[0], b_item[1], '{0:.4f}'.format(jaccard)]
+			if score is not None:
+				fields.append('{0:.4f}'.format(score))
+			out_f.write('\t'.join([str(field) for field in fields]) + '\n')
+			matched_a.add(a_idx)
+			matched_b.add(b_item[0])
+			kept += 1
+		return kept
+
+	with open_file(args.o, 'w') as out_f:
+		for a_idx, (amr_id, line, signature) in enumerate(iter_signatures(read_amrs(args.a, args.a_format), args)):
+			num_a += 1
+			if signature is None:
+				invalid += 1
+				continue
+			for b_idx, jaccard in index.query(signature, args.j):
+				pending.append(((a_idx, amr_id, line), index.items[b_idx], jaccard))
+			if not args.b:
+				index.add((a_idx, amr_id, line), signature)
+			if len(pending) >= args.chunk:
+				num_pairs += write_pairs(out_f, pending)
+				pending = []
+		num_pairs += write_pairs(out_f, pending)
+
+	print 'Compared {0} AMRs of {1} ({2} AMRs could not be parsed)'.format(num_a, args.a, invalid)
+	print 'Found {0} near-duplicate pairs: {1} AMRs of {2} and {3} other AMRs'.format(
+		num_pairs, len(matched_a), args.a, len(matched_b))
+
+
+if __name__ == '__main__':
+	args = create_arg_parser()
+	find_near_duplicates(args)
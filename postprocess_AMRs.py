@@ -30,41 +30,43 @@ def create_arg_parser():
 	
 	parser.add_argument('-c', default = 'dupl', action='store', choices=['dupl','index','abs'], help='How to handle coreference - input was either duplicated/indexed/absolute path')
 	parser.add_argument('-no_wiki', action='store_true', help='Not doing Wikification, since it takes a long time')
+	parser.add_argument('-parse_cache', action='store_true', help='Keep parse results on disk ([file].parse_cache), so AMRs are not parsed again by later stages or runs')
+	parser.add_argument('-recover', action='store_true', help='Repair invalid AMRs with the recovering parser instead of replacing them by a default AMR')
 	args = parser.parse_args() 
 
 	return args	
 
 
-def check_valid(restore_file, rewrite):
-	'''Checks whether the AMRS in a file are valid, possibly rewrites to default AMR'''
+def check_valid(restore_file, rewrite, cache_file=None, processes=1, recover=False):
+	'''Checks whether the AMRS in a file are valid, possibly rewrites to default AMR
+	   With recover, invalid AMRs are repaired by the recovering parser instead (keeping the parts of the graph that
+	   could be read), only AMRs of which nothing can be recovered are rewritten to the default AMR
+	   AMRs that were already validated (in this process or in cache_file) are not parsed again,
+	   the other AMRs are validated by a pool of processes'''
 	
-	idx = 0
-	warnings = 0
-	all_amrs = []
-	for line in open(restore_file,'r'):
-		idx += 1
-		if not valid_amr(line):
-			print 'Error or warning in line {0}, write default\n'.format(idx)
-			warnings += 1
-			default_amr = get_default_amr()
-			all_amrs.append(default_amr)		## add default when error
-		else:
-			all_amrs.append(line)	
+	if cache_file:
+		PARSE_CACHE.open(cache_file)
+	result = validate_file(restore_file, rewrite=rewrite, default_amr=get_default_amr(), processes=processes, recover=recover)
+	for idx in sorted(result.errors):
+		kind, offset = result.errors[idx]
+		action = 'repaired' if idx in result.repaired else 'write default'
+		print 'Error or warning in line {0} ({1} at character {2}), {3}\n'.format(idx + 1, kind, offset, action)
 	
+	warnings = len(result.errors)
 	if warnings == 0:
 		print 'No badly formed AMRs!\n'
+	elif rewrite and recover:
+		print 'Repaired {0} AMRs with error, rewrote {1} to default AMR\n'.format(len(result.repaired), warnings - len(result.repaired))
 	elif rewrite:
-		print 'Rewriting {0} AMRs with error to default AMR\n'.format(warnings)
-		
-		with open(restore_file,'w') as out_f:
-			for line in all_amrs:
-				out_f.write(line.strip()+'\n')
-		out_f.close()		
+		print 'Rewrote {0} AMRs with error to default AMR\n'.format(warnings)
 	else:
 		print '{0} AMRs with warning - no rewriting to default\n'.format(warnings)	
 	
+	PARSE_CACHE.close()
+	print PARSE_CACHE.stats() + '\n'
+	
 
-def add_wikification(in_file, sent_file):
+def add_wikification(in_file, sent_file, cache_file):
 	'''Function that adds wiki-links to produced AMRs'''
 	
 	wiki_file = in_file + '.wiki'
@@ -74,14 +76,14 @@ def add_wikification(in_file, sent_file):
 	if not os.path.isfile(wiki_file):	#check if wiki file doesn't exist already
 		wikify_file.wikify_file(in_file, sent_file)
 		
-		if len([x for x in open(sent_file,'r')]) != len([x for x in open(wiki_file,'r')]):
+		if len([x for x in open_file(sent_file,'r')]) != len([x for x in open_file(wiki_file,'r')]):
 			print 'Wikification failed for some reason (length {0} instead of {1})\n\tSave file as backup with wrong extension, no validating\n'
 			os.system('mv {0} {1}'.format(wiki_file, wiki_file.replace('.wiki','.failed_wiki')))
 			return wiki_file, False
 		
 		else:
 			print 'Validating Wikified AMRs...\n'
-			check_valid(wiki_file, True)
+			check_valid(wiki_file, True, cache_file, args.t, args.recover)
 		
 			return wiki_file, True
 	else:
@@ -89,21 +91,24 @@ def add_wikification(in_file, sent_file):
 		return wiki_file, True
 
 
-def add_coreference(in_file, ext):
+def add_coreference(in_file, ext, cache_file):
 	'''Function that adds coreference back for each concept that occurs more than once'''
 	
 	print 'Adding coreference...\n'
 	coref_file = in_file + ext
 	
 	if not os.path.isfile(coref_file):
-		os.system('python restore_duplicate_coref.py -f {0} -output_ext {1}'.format(in_file, ext))
+		coref_call = 'python restore_duplicate_coref.py -f {0} -output_ext {1}'.format(in_file, ext)
+		if cache_file:
+			coref_call += ' -parse_cache {0}'.format(cache_file)
+		os.system(coref_call)
 	else:
 		print 'Coref file already exists, skipping...'	
 		
 	return coref_file
 	
 
-def do_pruning(in_file):
+def do_pruning(in_file, cache_file):
 	'''Function that prunes duplicate output'''
 	
 	print 'Pruning...\n'
@@ -112,14 +117,14 @@ def do_pruning(in_file):
 	if not os.path.isfile(prune_file):
 		os.system('python prune_amrs.py -f {0}'.format(in_file))
 		print 'Validating pruned AMRs...\n'
-		check_valid(prune_file, True)
+		check_valid(prune_file, True, cache_file, args.t, args.recover)
 	else:
 		print 'Prune file already exists, skipping'	
 		
 	return prune_file
 
 
-def restore_amr(in_file, out_file, coref_type):
+def restore_amr(in_file, out_file, coref_type, cache_file):
 	'''Function that restores variables in output AMR'''
 	
 	print 'Restoring variables...'
@@ -134,7 +139,7 @@ def restore_amr(in_file, out_file, coref_type):
 		os.system(restore_call)
 		
 		print 'Validating restored AMRs...\n'					
-		check_valid(out_file, True)
+		check_valid(out_file, True, cache_file, args.t, args.recover)
 	else:
 		print 'Restore file already exists, skipping...'	
 	
@@ -151,25 +156,26 @@ def process_file(input_list):
 		sys.exit(0)
 	
 	if os.path.getsize(f) > 0: #check if file has content			
+		cache_file			= f + '.parse_cache' if args.parse_cache else None	#one cache file per input file, stages of a file run one after another
 		restore_file 		= f + '.restore'
-		restore_file 		= restore_amr(f, restore_file, args.c)
-		prune_file 			= do_pruning(restore_file)
+		restore_file 		= restore_amr(f, restore_file, args.c, cache_file)
+		prune_file 			= do_pruning(restore_file, cache_file)
 		
 		if args.c == 'dupl':	#coreference by duplication is done in separate script
-			coref_file 		= add_coreference(restore_file, '.coref')
+			coref_file 		= add_coreference(restore_file, '.coref', cache_file)
 		
 		if not args.no_wiki:	#sometimes we don't want to do Wikification because it takes time
-			wiki_file, success 	= add_wikification(restore_file, sent_file)
+			wiki_file, success 	= add_wikification(restore_file, sent_file, cache_file)
 			
 			#then add all postprocessing steps together, starting at the pruning
 		
 			print 'Do all postprocessing steps...\n'
 			 
-			wiki_file_pruned, success = add_wikification(prune_file, sent_file)
+			wiki_file_pruned, success = add_wikification(prune_file, sent_file, cache_file)
 			
 			if success:
 				if args.c == 'dupl':
-					coref_file_wiki_pruned 	  = add_coreference(wiki_file_pruned, '.coref.all')
+					coref_file_wiki_pruned 	  = add_coreference(wiki_file_pruned, '.coref.all', cache_file)
 				else:	#we already did coreference in restore file, still call the output-file .coref.all to not get confused in evaluation, just copy previous file
 					os.system("cp {0} {1}".format(wiki_file_pruned, wiki_file_pruned + '.coref.all'))	
 			else:
@@ -52,7 +52,7 @@ def prune_file(f):
 	
 	print 'First remove all variables...'
 	
-	for idx, line in enumerate(open(args.f,'r')):
+	for idx, line in enumerate(open_file(args.f,'r')):
 		clean_line = re.sub(r'\([A-Za-z0-9-_~]+ / ',r'(', line).strip()		#delete variables
 		
 		if clean_line.count(':') > 1:		#only try to do something if we can actually permutate					
@@ -671,7 +671,7 @@ if __name__ == '__main__':
 	global ggg
 	ggg = 0
 		
-	for idx, line in enumerate(open(args.f, 'r')):
+	for idx, line in enumerate(open_file(args.f, 'r')):
 		ggg += 1
 		
 		line = preprocess(line, args.abs)	#abs has separate preprocessing step as well
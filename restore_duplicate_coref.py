@@ -22,6 +22,7 @@ def create_arg_parser():
 	parser = argparse.ArgumentParser()
 	parser.add_argument("-f", required=True, type=str, help="File that contains amrs / sentences to be processed")
 	parser.add_argument("-output_ext", default = '.coref', required=False, type=str, help="Output extension of AMRs (default .coref)")
+	parser.add_argument("-parse_cache", default = '', type=str, help="File with cached parse results, so the same AMR is not validated twice (see amr_utils.ParseCache)")
 	args = parser.parse_args()
 	
 	return args
@@ -75,7 +76,7 @@ def process_file(f):
 
 	coref_amrs = []
 	
-	for indx, line in enumerate(open(f,'r')):
+	for indx, line in enumerate(open_file(f,'r')):
 		var_list = process_var_line(line, f)	#get list of variables and concepts
 		new_line = line
 		
@@ -101,5 +102,9 @@ def process_file(f):
 if __name__ == '__main__':
 	args = create_arg_parser()
 	
+	if args.parse_cache:
+		PARSE_CACHE.open(args.parse_cache)
 	coref_amrs = process_file(args.f)
+	PARSE_CACHE.close()
+	print PARSE_CACHE.stats()
 	write_to_file(coref_amrs, args.f + args.output_ext)
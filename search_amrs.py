@@ -0,0 +1,430 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+
+import os
+import json
+import time
+import sqlite3
+import argparse
+from array import array
+from itertools import izip
+from multiprocessing import Pool
+import numpy as np
+from amr import AMR, normalize_relation, var_free_to_penman
+from amr_utils import AMRIndex, open_file, read_amr_records
+
+'''Script that searches AMR files for AMRs that contain a pattern, e.g. a concept, a relation or a small subgraph
+
+   The first time, an inverted index of the files is built (an SQLite file, by default [first file].search). It maps
+   three kinds of keys to the (sorted) list of AMRs that contain them:
+
+   concept  : a concept, e.g. possible-01
+   relation : a relation, e.g. ARG1. Inverted relations are stored the other way around, as in smatch, so a search
+              for :ARG0-of also finds :ARG0 in the other direction
+   triple   : (parent concept, relation, child concept or constant), e.g. (possible-01, polarity, -)
+
+   A query is an AMR pattern, with or without variables. The concept * matches any concept. The posting lists of the
+   keys of the pattern are intersected, and each candidate AMR is parsed to check that the pattern really is a
+   subgraph of the AMR (e.g. that the :polarity - belongs to the same possible-01). If more than one pattern is given,
+   an AMR has to contain all of them.
+
+   The index is rebuilt automatically when one of the files changed. Files are in the format of the AMR releases, or
+   with -one_line have one AMR per line (the id of an AMR is then [file]:[line number]). With -var_free, the files have
+   one variable-free AMR per line (e.g. .tf files or model output), variables are added while reading them.
+
+   Usage:
+
+   python search_amrs.py -f silver.txt -q '(possible-01 :polarity -)'
+   python search_amrs.py -f dev.txt test.txt -q '(p / person :ARG0-of (h / have-org-role-91 :ARG2 (p2 / president)))' -show
+   python search_amrs.py -f train.txt -q '(* :ARG1-of (cause-01))' -max 10'''
+
+
+def create_arg_parser():
+	parser = argparse.ArgumentParser()
+	parser.add_argument("-f", required=True, nargs='+', type=str, help="AMR file(s) to search")
+	parser.add_argument("-q", default=[], nargs='+', type=str, help="AMR pattern(s) to search for, AMRs have to contain all of them")
+	parser.add_argument("-i", default='', type=str, help="Index file (default [first file].search)")
+	parser.add_argument("-one_line", action='store_true', help="Files have one AMR per line")
+	parser.add_argument("-var_free", action='store_true', help="Files have one variable-free AMR per line (e.g. .tf files)")
+	parser.add_argument("-build", action='store_true', help="Always build the index again")
+	parser.add_argument("-max", default=0, type=int, help="Stop after this number of results (default 0: all)")
+	parser.add_argument("-show", action='store_true', help="Also print the matching AMRs")
+	parser.add_argument("-t", default=1, type=int, help="Number of parallel processes to build the index (default 1)")
+	parser.add_argument("-chunk", default=1000, type=int, help="Number of AMRs sent to a worker at once (default 1000)")
+	parser.add_argument("-flush", default=10000000, type=int, help="Write the posting lists to disk after this number of postings (default 10M)")
+	args = parser.parse_args()
+
+	return args
+
+
+# prefixes of the three kinds of keys, the parts of a triple key are separated by tabs
+CONCEPT = 'c\t'
+RELATION = 'r\t'
+TRIPLE = 't\t'
+# concept of a pattern node that matches any concept
+WILDCARD = '*'
+
+
+def amr_graph(line):
+	'''Concepts (dict of node -> concept) and relations ((relation, node, node or constant) triples, inverted relations
+	   the other way around) of an AMR line, None if it can not be parsed. TOP is not a relation'''
+
+	try:
+		cur_amr = AMR.parse_AMR_line(line)
+	except Exception:
+		cur_amr = None
+	if cur_amr is None:
+		return None
+	instance_triples, relation_triples = cur_amr.get_triples2()
+	concepts = dict([(node, concept) for _, node, concept in instance_triples])
+	relations = [normalize_relation(relation, node1, node2) for relation, node1, node2 in relation_triples if relation != 'TOP']
+	return concepts, relations
+
+
+def graph_keys(concepts, relations):
+	'''Index keys of a graph (see amr_graph). Concepts and constants that are a wildcard do not give a key'''
+
+	keys = set([CONCEPT + concept for concept in concepts.values() if concept != WILDCARD])
+	for relation, node1, node2 in relations:
+		keys.add(RELATION + relation)
+		parent, child = concepts[node1], concepts.get(node2, node2)
+		if parent != WILDCARD and child != WILDCARD:
+			keys.add(TRIPLE + '\t'.join([parent, relation, child]))
+	return keys
+
+
+def keys_chunk(arg_list):
+	'''Sorted index keys of each AMR line of a chunk, None if the AMR can not be parsed'''
+
+	lines, var_free = arg_list
+	keys = []
+	for line in lines:
+		graph = amr_graph(var_free_to_penman(line) if var_free else line)
+		keys.append(None if graph is None else sorted(graph_keys(*graph)))
+	return keys
+
+
+def read_block(in_f, offset, length, one_line):
+	'''One-line AMR of the block (or line) at offset'''
+
+	in_f.seek(offset)
+	block = in_f.read(length)
+	if one_line:
+		return block.strip()
+	for record in read_amr_records(block.splitlines(True)):
+		return record.one_line()
+	return ''
+
+
+def iter_amrs(amr_files, one_line):
+	'''Generator that yields (id, file index, offset, length, AMR line) for each AMR of the files'''
+
+	for file_idx, amr_file in enumerate(amr_files):
+		if one_line:
+			offset = 0
+			with open_file(amr_file, 'rb') as in_f:
+				for line_idx, line in enumerate(in_f):
+					if line.strip():
+						yield '{0}:{1}'.format(amr_file, line_idx + 1), file_idx, offset, len(line), line.strip()
+					offset += len(line)
+		else:
+			entries = AMRIndex(amr_file).entries
+			with open_file(amr_file, 'rb') as in_f:
+				for amr_idx, (amr_id, offset, length, _, _) in enumerate(entries):
+					amr_id = amr_id.encode('utf-8') if amr_id else '{0}:{1}'.format(amr_file, amr_idx + 1)
+					yield amr_id, file_idx, offset, length, read_block(in_f, offset, length, one_line)
+
+
+def file_sources(amr_files, one_line, var_free):
+	return json.dumps({'files': [[os.path.abspath(f), os.path.getsize(f), os.path.getmtime(f)] for f in amr_files],
+					   'one_line': one_line, 'var_free': var_free})
+
+
+class SearchIndex(object):
+	'''Inverted index of AMR files in an SQLite file, with the tables
+
+	   amrs    : index, id, file index, byte offset and length of each AMR (parsed = 0 if it could not be parsed)
+	   postings: key, number of AMRs and the sorted AMR indexes (uint32, little-endian). Long posting lists are split
+	             over several rows (one per flush), in increasing order of rowid
+	   meta    : the files the index was built from'''
+
+	def __init__(self, index_file, amr_files, one_line=False, var_free=False):
+		self.index_file = index_file
+		self.amr_files = amr_files
+		self.one_line = one_line or var_free
+		self.var_free = var_free
+		self.conn = None
+
+	def up_to_date(self):
+		if not os.path.isfile(self.index_file):
+			return False
+		conn = sqlite3.connect(self.index_file)
+		conn.text_factory = str
+		try:
+			row = conn.execute("SELECT value FROM meta WHERE name = 'sources'").fetchone()
+		except sqlite3.DatabaseError:
+			row = None
+		conn.close()
+		return row is not None and row[0] == file_sources(self.amr_files, self.one_line, self.var_free)
+
+	def build(self, processes=1, chunk_size=1000, flush_size=10000000):
+		'''Parse all AMRs and write the index to a temporary file, that replaces the index file when it is done'''
+
+		temp_file = self.index_file + '.temp'
+		if os.path.isfile(temp_file):
+			os.remove(temp_file)
+		conn = sqlite3.connect(temp_file)
+		conn.text_factory = str
+		conn.execute('CREATE TABLE meta (name TEXT PRIMARY KEY, value TEXT)')
+		conn.execute('CREATE TABLE amrs (idx INTEGER PRIMARY KEY, id TEXT, file INTEGER, offset INTEGER, length INTEGER, parsed INTEGER)')
+		conn.execute('CREATE TABLE postings (key TEXT, count INTEGER, ids BLOB)')
+
+		postings = {}
+		num_postings = 0
+		items = []
+
+		def chunks():
+			chunk = []
+			for item in iter_amrs(self.amr_files, self.one_line):
+				items.append(item[:4])
+				chunk.append(item[4])
+				if len(chunk) == chunk_size:
+					yield chunk, self.var_free
+					chunk = []
+			if chunk:
+				yield chunk, self.var_free
+
+		def flush():
+			conn.executemany('INSERT INTO postings VALUES (?, ?, ?)',
+							 [(key, len(ids), buffer(np.frombuffer(ids, dtype=np.uint32).astype('<u4').tostring()))
+							  for key, ids in postings.iteritems()])
+			postings.clear()
+
+		if processes > 1:
+			pool = Pool(processes=processes)
+			results = pool.imap(keys_chunk, chunks())
+		else:
+			pool = None
+			results = (keys_chunk(chunk) for chunk in chunks())
+		amr_idx = 0
+		invalid = 0
+		for keys in results:
+			rows = []
+			#imap keeps the order, so the first len(keys) items belong to this chunk
+			chunk_items, items[:len(keys)] = items[:len(keys)], []
+			for (amr_id, file_idx, offset, length), amr_keys in izip(chunk_items, keys):
+				rows.append((amr_idx, amr_id, file_idx, offset, length, int(amr_keys is not None)))
+				if amr_keys is None:
+					invalid += 1
+				else:
+					for key in amr_keys:
+						if key not in postings:
+							postings[key] = array('I')
+						postings[key].append(amr_idx)
+					num_postings += len(amr_keys)
+				amr_idx += 1
+			conn.executemany('INSERT INTO amrs VALUES (?, ?, ?, ?, ?, ?)', rows)
+			if num_postings >= flush_size:
+				flush()
+				num_postings = 0
+		if pool is not None:
+			pool.close()
+			pool.join()
+		flush()
+		conn.execute('CREATE INDEX postings_key ON postings (key)')
+		conn.execute("INSERT INTO meta VALUES ('sources', ?)", (file_sources(self.amr_files, self.one_line, self.var_free),))
+		conn.commit()
+		conn.close()
+		os.rename(temp_file, self.index_file)
+		return amr_idx, invalid
+
+	def open(self):
+		self.conn = sqlite3.connect(self.index_file)
+		self.conn.text_factory = str
+
+	def close(self):
+		if self.conn is not None:
+			self.conn.close()
+			self.conn = None
+
+	def __len__(self):
+		return self.conn.execute('SELECT COUNT(*) FROM amrs').fetchone()[0]
+
+	def count(self, key):
+		return self.conn.execute('SELECT COALESCE(SUM(count), 0) FROM postings WHERE key = ?', (key,)).fetchone()[0]
+
+	def posting_list(self, key):
+		'''Sorted numpy array of the indexes of the AMRs that contain the key'''
+
+		parts = [np.frombuffer(ids, dtype='<u4') for ids, in
+				 self.conn.execute('SELECT ids FROM postings WHERE key = ? ORDER BY rowid', (key,))]
+		return np.concatenate(parts) if parts else np.zeros(0, dtype='<u4')
+
+	def candidates(self, keys):
+		'''Sorted numpy array of the indexes of the AMRs that contain all keys, None if there are no keys (all AMRs
+		   are candidates). Posting lists are intersected from short to long'''
+
+		if not keys:
+			return None
+		counts = sorted([(self.count(key), key) for key in keys])
+		result = self.posting_list(counts[0][1])
+		for _, key in counts[1:]:
+			if not len(result):
+				break
+			result = np.intersect1d(result, self.posting_list(key), assume_unique=True)
+		return result
+
+	def entries(self, amr_indexes):
+		'''Generator that yields (id, one-line AMR as in the file) for each AMR index (in increasing order)'''
+
+		files = [open_file(amr_file, 'rb') for amr_file in self.amr_files]
+		try:
+			for amr_idx in amr_indexes:
+				amr_id, file_idx, offset, length = self.conn.execute(
+					'SELECT id, file, offset, length FROM amrs WHERE idx = ?', (int(amr_idx),)).fetchone()
+				yield amr_id, read_block(files[file_idx], offset, length, self.one_line)
+		finally:
+			for in_f in files:
+				in_f.close()
+
+
+class Pattern(object):
+	'''AMR pattern to search for: a (connected) AMR, with or without variables, in which the concept * matches any
+	   concept'''
+
+	def __init__(self, text):
+		self.text = text
+		text = text.strip()
+		if not text.startswith('('):
+			text = '(' + text + ')'
+		graph = amr_graph(text if ' / ' in text else var_free_to_penman(text))
+		if graph is None:
+			raise ValueError('Pattern {0} is not a valid AMR'.format(self.text))
+		self.concepts, self.relations = graph
+		# match the nodes in breadth-first order from the root, so each node (after the first) is connected to a
+		# node that is already matched
+		neighbours = dict([(node, []) for node in self.concepts])
+		for relation, node1, node2 in self.relations:
+			if node2 in self.concepts:
+				neighbours[node1].append(node2)
+				neighbours[node2].append(node1)
+		self.order = []
+		for start in sorted(self.concepts, key=lambda node: self.concepts[node] == WILDCARD):
+			queue = [start]
+			while queue:
+				node = queue.pop(0)
+				if node not in self.order:
+					self.order.append(node)
+					queue.extend(neighbours[node])
+
+	def keys(self):
+		return graph_keys(self.concepts, self.relations)
+
+	def match(self, concepts, relations):
+		'''True if the pattern is a subgraph of the graph (see amr_graph), distinct pattern nodes match distinct nodes'''
+
+		outgoing, incoming, by_concept = {}, {}, {}
+		for relation, node1, node2 in relations:
+			outgoing.setdefault(node1, []).append((relation, node2))
+			incoming.setdefault(node2, []).append((relation, node1))
+		for node, concept in concepts.iteritems():
+			by_concept.setdefault(concept, []).append(node)
+		edges = set(relations)
+
+		def candidates(node, mapping):
+			for relation, node1, node2 in self.relations:
+				if node1 == node and node2 in mapping:
+					return [other for rel, other in incoming.get(mapping[node2], []) if rel == relation]
+				if node2 == node and node1 in mapping:
+					return [other for rel, other in outgoing.get(mapping[node1], []) if rel == relation]
+			return list(concepts) if self.concepts[node] == WILDCARD else by_concept.get(self.concepts[node], [])
+
+		def consistent(node, target, mapping):
+			if target not in concepts or self.concepts[node] not in [WILDCARD, concepts[target]]:
+				return False
+			for relation, node1, node2 in self.relations:
+				if node1 == node:
+					if node2 not in self.concepts:
+						value = node2
+					elif node2 == node:
+						value = target
+					elif node2 in mapping:
+						value = mapping[node2]
+					else:
+						continue
+					if value == WILDCARD:
+						if relation not in [rel for rel, _ in outgoing.get(target, [])]:
+							return False
+					elif (relation, target, value) not in edges:
+						return False
+				elif node2 == node and node1 in mapping and (relation, mapping[node1], target) not in edges:
+					return False
+			return True
+
+		def extend(pos, mapping, used):
+			if pos == len(self.order):
+				return True
+			node = self.order[pos]
+			for target in candidates(node, mapping):
+				if target not in used and consistent(node, target, mapping):
+					mapping[node] = target
+					used.add(target)
+					if extend(pos + 1, mapping, used):
+						return True
+					del mapping[node]
+					used.remove(target)
+			return False
+
+		return extend(0, {}, set())
+
+
+def search(index, patterns, candidates, max_results=0):
+	'''Generator that yields (id, one-line AMR) of the candidate AMRs that contain all patterns, in file order'''
+
+	found = 0
+	for amr_id, line in index.entries(candidates):
+		graph = amr_graph(var_free_to_penman(line) if index.var_free else line)
+		if graph is not None and all([pattern.match(*graph) for pattern in patterns]):
+			yield amr_id, line
+			found += 1
+			if found == max_results:
+				break
+
+
+def search_amrs(args):
+	index = SearchIndex(args.i or args.f[0] + '.search', args.f, args.one_line, args.var_free)
+	if args.build or not index.up_to_date():
+		start = time.time()
+		num_amrs, invalid = index.build(args.t, args.chunk, args.flush)
+		print 'Indexed {0} AMRs ({1} could not be parsed) in {2:.1f} seconds'.format(num_amrs, invalid, time.time() - start)
+	if not args.q:
+		return
+
+	try:
+		patterns = [Pattern(query) for query in args.q]
+	except ValueError, e:
+		raise SystemExit(str(e))
+	index.open()
+	try:
+		start = time.time()
+		keys = set()
+		for pattern in patterns:
+			keys.update(pattern.keys())
+		candidates = index.candidates(keys)
+		if candidates is None:
+			candidates = xrange(len(index))
+		num_results = 0
+		for amr_id, line in search(index, patterns, candidates, args.max):
+			num_results += 1
+			print amr_id
+			if args.show:
+				print line + '\n'
+		print '\n{0} results, {1} candidates in {2} AMRs, {3:.3f} seconds'.format(
+			num_results, len(candidates), len(index), time.time() - start)
+	finally:
+		index.close()
+
+
+if __name__ == '__main__':
+	args = create_arg_parser()
+	search_amrs(args)
@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+"""
+Batched (lockstep) hill-climbing for smatch.
+
+Most sentence-level AMR pairs are small (5-30 nodes), so the per-pair search in smatch_edited.py is dominated
+by interpreter overhead on dictionary lookups. This module packs many (AMR pair, restart) search problems into
+padded NumPy arrays and evaluates all move and swap gains of all problems at once. Problems that can not be
+improved any more drop out of the active batch.
+
+The search is the same as in smatch_edited.get_best_gain: moves are tried before swaps, both in index order, and
+the first largest strictly positive gain is applied. Starting from the same initial mapping, the batched search
+therefore ends in the same mapping and match number as the original one.
+
+"""
+
+import numpy as np
+
+
+# default number of search problems (AMR pair x restart) that are packed in one batch
+batch_size = 256
+
+# used to mask impossible moves/swaps in the gain matrices
+NO_GAIN = -(1 << 30)
+
+
+def pack_problem(candidate_mappings, weight_dict, instance_len):
+	"""
+	Convert the candidate pool of one AMR pair into dense arrays
+	Arguments:
+		candidate_mappings: candidate node match list (see smatch_edited.compute_pool)
+		weight_dict: weight dictionary (see smatch_edited.compute_pool)
+		instance_len: the number of nodes in AMR 2
+	Returns:
+		unary: (n1, n2) array with the instance/attribute triple match of each node pair
+		cand: (n1, n2) boolean array, True if the node pair is in the candidate pool
+		edges: (e, 5) array with one row (i, j, k, l, weight) per relation triple match between node pairs
+			   (i, j) and (k, l), stored once with i < k
+
+	"""
+	n1 = len(candidate_mappings)
+	unary = np.zeros((n1, instance_len), dtype=np.int32)
+	cand = np.zeros((n1, instance_len), dtype=bool)
+	for i, candidates in enumerate(candidate_mappings):
+		for j in candidates:
+			cand[i, j] = True
+	edges = []
+	for node_pair, weights in weight_dict.items():
+		for key, weight in weights.items():
+			if key == -1:
+				unary[node_pair] += weight
+			# both directions are stored in weight_dict, keep the one with the lowest node index first.
+			# Two node pairs with the same node in AMR 1 can never match at the same time, skip them.
+			elif key[0] > node_pair[0]:
+				edges.append((node_pair[0], node_pair[1], key[0], key[1], weight))
+	edges = np.array(edges, dtype=np.int32).reshape(-1, 5)
+	return unary, cand, edges
+
+
+class Batch(object):
+	"""
+	A set of search problems padded to the same size.
+	Nodes in AMR 1 map to a column in [0, n2) or to the extra "null" column n2 (no mapping, -1 in smatch_edited).
+
+	"""
+
+	def __init__(self, problems, mappings):
+		"""
+		problems: list of (unary, cand, edges) tuples as returned by pack_problem
+		mappings: list of initial node mappings, one for each problem
+
+		"""
+		self.size = len(problems)
+		self.n1 = max([p[0].shape[0] for p in problems])
+		self.n2 = max([p[0].shape[1] for p in problems])
+		self.null = self.n2
+		n_edges = max([p[2].shape[0] for p in problems] + [1])
+		cols = self.n2 + 1
+		self.unary = np.zeros((self.size, self.n1, cols), dtype=np.int32)
+		self.cand = np.zeros((self.size, self.n1, cols), dtype=bool)
+		self.edges = np.zeros((self.size, n_edges, 5), dtype=np.int32)
+		self.mapping = np.empty((self.size, self.n1), dtype=np.int32)
+		self.mapping.fill(self.null)
+		self.row_valid = np.zeros((self.size, self.n1), dtype=bool)
+		for b, (unary, cand, edges) in enumerate(problems):
+			p1, p2 = unary.shape
+			self.unary[b, :p1, :p2] = unary
+			self.cand[b, :p1, :p2] = cand
+			# padded edges have weight 0 and never change a score
+			self.edges[b, :edges.shape[0]] = edges
+			self.row_valid[b, :p1] = True
+			for i, m in enumerate(mappings[b]):
+				if m != -1:
+					self.mapping[b, i] = m
+		self.ids = np.arange(self.size)
+		self.match_num = self.compute_match()
+
+	def compute_match(self):
+		"""
+		Matching triple number of the current mapping of each problem (vectorized smatch_edited.compute_match)
+
+		"""
+		rows = np.arange(self.size)[:, None]
+		match_num = self.unary[rows, np.arange(self.n1)[None, :], self.mapping].sum(axis=1)
+		i, j, k, l, w = [self.edges[:, :, c] for c in range(5)]
+		active = (self.mapping[rows, i] == j) & (self.mapping[rows, k] == l)
+		return match_num + (w * active).sum(axis=1)
+
+	def keep(self, index):
+		"""
+		Only keep the problems in index (drop converged problems from the active batch)
+
+		"""
+		for name in ['unary', 'cand', 'edges', 'mapping', 'row_valid', 'ids', 'match_num']:
+			setattr(self, name, getattr(self, name)[index])
+		self.size = len(index)
+
+	def best_gain(self):
+		"""
+		Compute the gain of all moves and swaps of all problems at once
+		Returns:
+			gain: the largest gain of each problem
+			choice: index of the operation resulting in that gain. Moves (i -> j) come first, as i * (n2 + 1) + j,
+					followed by swaps (i <-> i2), as offset + i * n1 + i2
+
+		"""
+		size, n1, cols = self.size, self.n1, self.n2 + 1
+		rows = np.arange(size)[:, None]
+		mapping = self.mapping
+		i, j, k, l, w = [self.edges[:, :, c] for c in range(5)]
+		# which node pair of every relation triple match is part of the current mapping
+		first_on = mapping[rows, i] == j
+		second_on = mapping[rows, k] == l
+		# relational weight of every node pair given the (unchanged) mapping of all other nodes
+		flat_first = (rows * n1 + i) * cols + j
+		flat_second = (rows * n1 + k) * cols + l
+		length = size * n1 * cols
+		value = np.bincount(flat_first.ravel(), (w * second_on).ravel(), minlength=length) + \
+				np.bincount(flat_second.ravel(), (w * first_on).ravel(), minlength=length)
+		value = value.reshape(size, n1, cols).astype(np.int32) + self.unary
+		# value of the current node pair of each node
+		current = value[rows, np.arange(n1)[None, :], mapping]
+		# move gain: remap node i to an unmatched candidate node j
+		unmatched = np.ones((size, cols), dtype=bool)
+		unmatched[rows, mapping] = False
+		move = value - current[:, :, None]
+		move[~(self.cand & unmatched[:, None, :])] = NO_GAIN
+		# swap gain: node i and node i2 exchange their mapping
+		cross = value[rows[:, :, None], np.arange(n1)[None, :, None], mapping[:, None, :]]
+		swap = cross + cross.transpose(0, 2, 1) - current[:, :, None] - current[:, None, :]
+		# correct for relation triples between the two swapped nodes, which are counted wrong in value
+		mapped_i = mapping[rows, i]
+		mapped_k = mapping[rows, k]
+		correction = ((j == mapped_i) & (l == mapped_k)).astype(np.int32) \
+					 - ((j == mapped_k) & (l == mapped_k)) \
+					 - ((j == mapped_i) & (l == mapped_i)) \
+					 + ((j == mapped_k) & (l == mapped_i))
+		swap += np.bincount(((rows * n1 + i) * n1 + k).ravel(), (w * correction).ravel(),
+							minlength=size * n1 * n1).reshape(size, n1, n1).astype(np.int32)
+		# only swap i < i2, and only real nodes of AMR 1
+		upper = np.triu(np.ones((n1, n1), dtype=bool), 1)
+		swap[~(upper[None, :, :] & self.row_valid[:, :, None] & self.row_valid[:, None, :])] = NO_GAIN
+		gains = np.concatenate((move.reshape(size, -1), swap.reshape(size, -1)), axis=1)
+		# argmax returns the first occurrence, which is the operation the sequential search would choose
+		choice = gains.argmax(axis=1)
+		return gains[np.arange(size), choice], choice
+
+	def apply(self, gain, choice):
+		"""
+		Apply the chosen move or swap to every problem with a positive gain
+
+		"""
+		cols = self.n2 + 1
+		n_moves = self.n1 * cols
+		for b in np.nonzero(gain > 0)[0]:
+			c = choice[b]
+			if c < n_moves:
+				self.mapping[b, c // cols] = c % cols
+			else:
+				node1, node2 = divmod(c - n_moves, self.n1)
+				self.mapping[b, node1], self.mapping[b, node2] = self.mapping[b, node2], self.mapping[b, node1]
+		self.match_num = self.match_num + np.maximum(gain, 0)
+
+
+def hill_climb(problems, mappings, size=None):
+	"""
+	Hill-climb a list of search problems in lockstep until no move or swap gives a gain
+	Arguments:
+		problems: list of (unary, cand, edges) tuples as returned by pack_problem
+		mappings: list of initial node mappings, one for each problem
+		size: number of problems packed in one batch (Default: batch_size)
+	Returns:
+		list of (final mapping, matching triple number), in the order of problems
+
+	"""
+	if size is None:
+		size = batch_size
+	results = [None] * len(problems)
+	# group problems of similar size to keep padding low
+	order = sorted(range(len(problems)), key=lambda x: problems[x][0].shape)
+	for start in range(0, len(order), size):
+		chunk = order[start:start + size]
+		batch = Batch([problems[x] for x in chunk], [mappings[x] for x in chunk])
+		while batch.size > 0:
+			gain, choice = batch.best_gain()
+			batch.apply(gain, choice)
+			done = gain <= 0
+			for b in np.nonzero(done)[0]:
+				idx = chunk[batch.ids[b]]
+				n1 = problems[idx][0].shape[0]
+				mapping = [int(m) if m != batch.null else -1 for m in batch.mapping[b, :n1]]
+				results[idx] = (mapping, int(batch.match_num[b]))
+			if done.any():
+				batch.keep(np.nonzero(~done)[0])
+	return results
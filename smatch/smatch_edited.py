@@ -12,6 +12,7 @@ import sys
 import os
 sys.path.insert(1, os.path.join(sys.path[0], '..')) #import amr from previous folder
 import amr
+from amr_utils import open_file
 import random
 import time
 
@@ -38,6 +39,10 @@ ERROR_LOG = sys.stderr
 # Debug log location
 DEBUG_LOG = sys.stderr
 
+# fine-grained sub-scores that can be computed from the best node mapping (--sub_scores)
+sub_score_names = ["concepts", "named_entities", "negation", "wikification", "reentrancies", "srl", "unlabeled"]
+relation_categories = ["reentrancies", "srl", "unlabeled"]
+
 # dictionary to save pre-computed node mapping and its resulting triple match count
 # key: tuples of node mapping
 # value: the matching triple count
@@ -54,7 +59,7 @@ def get_amr_line(input_f):
 	cur_amr = []
 	has_content = False
 
-	for line in open(input_f,'r'):
+	for line in open_file(input_f,'r'):
 		line = line.strip()
 		if line == "":
 			if not has_content:
@@ -97,9 +102,17 @@ def build_arg_parser():
 	parser.add_argument('--pr', action='store_true', default=False,
 						help="Output precision and recall as well as the f-score. Default: false")
 	parser.add_argument('--one_line', default = 'prod', choices = ['no', 'prod','gold','both'], type=str, help="If the input is in one-line format (default prod)")
+	parser.add_argument('--var_free', default='no', choices=['no', 'prod', 'gold', 'both'], type=str,
+						help="If the input is variable-free (e.g. .tf or char-level model output), variables are added while reading (default no)")
 	parser.add_argument('--justinstance', action='store_true', default=False, help="just pay attention to matching instances")
 	parser.add_argument('--justattribute', action='store_true', default=False, help="just pay attention to matching attributes")
 	parser.add_argument('--justrelation', action='store_true', default=False, help="just pay attention to matching relations")
+	parser.add_argument('--sub_scores', nargs='*', choices=sub_score_names, default=None,
+						help="Also output fine-grained scores computed from the best mapping. Without values, all of: "
+							 + ", ".join(sub_score_names))
+	parser.add_argument('--batch', action='store_true', default=False,
+						help="Hill-climb all AMR pairs in lockstep with numpy, much faster for many small AMRs (Default: false)")
+	parser.add_argument('--batch_size', type=int, default=256, help="Number of AMR pair restarts per batch (Default: 256)")
 
 	return parser
 
@@ -123,10 +136,19 @@ def build_arg_parser2():
 						   'a single document-level smatch score (Default: False)')
 	parser.add_option('--pr', "--precision_recall", action='store_true', dest="pr",
 					  help="Output precision and recall as well as the f-score. Default: false")
-	parser.add_argument('--one_line', default = 'prod', choices = ['no', 'prod','gold','both'], type=str, help="If the input is in one-line format (default prod)")
+	parser.add_option('--one_line', default='prod', type="choice", choices=['no', 'prod', 'gold', 'both'],
+					  help="If the input is in one-line format (default prod)")
+	parser.add_option('--var_free', default='no', type="choice", choices=['no', 'prod', 'gold', 'both'],
+					  help="If the input is variable-free (e.g. .tf or char-level model output), variables are added while reading (default no)")
 	parser.add_option('--justinstance', action='store_true', default=False, help="just pay attention to matching instances")
 	parser.add_option('--justattribute', action='store_true', default=False, help="just pay attention to matching attributes")
 	parser.add_option('--justrelation', action='store_true', default=False, help="just pay attention to matching relations")
+	parser.add_option('--sub_scores', type="string", default=None,
+					  help="Also output fine-grained scores computed from the best mapping, comma-separated names or "
+						   "'all' for all of: " + ", ".join(sub_score_names))
+	parser.add_option('--batch', action='store_true', default=False,
+					  help="Hill-climb all AMR pairs in lockstep with numpy, much faster for many small AMRs (Default: false)")
+	parser.add_option('--batch_size', type="int", default=256, help="Number of AMR pair restarts per batch (Default: 256)")
 	parser.set_defaults(r=4, v=False, ms=False, pr=False)
 	return parser
 
@@ -201,6 +223,121 @@ def get_best_match(instance1, attribute1, relation1,
 			best_match_num = match_num
 	return best_mapping, best_match_num
 
+
+def get_best_match_batch(triple_list, prefix1, prefix2, doinstance=True, doattribute=True, dorelation=True):
+	"""
+	Get the best node mapping for many AMR pairs at once, hill-climbing all pairs and restarts in lockstep
+	(see smatch_batch.py). Needs numpy.
+	Arguments:
+		triple_list: list of (instance1, attribute1, relation1, instance2, attribute2, relation2) tuples, one per AMR pair
+		prefix1: prefix label for AMR 1
+		prefix2: prefix label for AMR 2
+	Returns:
+		list of (best_mapping, best_match_num), one per AMR pair
+
+	"""
+	import smatch_batch
+	problems = []
+	init_mappings = []
+	owners = []
+	for pair_num, (instance1, attribute1, relation1, instance2, attribute2, relation2) in enumerate(triple_list):
+		(candidate_mappings, weight_dict) = compute_pool(instance1, attribute1, relation1,
+														 instance2, attribute2, relation2,
+														 prefix1, prefix2, doinstance=doinstance, doattribute=doattribute, dorelation=dorelation)
+		problem = smatch_batch.pack_problem(candidate_mappings, weight_dict, len(instance2))
+		for i in range(0, iteration_num):
+			if i == 0:
+				init_mappings.append(smart_init_mapping(candidate_mappings, instance1, instance2))
+			else:
+				init_mappings.append(random_init_mapping(candidate_mappings))
+			problems.append(problem)
+			owners.append(pair_num)
+	results = [([-1] * len(triples[0]), 0) for triples in triple_list]
+	# keep the first restart with the highest match number, as get_best_match does
+	for pair_num, (mapping, match_num) in zip(owners, smatch_batch.hill_climb(problems, init_mappings)):
+		if match_num > results[pair_num][1]:
+			results[pair_num] = (mapping, match_num)
+	return results
+
+def get_amr_triples(cur_amr, prefix, var_free=False):
+	"""
+	Parse a one-line AMR and get its triples, with nodes renamed to prefix + node index
+	Arguments:
+		cur_amr: AMR in one-line format
+		prefix: prefix label for the nodes
+		var_free: the AMR is variable-free (see amr.var_free_to_penman)
+	Returns:
+		(instance, attribute, relation) triples, or None if the AMR can not be parsed
+
+	"""
+	if var_free:
+		cur = amr.AMR.parse_var_free_line(cur_amr)
+	else:
+		cur = amr.AMR.parse_AMR_line(cur_amr)
+	if cur is None:
+		return None
+	cur.rename_node(prefix)
+	return cur.get_triples()
+
+
+def get_amr_match(cur_amr1, cur_amr2, doinstance=True, doattribute=True, dorelation=True, var_free=False):
+	"""
+	Compute the smatch triple numbers of a single AMR pair (for use of smatch from other scripts)
+	Arguments:
+		cur_amr1: AMR 1 in one-line format
+		cur_amr2: AMR 2 in one-line format
+		var_free: the AMRs are variable-free
+	Returns:
+		best_match_num, test_triple_num, gold_triple_num (or None if one of the AMRs can not be parsed)
+
+	"""
+	return get_amr_match_batch([(cur_amr1, cur_amr2)], doinstance=doinstance, doattribute=doattribute,
+								dorelation=dorelation, var_free=var_free, batch=False)[0]
+
+
+def get_amr_match_batch(amr_pairs, doinstance=True, doattribute=True, dorelation=True, var_free=False, batch=True):
+	"""
+	Compute the smatch triple numbers of a list of AMR pairs, using the batched search (needs numpy) if batch is True
+	Arguments:
+		amr_pairs: list of (AMR 1, AMR 2) in one-line format
+		var_free: the AMRs are variable-free
+		batch: hill-climb all pairs in lockstep (see smatch_batch.py)
+	Returns:
+		list of (best_match_num, test_triple_num, gold_triple_num), None for pairs that can not be parsed
+
+	"""
+	prefix1 = "a"
+	prefix2 = "b"
+	triple_list = []
+	parsed = []
+	for cur_amr1, cur_amr2 in amr_pairs:
+		triples1 = get_amr_triples(cur_amr1, prefix1, var_free)
+		triples2 = get_amr_triples(cur_amr2, prefix2, var_free)
+		if triples1 is None or triples2 is None:
+			parsed.append(False)
+		else:
+			parsed.append(True)
+			triple_list.append(triples1 + triples2)
+	if batch:
+		best_matches = get_best_match_batch(triple_list, prefix1, prefix2, doinstance=doinstance,
+											 doattribute=doattribute, dorelation=dorelation)
+	else:
+		best_matches = []
+		for triples in triple_list:
+			best_matches.append(get_best_match(*(triples + (prefix1, prefix2)), doinstance=doinstance,
+												doattribute=doattribute, dorelation=dorelation))
+			match_triple_dict.clear()
+	results = []
+	for (instance1, attribute1, relation1, instance2, attribute2, relation2), (best_mapping, best_match_num) in \
+			zip(triple_list, best_matches):
+		# only count the triple types that are compared
+		test_triple_num = doinstance * len(instance1) + doattribute * len(attribute1) + dorelation * len(relation1)
+		gold_triple_num = doinstance * len(instance2) + doattribute * len(attribute2) + dorelation * len(relation2)
+		results.append((best_match_num, test_triple_num, gold_triple_num))
+	results.reverse()
+	return [results.pop() if ok else None for ok in parsed]
+
+
 def normalize(item):
 	"""
 	lowercase and remove quote signifiers from items that are about to be compared
@@ -685,6 +822,90 @@ def get_best_gain(mapping, candidate_mappings, weight_dict, instance_len, cur_ma
 	return largest_gain, cur_mapping
 
 
+def category_triples(instance, attribute, relation):
+	"""
+	Split the triples of one AMR into the fine-grained categories of sub_score_names
+	Arguments:
+		instance: instance triples of the AMR
+		attribute: attribute triples of the AMR
+		relation: relation triples of the AMR
+	Returns:
+		dictionary with a list of triples for each category
+
+	"""
+	categories = dict([(name, []) for name in sub_score_names])
+	# nodes that are the head of a named entity, e.g. (c / country :name (n / name ...))
+	named_nodes = set([r[1] for r in relation if normalize(r[0]) == "name"])
+	incoming = {}
+	for r in relation:
+		incoming[r[2]] = incoming.get(r[2], 0) + 1
+	for t in instance:
+		categories["concepts"].append(t)
+		if t[1] in named_nodes:
+			categories["named_entities"].append(t)
+	for t in attribute:
+		if normalize(t[0]) == "polarity":
+			categories["negation"].append(t)
+		elif normalize(t[0]) == "wiki":
+			categories["wikification"].append(t)
+	for t in relation:
+		# unlabeled: only the two nodes need to match
+		categories["unlabeled"].append(("", t[1], t[2]))
+		if incoming[t[2]] > 1:
+			categories["reentrancies"].append(t)
+		if normalize(t[0]).startswith("arg"):
+			categories["srl"].append(t)
+	return categories
+
+
+def compute_sub_scores(mapping, instance1, attribute1, relation1, instance2, attribute2, relation2,
+					   prefix1, prefix2, names=None):
+	"""
+	Count the matching triples of each fine-grained category, given the best node mapping found by get_best_match
+	(the mapping search is not done again)
+	Arguments:
+		mapping: best node mapping between AMR 1 and AMR 2
+		instance1, attribute1, relation1: triples of AMR 1
+		instance2, attribute2, relation2: triples of AMR 2
+		prefix1: prefix label for AMR 1
+		prefix2: prefix label for AMR 2
+		names: categories to compute (Default: all of sub_score_names)
+	Returns:
+		dictionary with [match number, triple number of AMR 1, triple number of AMR 2] for each category
+
+	"""
+	if names is None:
+		names = sub_score_names
+	# node name in AMR 1 -> node name in AMR 2 it maps to
+	node_map = {}
+	for i, m in enumerate(mapping):
+		if m != -1:
+			node_map[prefix1 + str(i)] = prefix2 + str(m)
+	categories1 = category_triples(instance1, attribute1, relation1)
+	categories2 = category_triples(instance2, attribute2, relation2)
+	scores = {}
+	for name in names:
+		# relation categories link two nodes, the others link a node to a concept or constant
+		if name in relation_categories:
+			gold = set([(normalize(t[0]), t[1], t[2]) for t in categories2[name]])
+		else:
+			gold = set([(normalize(t[0]), t[1], normalize(t[2])) for t in categories2[name]])
+		match_num = 0
+		for t in categories1[name]:
+			if t[1] not in node_map:
+				continue
+			if name in relation_categories:
+				if t[2] not in node_map:
+					continue
+				mapped_triple = (normalize(t[0]), node_map[t[1]], node_map[t[2]])
+			else:
+				mapped_triple = (normalize(t[0]), node_map[t[1]], normalize(t[2]))
+			if mapped_triple in gold:
+				match_num += 1
+		scores[name] = [match_num, len(categories1[name]), len(categories2[name])]
+	return scores
+
+
 def print_alignment(mapping, instance1, instance2):
 	"""
 	print the alignment based on a node mapping
@@ -755,6 +976,9 @@ def main(arguments):
 		veryVerbose = True
 	if arguments.pr:
 		pr_flag = True
+	if arguments.batch:
+		import smatch_batch
+		smatch_batch.batch_size = arguments.batch_size
 	# optionally turn off some of the node comparison
 	doinstance=True
 	doattribute=True
@@ -778,13 +1002,18 @@ def main(arguments):
 	sent_num = 1
 	# significant digits to print out
 	floatdisplay = "%%.%df" % arguments.significant
+	# fine-grained categories requested, and their [match, test, gold] numbers over all AMR pairs
+	sub_scores = None
+	if arguments.sub_scores is not None:
+		sub_scores = arguments.sub_scores if arguments.sub_scores else sub_score_names
+	total_sub_scores = dict([(name, [0, 0, 0]) for name in sub_scores or []])
 	# Read amr pairs from two files
 	
 	if args.one_line == 'both':
-		prod_amrs = [x.strip() for x in open(args.f[0],'r')]
-		gold_amrs = [x.strip() for x in open(args.f[1],'r')]
+		prod_amrs = [x.strip() for x in open_file(args.f[0],'r')]
+		gold_amrs = [x.strip() for x in open_file(args.f[1],'r')]
 	elif args.one_line == 'prod':
-		prod_amrs = [x.strip() for x in open(args.f[0],'r')]    
+		prod_amrs = [x.strip() for x in open_file(args.f[0],'r')]    
 		gold_amrs = get_amr_line(args.f[1])
 	elif args.one_line == 'gold':
 		prod_amrs = get_amr_line(args.f[0])
@@ -803,21 +1032,36 @@ def main(arguments):
 		print >> ERROR_LOG, "Error: File 2 has less AMRs than file 1"
 		raise ValueError
 	
+	prefix1 = "a"
+	prefix2 = "b"
+	# variable-free AMRs get their variables while parsing, no restoring step needed
+	parse_prod = amr.AMR.parse_AMR_line
+	parse_gold = amr.AMR.parse_AMR_line
+	if args.var_free in ['prod', 'both']:
+		parse_prod = amr.AMR.parse_var_free_line
+	if args.var_free in ['gold', 'both']:
+		parse_gold = amr.AMR.parse_var_free_line
+	triple_list = []
 	for idx in range(len(gold_amrs)):
-		cur_amr1 = prod_amrs[idx]
-		cur_amr2 = gold_amrs[idx]
-
-		amr1 = amr.AMR.parse_AMR_line(cur_amr1)
-		amr2 = amr.AMR.parse_AMR_line(cur_amr2)
-		
-		prefix1 = "a"
-		prefix2 = "b"
+		amr1 = parse_prod(prod_amrs[idx])
+		amr2 = parse_gold(gold_amrs[idx])
 		# Rename node to "a1", "a2", .etc
 		amr1.rename_node(prefix1)
 		# Renaming node to "b1", "b2", .etc
 		amr2.rename_node(prefix2)
 		(instance1, attributes1, relation1) = amr1.get_triples()
 		(instance2, attributes2, relation2) = amr2.get_triples()
+		triple_list.append((instance1, attributes1, relation1, instance2, attributes2, relation2))
+	
+	if arguments.batch:
+		# search the best mapping of all pairs at once
+		best_matches = get_best_match_batch(triple_list, prefix1, prefix2, doinstance=doinstance,
+											 doattribute=doattribute, dorelation=dorelation)
+	
+	for idx in range(len(gold_amrs)):
+		cur_amr1 = prod_amrs[idx]
+		cur_amr2 = gold_amrs[idx]
+		(instance1, attributes1, relation1, instance2, attributes2, relation2) = triple_list[idx]
 		
 		if verbose:
 			# print parse results of two AMRs
@@ -837,9 +1081,12 @@ def main(arguments):
 			print >> DEBUG_LOG, attributes2
 			print >> DEBUG_LOG, "Relation triples of AMR 2:", len(relation2)
 			print >> DEBUG_LOG, relation2
-		(best_mapping, best_match_num) = get_best_match(instance1, attributes1, relation1,
-														instance2, attributes2, relation2,
-														prefix1, prefix2, doinstance=doinstance, doattribute=doattribute, dorelation=dorelation)
+		if arguments.batch:
+			(best_mapping, best_match_num) = best_matches[idx]
+		else:
+			(best_mapping, best_match_num) = get_best_match(instance1, attributes1, relation1,
+															instance2, attributes2, relation2,
+															prefix1, prefix2, doinstance=doinstance, doattribute=doattribute, dorelation=dorelation)
 		if verbose:
 			print >> DEBUG_LOG, "best match number", best_match_num
 			print >> DEBUG_LOG, "best node mapping", best_mapping
@@ -869,6 +1116,13 @@ def main(arguments):
 		total_match_num += best_match_num
 		total_test_num += test_triple_num
 		total_gold_num += gold_triple_num
+		if sub_scores:
+			# reuse the best mapping, no new mapping search is done
+			pair_sub_scores = compute_sub_scores(best_mapping, instance1, attributes1, relation1,
+												 instance2, attributes2, relation2, prefix1, prefix2, sub_scores)
+			for name in sub_scores:
+				for i in range(3):
+					total_sub_scores[name][i] += pair_sub_scores[name][i]
 		# clear the matching triple dictionary for the next AMR pair
 		match_triple_dict.clear()
 		sent_num += 1
@@ -889,6 +1143,12 @@ def main(arguments):
 			print "Recall: "+floatdisplay % recall
 		print 'Total AMRs: {0}'.format(len(gold_amrs))
 		print "Document F-score: "+floatdisplay % best_f_score
+	
+	if sub_scores:
+		print "Fine-grained scores (precision, recall, f-score):"
+		for name in sub_scores:
+			(precision, recall, f_score) = compute_f(*total_sub_scores[name])
+			print "{0}: {1} {2} {3}".format(name, floatdisplay % precision, floatdisplay % recall, floatdisplay % f_score)
 		
 		
 
@@ -909,7 +1169,12 @@ if __name__ == "__main__":
 			exit(1)
 		parser = build_arg_parser2()
 		(args, opts) = parser.parse_args()
-		file_handle = []
+		# optparse options take one value, --sub_scores is a comma-separated list as argparse gives it
+		if args.sub_scores is not None:
+			args.sub_scores = [] if args.sub_scores == 'all' else args.sub_scores.split(',')
+			for name in args.sub_scores:
+				if name not in sub_score_names:
+					parser.error("invalid sub-score: %s (choose from %s)" % (name, ", ".join(sub_score_names)))
 		if args.f is None:
 			print >> ERROR_LOG, "smatch.py requires -f option to indicate two files \
 								 containing AMR as input. Please run smatch.py -h to  \
@@ -921,9 +1186,6 @@ if __name__ == "__main__":
 			if not os.path.exists(file_path):
 				print >> ERROR_LOG, "Given file", args.f[0], "does not exist"
 				exit(1)
-			file_handle.append(open(file_path))
-		# use opened files
-		args.f = tuple(file_handle)
 	#  use argparse if python version is 2.7 or later
 	else:
 		import argparse
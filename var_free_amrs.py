@@ -4,7 +4,9 @@ from __future__ import absolute_import, division, print_function
 from builtins import *
 import argparse
 import re
-import spacy
+from collections import OrderedDict, deque
+from itertools import islice
+from multiprocessing import Pool, current_process
 from amr_utils import *
 
 '''Script that removes variables from AMR by duplicating the information, possibly deletes wiki-links
@@ -47,66 +49,57 @@ def create_args_parser():
     parser.add_argument('--no_semantics', action='store_true', help='Remove all semantics identifier from the AMR concept nodes.')
     parser.add_argument('--filter_summary', action='store_true', help='Filter out non-summary in Proxy Report dataset of pre-training.')
     parser.add_argument('--custom_parentheses', action='store_true', help='Add extra space after all parentheses and remove beginning and ending parentheses.')
+    parser.add_argument('--graph', action='store_true', help='Parse each AMR once and serialize the transformed graph, instead of the regex passes over the text.')
+    parser.add_argument('-body_ref', action='store_true', help='With --with_side, write the body of each document once, with .ids files that link the summary lines to it.')
+    parser.add_argument('-body_max_tokens', default=0, type=int, help='With --with_side, only keep the first body AMRs of a document that have at most this many tokens in total (default 0, no limit)')
+    parser.add_argument('-procs', default=1, type=int, help='Number of processes that convert the AMRs: the files of -f with -is_dir, otherwise chunks of -chunk AMRs. They also tokenize the sentences (default 1)')
+    parser.add_argument('-chunk', default=1000, type=int, help='Number of AMRs sent to a process at once (default 1000)')
+    parser.add_argument('-shard_size', default=0, type=int, help='Write the .tf and .sent files in shards of this many AMRs, with a manifest JSON file (default 0, no shards)')
+    parser.add_argument('-compress', default=None, choices=['gzip', 'bz2', 'xz'], help='Compress the .tf and .sent files (default no compression)')
+    parser.add_argument('-tok_model', default='en_core_web_sm', help='spaCy model of the tokenizer (default en_core_web_sm)')
+    parser.add_argument('-tok_batch', default=1000, type=int, help='Number of sentences that are tokenized at once (default 1000)')
+    parser.add_argument('-tok_procs', default=1, type=int, help='Number of processes for tokenization (default 1)')
+    parser.add_argument('-tok_cache', default='', help='Cache file for tokenized sentences, shared between runs (default no cache)')
+    parser.add_argument('-tok_cache_size', default=1000000, type=int, help='Maximum number of sentences in the cache (default 1M)')
     args = parser.parse_args()
 
     return args
 
 
-def single_line_convert(lines, filter_str=None):
-    '''Convert AMRs to a single line, ignoring lines that start with "# ::"'''
+def single_line_record(record):
+    '''Return the AMR of a record as a single line and its sentence (::snt or ::tok). As before, wiki links and
+       double whitespace are removed from the sentence line like from the AMR lines (see remove_wiki)'''
+
+    assert record.sentence is not None  # sanity check
+    return record.one_line(), remove_wiki(record.sentence).strip()
+
+
+def single_line_convert(records):
+    '''Convert the AMRs of the records to a single line, also return their sentences (::snt or ::tok)'''
 
     all_amrs = []
-    cur_amr = []
     sents = []
-    skip = False
-    for line in lines:
-        if line.startswith('# AMR'):
-            continue
-        if '::snt-type ' in line and filter_str:
-            if '::snt-type ' + filter_str in line:
-                skip = False
-            else:
-                skip = True
-        if not skip:
-            if not line.strip() and cur_amr:
-                cur_amr_line = " ".join(cur_amr)
-                all_amrs.append(cur_amr_line.strip())
-                cur_amr = []
-            elif line.startswith('# ::snt') or line.startswith('# ::tok'):  # match sentence
-                sent = re.sub('(^# ::(tok|snt))', '', line).strip()  # remove # ::snt or # ::tok
-                sents.append(sent)
-            elif not line.startswith('#'):
-                cur_amr.append(line.strip())
-        if not line.strip():
-            skip = False
-    if cur_amr:  # file did not end with newline, so add AMR here
-        all_amrs.append(" ".join(cur_amr).strip())
-    assert (len(all_amrs) == len(sents))  # sanity check
-
+    for record in records:
+        single_amr, sent = single_line_record(record)
+        all_amrs.append(single_amr)
+        sents.append(sent)
     return all_amrs, sents
 
 
-def delete_wiki(f, filter_str=None):
-    '''Delete wiki links from AMRs'''
+def remove_wiki(line):
+    '''Delete wiki links from an AMR line'''
+
+    n_line = re.sub(r':wiki "(.*?)"', '', line, 1)
+    n_line = re.sub(':wiki -', '', n_line)
+    return (len(n_line) - len(n_line.lstrip())) * ' ' + ' '.join(
+        n_line.split())  # convert double whitespace but keep leading whitespace
 
-    no_wiki = []
-    skip = False
-    for line in codecs.open(f, 'r', 'utf-8'):
-        if line.startswith('# AMR'):
-            continue
-        if '::snt-type ' in line and filter_str:
-            if '::snt-type ' + filter_str in line:
-                skip = False
-            else:
-                skip = True
-        if not skip:
-            n_line = re.sub(r':wiki "(.*?)"', '', line, 1)
-            n_line = re.sub(':wiki -', '', n_line)
-            no_wiki.append((len(n_line) - len(n_line.lstrip())) * ' ' + ' '.join(
-                n_line.split()))  # convert double whitespace but keep leading whitespace
-        if not line.strip():
-            skip = False
-    return no_wiki
+
+def delete_wiki(records):
+    '''Generator that deletes wiki links from the AMRs of the records'''
+
+    for record in records:
+        yield record._replace(lines=[remove_wiki(line) for line in record.lines])
 
 
 def process_var_line(line, var_dict):
@@ -146,22 +139,16 @@ def process_var_line(line, var_dict):
     return deleted_var_string, var_dict
 
 
-def delete_amr_variables(amrs, filter_str=None):
-    '''Function that deletes variables from AMRs'''
+def delete_amr_variables(records, var_dict=None):
+    '''Generator that deletes variables from the AMRs of the records. The values of the variables are kept
+       over all AMRs, starting with the values of var_dict if given'''
 
-    var_dict = dict()
-    del_amr = []
-    skip = False
-    for line in amrs:
-        if line.startswith('# AMR'):
-            continue
-        if '::snt-type ' in line and filter_str:
-            if '::snt-type ' + filter_str in line:
-                skip = False
-            else:
-                skip = True
-        if not skip:
-            if line.strip() and line[0] != '#':
+    if var_dict is None:
+        var_dict = dict()
+    for record in records:
+        del_amr = []
+        for line in record.lines:
+            if line.strip():
                 if '/' in line:  # variable here
                     deleted_var_string, var_dict = process_var_line(line, var_dict)  # process line and save variables
                     del_amr.append(deleted_var_string)  # save string with variables deleted
@@ -180,139 +167,456 @@ def delete_amr_variables(amrs, filter_str=None):
                         del_amr.append(
                             line)  # no reference found, add line without editing (usually there are numbers in this line)
             else:
-                del_amr.append(line)  # line with other info, just add
-        if not line.strip():
-            skip = False
-    return del_amr
+                del_amr.append(line)  # empty line, just add
+        yield record._replace(lines=del_amr)
+
+
+def post_process_amr(args, line):
+    '''Apply the output-format options (parentheses, senses) to a single-line AMR'''
+
+    new_line = line
+    if args.no_parentheses:
+        new_line = re.sub(r'\(', '', new_line)
+        new_line = re.sub(r'\)', '', new_line)
+    else:
+        if args.custom_parentheses:
+            new_line = re.sub(r'\s\(', ' ( ', line)
+            new_line = re.sub(r'^\(', '', new_line)
+
+            new_line = re.sub(r'\)\s?', ' ) ', new_line)
+            new_line = re.sub(r'\)\s$', '', new_line)
+            new_line = re.sub(r'\s+', ' ', new_line)
+    if args.no_semantics:
+        new_line = re.sub(r'-[09]\d\s', ' ', new_line)
+    return new_line
 
 
 def post_process_line(args, single_amrs):
-    new_lines = []
-    for line in single_amrs:
-        new_line = line
-        if args.no_parentheses:
-            new_line = re.sub(r'\(', '', new_line)
-            new_line = re.sub(r'\)', '', new_line)
-        else:
-            if args.custom_parentheses:
-                new_line = re.sub(r'\s\(', ' ( ', line)
-                new_line = re.sub(r'^\(', '', new_line)
+    return [post_process_amr(args, line) for line in single_amrs]
+
+
+def serialize_graph(line, args):
+    '''Parse an AMR line once, transform the graph and serialize it to a single line, None if it can not be parsed'''
+
+    amr = AMR.parse_AMR_line(line.encode('utf-8'), keep_tree=True)
+    if amr is None:
+        return None
+    amr.delete_wiki()
+    if args.no_semantics:
+        amr.delete_senses()
+    if args.delete_amr_var:
+        amr.duplicate_reentrancies()
+    if args.custom_parentheses and not args.no_parentheses:
+        new_line = ' '.join(amr.get_tokens(not args.delete_amr_var)[1:-1])
+    else:
+        new_line = amr.to_penman(not args.delete_amr_var, not args.no_parentheses)
+    return new_line.decode('utf-8')
+
 
-                new_line = re.sub(r'\)\s?', ' ) ', new_line)
-                new_line = re.sub(r'\)\s$', '', new_line)
-                new_line = re.sub(r'\s+', ' ', new_line)
-        if args.no_semantics:
-            new_line = re.sub(r'-[09]\d\s', ' ', new_line)
-        new_lines.append(new_line)
-    return new_lines
+def serialize_graphs(records, args):
+    '''Generator that replaces the AMR of each record by its serialized graph (see serialize_graph). AMRs that can
+       not be parsed are converted with the string operations instead'''
+
+    for record in records:
+        new_line = serialize_graph(record.one_line(), args)
+        if new_line is None:
+            fallback = delete_wiki([record])
+            if args.delete_amr_var:
+                fallback = delete_amr_variables(fallback)
+            new_line = post_process_amr(args, single_line_record(next(fallback))[0])
+        yield record._replace(lines=[new_line])
+
+
+def convert_records(records, args, var_dict=None):
+    '''Generator that yields the output AMR line and sentence of each record. All steps (wiki removal, variable
+       handling, linearization and the output-format options) are done for one AMR before the next one is read.
+       The variable values of delete_amr_variables are kept over all AMRs, as before (starting with var_dict)'''
+
+    if args.graph:
+        for record in serialize_graphs(records, args):
+            yield single_line_record(record)
+    else:
+        records = delete_wiki(records)
+        if args.delete_amr_var:
+            records = delete_amr_variables(records, var_dict)
+        for record in records:
+            single_amr, sent = single_line_record(record)
+            yield post_process_amr(args, single_amr), sent
+
+
+# components of the spaCy models that are not needed for tokenization
+NOT_TOKENIZER = ['tagger', 'parser', 'ner']
+
+
+class Tokenizer(object):
+    '''Tokenizer of a spaCy model. spaCy and the model are only loaded when the first sentence is tokenized, without
+       the components of the pipeline that are not needed for tokenization, so runs without sentences (e.g. -is_dir)
+       never load them. Sentences are tokenized in batches with nlp.pipe, by a pool of processes if processes > 1.
+       With a cache file (see TokenCache), sentences that were tokenized before are looked up instead'''
+
+    def __init__(self, model='en_core_web_sm', batch_size=1000, processes=1, cache_file=None, cache_size=1000000):
+        self.model = model
+        self.batch_size = batch_size
+        self.processes = processes
+        self.nlp = None
+        self.pool = None
+        self.cache = TokenCache(cache_file, self.version(), cache_size) if cache_file else None
+
+    def version(self):
+        '''Model name and versions of spaCy and the model, read from the installed packages without loading spaCy'''
+
+        import pkg_resources
+        versions = [self.model]
+        meta_file = os.path.join(self.model, 'meta.json')
+        if os.path.isfile(meta_file):
+            with open(meta_file, 'r') as in_f:
+                versions.append(json.load(in_f).get('version', ''))
+        for package in ['spacy', self.model]:
+            try:
+                versions.append(pkg_resources.get_distribution(package).version)
+            except Exception:
+                versions.append('')
+        return ' '.join(versions)
+
+    def load(self):
+        if self.nlp is None:
+            import spacy
+            self.nlp = spacy.load(self.model, disable=NOT_TOKENIZER)
+        return self.nlp
+
+    def tokenize_batch(self, sents):
+        '''Tokenized sentences (tokens separated by spaces) of a list of sentences, in this process'''
+
+        return [' '.join([token.text for token in doc]) for doc in self.load().pipe(sents, batch_size=self.batch_size)]
+
+    def get_pool(self):
+        '''Pool of processes, None if processes is 1 or if this process is a pool worker itself'''
+
+        if self.pool is None and self.processes > 1 and not current_process().daemon:
+            self.pool = Pool(processes=self.processes)
+        return self.pool
+
+    def tokenize(self, items):
+        '''Generator that yields (item, tokenized sentence) for each (item, sentence) pair, in order. Only a few
+           batches are in memory at a time'''
+
+        items = iter(items)
+        in_flight = deque()  # batches that are tokenized, in order
+
+        def finish(batch, cached, todo, tokenized):
+            tokenized = tokenized.get() if hasattr(tokenized, 'get') else tokenized
+            if self.cache is not None and todo:
+                self.cache.store(todo, tokenized)
+            tokenized = iter(tokenized)
+            for (item, _), tokenized_sent in zip(batch, cached):
+                yield item, next(tokenized) if tokenized_sent is None else tokenized_sent
+
+        while True:
+            batch = list(islice(items, self.batch_size))
+            if not batch:
+                break
+            sents = [sent for _, sent in batch]
+            cached = self.cache.lookup(sents) if self.cache is not None else [None] * len(sents)
+            todo = [sent for sent, tokenized_sent in zip(sents, cached) if tokenized_sent is None]
+            pool = self.get_pool()
+            if not todo:
+                in_flight.append((batch, cached, todo, []))
+            elif pool is None:
+                in_flight.append((batch, cached, todo, self.tokenize_batch(todo)))
+            else:
+                in_flight.append((batch, cached, todo, pool.apply_async(tokenize_chunk, ((self.model, self.batch_size, todo),))))
+            # keep all workers busy, while only a few batches are in memory
+            while len(in_flight) > 2 * self.processes:
+                for item in finish(*in_flight.popleft()):
+                    yield item
+        while in_flight:
+            for item in finish(*in_flight.popleft()):
+                yield item
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+        if self.cache is not None:
+            self.cache.close()
+
+
+# tokenizers of a pool worker, by model
+WORKER_TOKENIZERS = dict()
+
+
+def worker_tokenizer(model, batch_size):
+    '''Tokenizer of this pool worker, created once per model. The model is only loaded when it is needed'''
+
+    if model not in WORKER_TOKENIZERS:
+        WORKER_TOKENIZERS[model] = Tokenizer(model, batch_size)
+    return WORKER_TOKENIZERS[model]
+
+
+def tokenize_chunk(arg_list):
+    model, batch_size, sents = arg_list
+    return worker_tokenizer(model, batch_size).tokenize_batch(sents)
+
+
+class ChunkVariables(dict):
+    '''Variable values of delete_amr_variables in a chunk of AMRs that is converted by a pool worker. For the current
+       AMR, lookups has the value of each variable the first time it is referenced, None if it was not defined
+       earlier in the chunk (then the value of an earlier chunk would have been used)'''
+
+    def __init__(self):
+        dict.__init__(self)
+        self.lookups = dict()
+
+    def __contains__(self, key):
+        if key not in self.lookups:
+            self.lookups[key] = dict.get(self, key)
+        return dict.__contains__(self, key)
+
+
+def convert_chunk(arg_list):
+    '''Convert a chunk of AMR records in a pool worker (see convert_records). Returns the converted AMRs and
+       sentences, the variable lookups of each AMR that referenced a variable that was not defined earlier in the chunk
+       (None for the other AMRs) and the variable values at the end of the chunk'''
+
+    records, args = arg_list
+    var_dict = ChunkVariables()
+    converted, lookups = [], []
+    for item in convert_records(records, args, var_dict):
+        converted.append(item)
+        lookups.append(var_dict.lookups if None in var_dict.lookups.values() else None)
+        var_dict.lookups = dict()
+    return converted, lookups, dict(var_dict)
+
+
+def convert_records_parallel(records, args, tokenizer=None):
+    '''Generator that yields the same as convert_records, but with -procs converts chunks of -chunk records in the
+       pool of processes of the tokenizer. Only a few chunks are in memory at a time.
+       The variable values of delete_amr_variables are still kept over all AMRs: an AMR that referenced a variable
+       that was not defined earlier in its chunk is converted again with the values of the earlier chunks'''
+
+    pool = tokenizer.get_pool() if tokenizer is not None and args.procs > 1 else None
+    if pool is None:
+        for item in convert_records(records, args):
+            yield item
+        return
+    records = iter(records)
+    in_flight = deque()  # chunks that are converted, in order
+    var_dict = dict()  # variable values at the end of the chunks that were yielded
+
+    def finish(chunk, result):
+        converted, lookups, chunk_vars = result.get()
+        for record, item, lookup in zip(chunk, converted, lookups):
+            if lookup is not None and any(value is None and key in var_dict for key, value in lookup.items()):
+                values = dict([(key, var_dict[key] if value is None else value) for key, value in lookup.items()
+                               if value is not None or key in var_dict])
+                item = next(convert_records([record], args, values))
+            yield item
+        var_dict.update(chunk_vars)
+
+    while True:
+        chunk = list(islice(records, args.chunk))
+        if not chunk:
+            break
+        in_flight.append((chunk, pool.apply_async(convert_chunk, ((chunk, args),))))
+        while len(in_flight) > 2 * tokenizer.processes:
+            for item in finish(*in_flight.popleft()):
+                yield item
+    while in_flight:
+        for item in finish(*in_flight.popleft()):
+            yield item
+
+
+def convert_file(arg_list):
+    '''Convert a file of -is_dir in a pool worker (see gen_output)'''
+
+    path, f, args = arg_list
+    gen_output(path, f, args, filter_str='', tokenizer=worker_tokenizer(args.tok_model, args.tok_batch), has_sent=False)
+
+
+def output_writer(path, name, file_names, args):
+    """
+    Writer of aligned output files (see ShardWriter), in shards of -shard_size examples with the manifest
+    [path]/[name].manifest.json, and compressed with -compress
+    """
+    manifest_file = os.path.join(path, name + '.manifest.json') if args.shard_size else None
+    return ShardWriter(file_names, args.shard_size, args.compress, manifest_file)
 
 
-def gen_output(path, f, args, is_file=True, filter_str='', nlp=None, has_sent=True):
+def gen_output(path, f, args, is_file=True, filter_str='', tokenizer=None, has_sent=True):
     """
     Generate output in either file or dictionary format. Will automatically write to files.
+    The input is read in one pass (see convert_records): when writing to files, each AMR and sentence is written
+    as soon as it is converted, so memory does not grow with the size of the input.
+    The sentences are tokenized with tokenizer (see Tokenizer), not at all if has_sent is False and is_file is True.
+    Files are written with output_writer, so they can be sharded and compressed.
     """
     output_ext = args.output_ext
     sent_ext = args.sent_ext
-    amr_no_wiki = delete_wiki(f, filter_str)
-    if args.delete_amr_var:
-        amr_no_wiki = delete_amr_variables(amr_no_wiki, filter_str)
-    single_amrs, sents = single_line_convert(amr_no_wiki, filter_str)
-    tokenized_sents = []
-    for sent in sents:
-        doc = nlp.make_doc(sent)
-        tokenized_sents.append(' '.join([token.text for token in doc]))
-    single_amrs = post_process_line(args, single_amrs)
-
-    assert len(single_amrs) == len(tokenized_sents)  # sanity check
-    # print('Number of sentence processed: {}'.format(len(single_amrs)))
     if filter_str:
         filter_name = filter_str + '_'
     else:
         filter_name = 'all_'
-    if is_file:
-        out_tf = os.path.join(path, filter_name + os.path.basename(f) + output_ext)
-        out_sent = os.path.join(path, filter_name + os.path.basename(f) + sent_ext)
-        write_to_file(single_amrs, out_tf)
-        if has_sent:
-            write_to_file(tokenized_sents, out_sent)
-    else:
+    with open_file(f, 'r', 'utf-8') as in_f:
+        converted = convert_records_parallel(read_amr_records(in_f, filter_str), args, tokenizer)
+        if is_file:
+            name = filter_name + os.path.basename(f)
+            out_tf = os.path.join(path, name + output_ext)
+            out_sent = os.path.join(path, name + sent_ext)
+            with output_writer(path, name, [out_tf, out_sent] if has_sent else [out_tf], args) as writer:
+                if not has_sent:
+                    for single_amr, _ in converted:
+                        writer.write(single_amr.strip())
+                else:
+                    for single_amr, tokenized_sent in tokenizer.tokenize(converted):
+                        writer.write(single_amr.strip(), tokenized_sent.strip())
+        else:
+            single_amrs, tokenized_sents = tokenized_lists(converted, tokenizer)
+    if not is_file:
         result = dict()
         result[os.path.basename(f)] = (single_amrs, tokenized_sents)
         return result
 
 
-def split_file(f):
+def group_documents(f):
+    """
+    Read an AMR file in one pass and group its AMR records by document ID (the ::id up to the first '.', AMRs
+    without ::id belong to the document of the previous AMR), in the order the documents first occur
+    """
+    documents = OrderedDict()
+    file_id = None
+    with open_file(f, 'r', 'utf-8') as in_f:
+        for record in read_amr_records(in_f):
+            if record.id:
+                file_id = record.id.split('.')[0]
+            assert file_id
+            documents.setdefault(file_id, []).append(record)
+    return documents
+
+
+def tokenized_lists(converted, tokenizer):
+    """
+    Tokenize the sentences of converted AMRs (see convert_records) and return (AMRs, tokenized sentences)
+    """
+    single_amrs = []
+    tokenized_sents = []
+    for single_amr, tokenized_sent in tokenizer.tokenize(converted):
+        single_amrs.append(single_amr)
+        tokenized_sents.append(tokenized_sent)
+    return single_amrs, tokenized_sents
+
+
+def body_within_budget(converted, max_tokens):
+    """
+    Generator that yields the converted body AMRs of a document (see convert_records) as long as the AMRs have at
+    most max_tokens tokens in total. The AMRs after the budget is reached are not converted and not tokenized
+    """
+    num_tokens = 0
+    for single_amr, sent in converted:
+        num_tokens += len(single_amr.split())
+        if num_tokens > max_tokens:
+            break
+        yield single_amr, sent
+
+
+def convert_documents(documents, args, tokenizer):
     """
-    Split AMR file into files respecting to each document ID
+    Generator that converts the body and the summary AMRs of each document (see group_documents), classified by their
+    ::snt-type (AMRs without ::snt-type are both, as in read_amr_records), and yields (document ID, body, summary)
+    in the order of the documents. Body and summary are (AMRs, tokenized sentences).
+    Documents without summary AMRs are skipped, without converting their body. With -body_max_tokens, the body
+    only has the AMRs that fit in the token budget (see body_within_budget)
     """
-    files = dict()
-    store = ''
-    file_id = ''
-    for line in codecs.open(f, 'r', 'utf-8'):
-        # Skip first line in file
-        if line.startswith('# AMR'):
+    for file_id, records in documents.items():
+        summary = tokenized_lists(convert_records([record for record in records
+                                                   if record.metadata.get('snt-type', 'summary') == 'summary'], args),
+                                  tokenizer)
+        if not summary[0]:
             continue
-        # Save id
-        if line.startswith('# ::id'):
-            ids = line.split(' ')[2].split('.')
-            file_id = ids[0]
-        # Blank line and filled store
-        if not line.strip() and store:
-            store += '\n'
-            assert file_id != ''
-            files[file_id] = files.setdefault(file_id, '') + store
-            store = ''
-        # All lines that are not blank
-        elif line.strip():
-            store += line
-    return files
+        converted = convert_records([record for record in records
+                                     if record.metadata.get('snt-type', 'body') == 'body'], args)
+        if args.body_max_tokens:
+            converted = body_within_budget(converted, args.body_max_tokens)
+        yield file_id, tokenized_lists(converted, tokenizer), summary
+
+
+def join_body(body):
+    """
+    Single line of the body AMRs of a document, each preceded by <<sep>>, and single line of its sentences
+    """
+    body_amrs, body_sents = body
+    return ''.join(['<<sep>>' + body_amr for body_amr in body_amrs]), ' '.join(body_sents)
+
+
+def write_side_files(path, f, documents, args, tokenizer):
+    """
+    Write the summary AMRs of the documents (see convert_documents) to summary_[f], and the body of their document as
+    side information to body_[f], one line per summary AMR. Documents are written as soon as they are converted,
+    and the body line of a document is joined only once.
+    With -body_ref, body_[f] has the body of each document only once, and the document IDs of the body and summary
+    lines are written to body_[f].ids and summary_[f].ids.
+    The files are written with output_writer: without -body_ref, the body and summary files are sharded together
+    """
+    name = os.path.basename(f)
+    body_files = [os.path.join(path, 'body_' + name + ext) for ext in [args.output_ext, args.sent_ext]]
+    summ_files = [os.path.join(path, 'summary_' + name + ext) for ext in [args.output_ext, args.sent_ext]]
+    if args.body_ref:
+        body_writer = output_writer(path, 'body_' + name, body_files + [os.path.join(path, 'body_' + name + '.ids')], args)
+        summ_writer = output_writer(path, 'summary_' + name, summ_files + [os.path.join(path, 'summary_' + name + '.ids')], args)
+        writers = [body_writer, summ_writer]
+    else:
+        body_writer = None
+        summ_writer = output_writer(path, 'summary_' + name, summ_files + body_files, args)
+        writers = [summ_writer]
+    try:
+        for file_id, body, (summ_amrs, summ_sents) in convert_documents(documents, args, tokenizer):
+            assert len(summ_amrs) == len(summ_sents)
+            single_body_amrs, single_body_sents = join_body(body)
+            single_body_amrs = single_body_amrs.strip()
+            single_body_sents = single_body_sents.strip()
+            if body_writer is not None:
+                body_writer.write(single_body_amrs, single_body_sents, file_id)
+            for summ_amr, summ_sent in zip(summ_amrs, summ_sents):
+                if body_writer is not None:
+                    summ_writer.write(summ_amr.strip(), summ_sent.strip(), file_id)
+                else:
+                    summ_writer.write(summ_amr.strip(), summ_sent.strip(), single_body_amrs, single_body_sents)
+    except:
+        for writer in writers:
+            writer.abort()
+        raise
+    for writer in writers:
+        writer.close()
 
 
 if __name__ == "__main__":
     args = create_args_parser()
-    nlp = spacy.load('en_core_web_sm')
+    tokenizer = Tokenizer(args.tok_model, args.tok_batch, max(args.procs, args.tok_procs), args.tok_cache,
+                          args.tok_cache_size)
 
     print('Converting {0}...'.format(args.f))
 
     if args.is_dir:
-        for filename in os.listdir(args.f):
-            if filename.endswith('system'):
-                file_path = os.path.join(args.f, filename)
-                gen_output(args.output_path, file_path, args, filter_str='', nlp=nlp, has_sent=False)
-            pass
+        file_paths = [os.path.join(args.f, filename) for filename in os.listdir(args.f) if filename.endswith('system')]
+        if args.procs > 1:
+            # imap keeps the order of the files, so errors are raised for the same file as without -procs
+            for _ in tokenizer.get_pool().imap(convert_file, [(args.output_path, file_path, args) for file_path in file_paths]):
+                pass
+        else:
+            for file_path in file_paths:
+                gen_output(args.output_path, file_path, args, filter_str='', tokenizer=tokenizer, has_sent=False)
         if args.with_side:
-            # Write split files
-            files = split_file(args.side_file)
-            body_result = dict()
-            summary_result = dict()
-            for file_id, lines in files.items():
-                file_name = os.path.join(args.output_path, file_id + '.txt')
-                new_file = codecs.open(file_name, 'w', 'utf-8')
-                new_file.write(lines)
-                new_file.close()
-                body_result.update(gen_output(args.output_path, file_name, args, is_file=False, filter_str='body', nlp=nlp))
-                summary_result.update(
-                    gen_output(args.output_path, file_name, args, is_file=False, filter_str='summary', nlp=nlp))
-                os.remove(file_name)
-            assert body_result != None and summary_result != None
-            # Join all body_result and summary_result into a single file
-            for file_id, (summ_amrs, summ_sents) in summary_result.items():
-                body_amrs, body_sents = body_result[file_id]
-                assert len(summ_amrs) == len(summ_sents)
-                for i in range(len(summ_sents)):
-                    a_body_amrs = ''
-                    for body_amr in body_amrs:
-                        a_body_amrs = a_body_amrs + '<<sep>>' + body_amr
-                    single_body_amrs = a_body_amrs
-                    single_body_sents = ' '.join(body_sents)
-                    out_tf = os.path.join(
-                        args.output_path,
-                        'body_all_' + file_id[:-4] + '_system' + args.output_ext + '.s')
-                    out_sent = os.path.join(
-                        args.output_path,
-                        'body_all_' + file_id[:-4] + '_system.tf' + args.sent_ext + '.s')
-                    write_to_file(single_body_amrs, out_tf, False)
-                    write_to_file(single_body_sents, out_sent, False)
+            # Group the AMRs by document, no split files are written
+            for file_id, body, _ in convert_documents(group_documents(args.side_file), args, tokenizer):
+                single_body_amrs, single_body_sents = join_body(body)
+                out_tf = os.path.join(
+                    args.output_path,
+                    'body_all_' + file_id + '_system' + args.output_ext + '.s')
+                out_sent = os.path.join(
+                    args.output_path,
+                    'body_all_' + file_id + '_system.tf' + args.sent_ext + '.s')
+                write_to_file(single_body_amrs, out_tf, False)
+                write_to_file(single_body_sents, out_sent, False)
     else:
         if 'training' in args.f:
             split_path = 'training'
@@ -333,54 +637,14 @@ if __name__ == "__main__":
             new_path = os.path.join(args.output_path, 'no_filter', split_path)
 
         if 'training' in new_path:
-            gen_output(new_path, args.f, args, filter_str=filter_str, nlp=nlp)
+            gen_output(new_path, args.f, args, filter_str=filter_str, tokenizer=tokenizer)
         else:
             if args.with_side:
-                # Write split files
-                files = split_file(args.f)
-                body_result = dict()
-                summary_result = dict()
-                for file_id, lines in files.items():
-                    file_name = os.path.join(new_path, 'amr_' + file_id + '.txt')
-                    new_file = codecs.open(file_name, 'w', 'utf-8')
-                    new_file.write(lines)
-                    new_file.close()
-                    body_result.update(gen_output(new_path, file_name, args, is_file=False, filter_str='body', nlp=nlp))
-                    summary_result.update(gen_output(new_path, file_name, args, is_file=False, filter_str='summary', nlp=nlp))
-                    os.remove(file_name)
-                assert body_result != None and summary_result != None
-                # Join all body_result and summary_result into a single file
-                single_body_amrs = []
-                single_body_sents = []
-                single_summ_amrs = []
-                single_summ_sents = []
-                for file_id, (summ_amrs, summ_sents) in summary_result.items():
-                    body_amrs, body_sents = body_result[file_id]
-                    assert len(summ_amrs) == len(summ_sents)
-                    for i in range(len(summ_sents)):
-                        single_summ_amrs.append(summ_amrs[i])
-                        single_summ_sents.append(summ_sents[i])
-                        a_body_amrs = ''
-                        for body_amr in body_amrs:
-                            a_body_amrs = a_body_amrs + '<<sep>>' + body_amr
-                        single_body_amrs.append(a_body_amrs)
-                        single_body_sents.append(' '.join(body_sents))
-                out_tf = os.path.join(
-                    new_path,
-                    'body_' + os.path.basename(args.f) + args.output_ext)
-                out_sent = os.path.join(
-                    new_path,
-                    'body_' + os.path.basename(args.f) + args.sent_ext)
-                write_to_file(single_body_amrs, out_tf)
-                write_to_file(single_body_sents, out_sent)
-                out_tf = os.path.join(
-                    new_path,
-                    'summary_' + os.path.basename(args.f) + args.output_ext)
-                out_sent = os.path.join(
-                    new_path,
-                    'summary_' + os.path.basename(args.f) + args.sent_ext)
-                write_to_file(single_summ_amrs, out_tf)
-                write_to_file(single_summ_sents, out_sent)
+                # Group the AMRs by document, no split files are written
+                write_side_files(new_path, args.f, group_documents(args.f), args, tokenizer)
             else:
-                gen_output(new_path, args.f, args, filter_str=filter_str, nlp=nlp)
+                gen_output(new_path, args.f, args, filter_str=filter_str, tokenizer=tokenizer)
 
+    if tokenizer.cache is not None:
+        print(tokenizer.cache.stats())
+    tokenizer.close()
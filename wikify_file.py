@@ -63,12 +63,12 @@ def wikify_file(in_file, in_sents):
 	'''Takes .amr-files as input, outputs .amr.wiki-files
 	with wikification using DBPedia Spotlight.'''
 	
-	sentences = [x.strip() for x in open(in_sents,'r')]
+	sentences = [x.strip() for x in open_file(in_sents,'r')]
 	all_found = 0
 	unicode_errors = 0
 	
-	with open(in_file, 'r') as infile:
-		with open(in_file + '.wiki', 'w') as outfile:
+	with open_file(in_file, 'r') as infile:
+		with open_file(in_file + '.wiki', 'w') as outfile:
 			foundName = False
 			foundWiki = False
 			currName = ''  # String to contain the parts of names found